@@ -1,5 +1,7 @@
 from enum        import Enum
 from binary_file import sign_extend
+from pec         import PEC_HEADER, PEC_INDEXES, PEC_DIMENSIONS
+from pesv6       import PES_PHYSICAL_DIMENSIONS
 
 HIDE_THREAD_INDEXES = False
 
@@ -12,6 +14,12 @@ class Cmd(Enum):
 
 class PecDumperMixin:
 
+    def check(self, condition, message, /, severity=None, offset=None):
+        ## Report the anomaly in line with the dump and keep going.
+        if not condition:
+            self.print('*** {:s}'.format(message))
+        return condition
+
     def get_coord(self):
         b1 = self.get_uint8()
         if b1 == 0xFF:          # end of coordinates
@@ -65,37 +73,23 @@ def dump_pec_prologue(f):
     end of file."""
 
     with f.section('PEC Header', tab=20):
-        assert f.dump_text('label_marker', 3) == 'LA:'
-        label = f.dump_text('label', 16)
-        f.dump_uint8('carriage_return')
-        unknown1 = f.dump_data('unknown1', 11)
-        unknown2 = f.dump_data('unknown2', 3)
-        thumb_w = f.dump_uint8('thumb_w')   # in bytes, typically 6
-        thumb_h = f.dump_uint8('thumb_h')   # in scanlines, typically 38 
-        f.dump_data('unknown3a', 1)
-        f.dump_data('unknown3b', 1)
-        f.dump_vector_int8('unknown3c', 2)
-        f.dump_data('unknown3d', 1)
-        f.dump_data('unknown3e', 4)
-        f.dump_data('unknown3f', 1)
-        f.dump_data('unknown3g', 2)
+        header = PEC_HEADER.dump(f)
+        thumb_w = header['thumb_w']   # in bytes, typically 6
+        thumb_h = header['thumb_h']   # in scanlines, typically 38
 
     with f.section('Thread Indexes', tab=20, hide=HIDE_THREAD_INDEXES):
-        n_changes = f.dump_uint8('n_changes')
-        n_layers = n_changes+1
-        indexes = f.dump_data('thread_indexes', 463)
+        values = PEC_INDEXES.dump(f)
+        n_layers = values['n_changes']+1
+        indexes = values['indexes']
         end_of_index_list = f.tell()
 
     with f.section('Pattern', tab=20):
 
         ## Header
-        f.dump_data('unknown', 2)
-        thumbnail_offset = f.dump_uint24('thumbnail_offset', fmt='0x{:06X}')
-        f.dump_data('unknown', 3)
-        width =  f.dump_uint16('width')
-        height = f.dump_uint16('height')
-        f.dump_uint16('unknown_width')
-        f.dump_uint16('unknown_height')
+        dimensions = PEC_DIMENSIONS.dump(f)
+        thumbnail_offset = dimensions['thumbnail_offset']
+        width = dimensions['width']
+        height = dimensions['height']
         f.print()
 
         ## Stitches
@@ -236,8 +230,7 @@ def dump_pec_section_data(f):
            f.dump_scanline(None, SCAN_W)
 
     with f.section('Physical Dimensions'):
-        f.dump_int16('Width')
-        f.dump_int16('Height')
+        PES_PHYSICAL_DIMENSIONS.dump(f)
 
     with f.section('Huge Thumbnail', tab=0, hide=not f.show_bitmaps):
         SCAN_W = 30
@@ -1,4 +1,7 @@
 from enum import Enum
+from pesv6 import (PES_HEADER_PROLOGUE, PES_HEADER_EPILOGUE, PES_THREAD,
+                   PES_OBJECT_HEADER, CSEWSEG_BLOCK_HEADER, TAGGED_STRING_MARKER,
+                   decode_tagged_string)
 
 class HOOP(Enum):
     SIZE_100x100 = 1
@@ -14,9 +17,9 @@ class PesDumperMixin:
     
     def get_tagged_string(self):
         tag = self.get_uint24()
-        assert tag == 0xFFFEFF
+        assert tag == TAGGED_STRING_MARKER
         length = self.get_uint8()
-        return(''.join(chr(self.get_uint16()) for _ in range(length)))  # unicode?
+        return decode_tagged_string(self.get_data(2*length))
         
     def dump_tagged_string(self, id, fmt='"{:s}"'):
         self.print_addr()
@@ -24,67 +27,22 @@ class PesDumperMixin:
 
     def dump_header_prologue(self):
         with self.section('PES Header Prologue'):
-            pec_offset = self.dump_uint32('pec_offset', fmt='hex')
-            n_pecs = self.dump_uint16('n_pecs')
-            self.dump_text('hoop_size', 2)
-            self.dump_utf8('name')
-            self.dump_utf8('category')
-            self.dump_utf8('author')
-            self.dump_utf8('keywords')
-            self.dump_utf8('comments')
-            self.dump_bool16('optimize_hoop_change')
-            self.dump_bool16('custom_design_page')
-            self.dump_uint16('hoop_width')
-            self.dump_uint16('hoop_height')
-            self.dump_uint16('design_page_area') # doc says "hoop rotation (1=90 degrees)
-            self.dump_uint16('design_width')
-            self.dump_uint16('design_height')
-            self.dump_uint16('section_width')
-            self.dump_uint16('section_height')
-            self.dump_data('unknown', 2) # doc: must be in same ranges as section width & height 
-            self.dump_uint16('background_color')
-            self.dump_uint16('foreground_color')
-            self.dump_bool16('show_grid')
-            self.dump_bool16('with_axes')
-            self.dump_bool16('snap_to_grid')
-            self.dump_uint16('grid_interval')
-            self.dump_data('unknown', 2)
-            self.dump_bool16('optimize_entry_exit_points')
-            self.dump_utf8('from_image')
-            self.dump_vector_float32('transform_matrix', 6)
-        return n_pecs, pec_offset
+            values = PES_HEADER_PROLOGUE.dump(self)
+        return values['n_pecs'], values['pec_offset']
 
     def dump_thread(self):
-        self.dump_tagged_string('code')
-        self.dump_data('color_rgbx', 4)
-        self.dump_uint32('color_type')
-        self.dump_tagged_string('description') 
-        self.dump_tagged_string('brand')
-        self.dump_tagged_string('chart_length') # doc says chart_name
+        PES_THREAD.dump(self)
 
     def dump_csewseg_header(self):
-        self.dump_vector_int16('extents1', 4)
-        self.dump_vector_int16('extents2', 4)
-        self.dump_vector_float32('transform_matrix', 6)
-        self.dump_data('unknown1', 2)
-        self.dump_int16('x_translation')
-        self.dump_int16('y_translation')
-        self.dump_int16('width')
-        self.dump_int16('height')
-        self.dump_data('unknown2', 8)
-        n_blocks = self.dump_uint16('n_blocks')
-        assert(self.dump_uint32('end marker', fmt='hex') == 0xFFFF)
-        return n_blocks
+        return PES_OBJECT_HEADER.dump(self)['n_blocks']
 
     def dump_csewseg_stitch_list(self, n_blocks):
         for j in range(n_blocks):
             with self.subsection('Stitch List Block {:d}/{:d}'.format(j+1, n_blocks)):
-                self.dump_uint16('stitch_type')
-                self.dump_uint16('thread_index')
                 ## Coordinates here are absolute. Their deltas coorespond to the stitches
                 ## in the PEC section, except that the y-coordinate is first and the
                 ## x-coordinate is second.
-                n_coordinates = self.dump_uint16('n_coordinates')
+                n_coordinates = CSEWSEG_BLOCK_HEADER.dump(self)['n_coordinates']
                 self.tab = 0
                 for k in range(n_coordinates):
                     self.dump_vector_int16(None, 2)
@@ -108,13 +66,16 @@ def dump_pes_data(f):
     n_pecs, pec_offset = f.dump_header_prologue()
 
     with f.section('Fill Patterns'):
-        assert f.dump_uint16('n_fill_patterns') == 0
+        n_patterns = f.dump_uint16('n_fill_patterns')
+        f.check(n_patterns == 0, 'fill patterns are not supported')
 
     with f.section('Motif Patterns'):
-        assert f.dump_uint16('n_motif_patterns') == 0
+        n_patterns = f.dump_uint16('n_motif_patterns')
+        f.check(n_patterns == 0, 'motif patterns are not supported')
 
     with f.section('Feather Patterns'):
-        assert f.dump_uint16('n_feather_patterns') == 0
+        n_patterns = f.dump_uint16('n_feather_patterns')
+        f.check(n_patterns == 0, 'feather patterns are not supported')
 
     with f.section('Threads', tab=16):
         nthreads = f.dump_uint16('n_threads')
@@ -124,8 +85,7 @@ def dump_pes_data(f):
                 f.dump_thread()
 
     with f.section('PES Header Epilogue'):
-        n_objects = f.dump_uint16('n_objects')
-        assert(f.dump_uint32('end marker', fmt='hex') == 0xFFFF) # end of header marker
+        n_objects = PES_HEADER_EPILOGUE.dump(f)['n_objects']
 
     ## Per doc, the structure is:
     ##
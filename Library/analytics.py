@@ -0,0 +1,179 @@
+###---------------------------------------------------------------------------------------------
+### analytics
+###
+### Stitch statistics for quoting jobs: per layer and per thread, the stitch, jump and
+### trim counts, thread consumption, bounding box, longest stitch and estimated sew time.
+### Run as a script, streams the statistics for files and directories to CSV.
+###---------------------------------------------------------------------------------------------
+
+import csv
+import numpy as np
+from sys        import argv, stdout, stderr
+from os         import environ
+from os.path    import basename
+from contextlib import nullcontext
+from argparse   import ArgumentParser, RawDescriptionHelpFormatter
+from pec        import Cmd
+from pesv6      import PESv6
+from stitches   import UNITS_PER_MM, pec_arrays, absolute
+from validate   import expand_paths
+
+description = "Writes stitch statistics for .pes embroidery files as CSV."
+
+## Machine speed in stitches per minute. The Luminaire tops out at 1050.
+DEFAULT_SPEED = 800
+
+COLUMNS = ('path', 'scope', 'pec', 'layer', 'rgb', 'brand', 'code', 'blocks',
+           'stitches', 'jumps', 'trims', 'thread_mm', 'longest_mm',
+           'min_x_mm', 'min_y_mm', 'max_x_mm', 'max_y_mm', 'sew_seconds')
+
+
+def pec_layer_stats(pec, /, speed=DEFAULT_SPEED):
+
+    """Returns a list of statistics dictionaries, one per layer of pec. All layers are
+    computed together from the arrays of the whole PEC."""
+
+    n = len(pec.layers)
+    layer, cmd, dx, dy = pec_arrays(pec)
+    x, y = absolute(dx, dy)
+    length = np.hypot(dx, dy)
+
+    stitch = cmd == Cmd.STITCH
+    n_stitches = np.bincount(layer, weights=stitch, minlength=n)
+    n_jumps = np.bincount(layer, weights=cmd == Cmd.JUMP, minlength=n)
+    n_trims = np.bincount(layer, weights=cmd == Cmd.TRIM, minlength=n)
+    thread = np.bincount(layer, weights=np.where(stitch, length, 0.0), minlength=n)
+
+    longest = np.zeros(n)
+    np.maximum.at(longest, layer[stitch], length[stitch])
+
+    ## The box covers both ends of every stitch; jumps and trims sew nothing.
+    lo = np.full((2, n), np.inf)
+    hi = np.full((2, n), -np.inf)
+    for axis, (end, delta) in enumerate(((x, dx), (y, dy))):
+        end = end[stitch]
+        start = end-delta[stitch]
+        np.minimum.at(lo[axis], layer[stitch], np.minimum(start, end))
+        np.maximum.at(hi[axis], layer[stitch], np.maximum(start, end))
+
+    seconds = (n_stitches+n_jumps+n_trims)*60.0/speed
+
+    return [dict(stitches   = int(n_stitches[i]),
+                 jumps      = int(n_jumps[i]),
+                 trims      = int(n_trims[i]),
+                 thread_mm  = thread[i]/UNITS_PER_MM,
+                 longest_mm = longest[i]/UNITS_PER_MM,
+                 min_x_mm   = lo[0,i]/UNITS_PER_MM,
+                 min_y_mm   = lo[1,i]/UNITS_PER_MM,
+                 max_x_mm   = hi[0,i]/UNITS_PER_MM,
+                 max_y_mm   = hi[1,i]/UNITS_PER_MM,
+                 sew_seconds = seconds[i])
+            for i in range(n)]
+
+
+def combine_stats(stats):
+
+    """Combines statistics dictionaries, e.g. those of all layers sewn with one thread."""
+
+    combined = {}
+    for key in ('stitches', 'jumps', 'trims', 'thread_mm', 'sew_seconds'):
+        combined[key] = sum(s[key] for s in stats)
+    for key in ('longest_mm', 'max_x_mm', 'max_y_mm'):
+        combined[key] = max(s[key] for s in stats)
+    for key in ('min_x_mm', 'min_y_mm'):
+        combined[key] = min(s[key] for s in stats)
+    return combined
+
+
+def design_stats(design, /, speed=DEFAULT_SPEED):
+
+    """Yields a row for every layer of every PEC in design, then one for every thread,
+    identified by its RGB color. Thread rows name the brand and code of the matching
+    entry in the PES thread table, and count the CSewSeg blocks sewn with it."""
+
+    pes_threads = {tuple(thread.rgbx[:3]): thread for thread in design.threads}
+    blocks = {}
+    for obj in design.objects:
+        for stitch_type, thread_index, coordinates in getattr(obj, 'blocks', ()):
+            if thread_index < len(design.threads):
+                rgb = tuple(design.threads[thread_index].rgbx[:3])
+                blocks[rgb] = blocks.get(rgb, 0)+1
+
+    by_thread = {}
+    for p, pec in enumerate(design.pecs):
+        for i, stats in enumerate(pec_layer_stats(pec, speed=speed)):
+            rgb = pec.layer_rgb(i) if pec.indexes[i] < len(pec.rgbs) else None
+            by_thread.setdefault(rgb, []).append(stats)
+            yield dict(stats, scope='layer', pec=p, layer=i, rgb=rgb)
+
+    for rgb, stats in by_thread.items():
+        thread = pes_threads.get(rgb)
+        yield dict(combine_stats(stats), scope='thread', rgb=rgb,
+                   brand=thread.brand if thread else None,
+                   code=thread.code if thread else None,
+                   blocks=blocks.get(rgb, 0))
+
+
+def format_row(path, row):
+    row = dict(row, path=path)
+    if row['rgb'] is not None:
+        row['rgb'] = '#{:02X}{:02X}{:02X}'.format(*row['rgb'])
+    for key, value in row.items():
+        if isinstance(value, float):
+            row[key] = '' if np.isinf(value) else '{:.1f}'.format(value)
+    return row
+
+
+def write_csv(paths, ofile, /, speed=DEFAULT_SPEED):
+
+    """Streams the statistics of every .pes file in paths, descending into
+    directories, to ofile as CSV. Files that fail to parse are reported on stderr and
+    skipped."""
+
+    writer = csv.DictWriter(ofile, COLUMNS, lineterminator='\n')
+    writer.writeheader()
+    for path in expand_paths(paths):
+        try:
+            design = PESv6().get(path)
+        except Exception as e:
+            print('{:s}: {:s}: {}'.format(path, type(e).__name__, e), file=stderr)
+            continue
+        writer.writerows(format_row(path, row) for row in design_stats(design, speed=speed))
+
+
+def main():
+
+    if (script := environ.get('RUNPYTHON')):
+        command = basename(script)
+    else:
+        command = 'python3 {}'.format(argv[0])
+
+    parser = ArgumentParser(prog=command, description=description,
+                            allow_abbrev=False,
+                            formatter_class=RawDescriptionHelpFormatter)
+
+    parser.add_argument('paths', metavar='path', type=str, nargs='+',
+                        help="pathname of a file, or of a directory to search for .pes files")
+
+    parser.add_argument('-o', '--output',
+                        dest='output',
+                        type=str,
+                        help="pathname of the CSV file to write instead of stdout")
+
+    parser.add_argument('-s', '--speed',
+                        dest='speed',
+                        type=float,
+                        help="machine speed in stitches per minute (default {:d})"
+                        .format(DEFAULT_SPEED))
+
+    parser.set_defaults(output=None, speed=DEFAULT_SPEED)
+
+    args = parser.parse_args()
+
+    with (open(args.output, 'w', newline='') if args.output else
+          nullcontext(stdout)) as ofile:
+        write_csv(args.paths, ofile, speed=args.speed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+from enum import IntEnum
+
+
+class Severity(IntEnum):
+    INFO    = 0     # worth knowing, no effect on parsing or round-tripping
+    WARNING = 1     # unexpected, but the parse stays in sync
+    ERROR   = 2     # the file does not match the structure the library assumes
+    FATAL   = 3     # parsing could not continue
+
+
+class Anomaly:
+
+    def __init__(self, offset, severity, message):
+        self.offset     = offset
+        self.severity   = severity
+        self.message    = message
+
+    def __repr__(self):
+        return '{:s}(0x{:06X}, {:s}, {!r:s})'.format(
+            __class__.__name__, self.offset, self.severity.name, self.message)
+
+    def __str__(self):
+        return '0x{:06X} {:7s} {:s}'.format(self.offset, self.severity.name, self.message)
+
+
+class FormatError(Exception):
+
+    def __init__(self, anomaly):
+        super(__class__, self).__init__(str(anomaly))
+        self.anomaly = anomaly
@@ -0,0 +1,314 @@
+###---------------------------------------------------------------------------------------------
+### buffered_file
+###
+### A writer with the same put_* interface as BinaryFileWriter that assembles the whole
+### file in a bytearray. Fields whose values are not known until later, such as offsets
+### to sections that have not been written yet, are registered as named placeholders and
+### back-patched. The file is written in one call when the writer is closed, by default
+### through a temporary file that is renamed over the destination. BufferedFileReader is
+### the matching reader with the get_* interface of BinaryFileReader, over bytes already
+### in memory, such as a slice of a memory map.
+###---------------------------------------------------------------------------------------------
+
+import os
+from struct     import Struct
+from tempfile   import NamedTemporaryFile
+from os.path    import dirname, abspath
+
+UINT8   = Struct('<B')
+INT8    = Struct('<b')
+UINT16  = Struct('<H')
+INT16   = Struct('<h')
+UINT32  = Struct('<I')
+INT32   = Struct('<i')
+UINT64  = Struct('<Q')
+INT64   = Struct('<q')
+FLOAT32 = Struct('<f')
+FLOAT64 = Struct('<d')
+
+
+class BufferedFileWriter:
+
+    def __init__(self, path=None, /, atomic=True):
+        self.path = path
+        self.atomic = atomic
+        self.buffer = bytearray()
+        self.placeholders = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def tell(self):
+        return len(self.buffer)
+
+    def getvalue(self):
+        return bytes(self.buffer)
+
+
+    ## Placeholders
+
+    def placeholder(self, name, size, /, offset=None):
+        """Registers size bytes at offset, by default the next size bytes to be written,
+        as a placeholder to be filled in later by patch."""
+        assert name not in self.placeholders, (
+            'placeholder {!r:s} is already pending'.format(name))
+        self.placeholders[name] = (self.tell() if offset is None else offset, size)
+
+    def patch(self, name, value):
+        """Overwrites the named placeholder with an unsigned integer or with bytes."""
+        offset, size = self.placeholders.pop(name)
+        if isinstance(value, int):
+            value = value.to_bytes(size, 'little')
+        assert len(value) == size, (
+            'placeholder {!r:s} is {:d} bytes, not {:d}'.format(name, size, len(value)))
+        self.buffer[offset:offset+size] = value
+
+    def close(self):
+        assert not self.placeholders, (
+            'placeholders never patched: {:s}'.format(', '.join(self.placeholders)))
+        if self.path is None:
+            return
+        if not self.atomic:
+            with open(self.path, 'wb') as file:
+                file.write(self.buffer)
+            return
+        umask = os.umask(0)
+        os.umask(umask)
+        with NamedTemporaryFile(dir=dirname(abspath(self.path)), delete=False) as file:
+            try:
+                file.write(self.buffer)
+                file.flush()
+                os.fsync(file.fileno())
+                os.chmod(file.name, 0o666 & ~umask)
+            except BaseException:
+                file.close()
+                os.remove(file.name)
+                raise
+        os.replace(file.name, self.path)
+
+
+    ## Fields
+
+    def put_data(self, data):
+        self.buffer += data
+
+    def put_uint(self, size, value):
+        self.buffer += value.to_bytes(size, 'little')
+
+    def put_int(self, size, value):
+        self.buffer += value.to_bytes(size, 'little', signed=True)
+
+    def put_uint8(self, value):
+        self.buffer.append(value)
+
+    def put_int8(self, value):
+        self.buffer += INT8.pack(value)
+
+    def put_uint16(self, value):
+        self.buffer += UINT16.pack(value)
+
+    def put_int16(self, value):
+        self.buffer += INT16.pack(value)
+
+    def put_uint24(self, value):
+        self.buffer += value.to_bytes(3, 'little')
+
+    def put_int24(self, value):
+        self.buffer += value.to_bytes(3, 'little', signed=True)
+
+    def put_uint32(self, value):
+        self.buffer += UINT32.pack(value)
+
+    def put_int32(self, value):
+        self.buffer += INT32.pack(value)
+
+    def put_uint64(self, value):
+        self.buffer += UINT64.pack(value)
+
+    def put_int64(self, value):
+        self.buffer += INT64.pack(value)
+
+    def put_bool8(self, value):
+        self.buffer.append(int(bool(value)))
+
+    def put_bool16(self, value):
+        self.buffer += UINT16.pack(int(bool(value)))
+
+    def put_float32(self, value):
+        self.buffer += FLOAT32.pack(value)
+
+    def put_float64(self, value):
+        self.buffer += FLOAT64.pack(value)
+
+    def put_text(self, text):
+        self.buffer += text.encode('latin-1')
+
+    def put_utf8(self, text, /, length_size=1):
+        ## Lone surrogates from bytes that were not UTF-8 are written back as those bytes.
+        data = text.encode('utf8', 'surrogateescape')
+        self.put_uint(length_size, len(data))
+        self.buffer += data
+
+    def put_vector(self, code, vector):
+        ## vector packed with the struct code of its elements.
+        self.buffer += Struct('<{:d}{:s}'.format(len(vector), code)).pack(*vector)
+
+    def put_vector_int8(self, vector):
+        self.put_vector('b', vector)
+
+    def put_vector_uint8(self, vector):
+        self.put_vector('B', vector)
+
+    def put_vector_int16(self, vector):
+        self.put_vector('h', vector)
+
+    def put_vector_uint16(self, vector):
+        self.put_vector('H', vector)
+
+    def put_vector_int32(self, vector):
+        self.put_vector('i', vector)
+
+    def put_vector_uint32(self, vector):
+        self.put_vector('I', vector)
+
+    def put_vector_float32(self, vector):
+        self.put_vector('f', vector)
+
+    def put_vector_float64(self, vector):
+        self.put_vector('d', vector)
+
+
+
+class BufferedFileReader:
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.data = b''
+
+    def tell(self):
+        return self.offset
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.offset
+        elif whence == os.SEEK_END:
+            offset += len(self.data)
+        self.offset = offset
+        return offset
+
+
+    ## Fields
+
+    def get_data(self, size):
+        ## Always a copy, so that nothing read keeps the buffer alive.
+        start = self.offset
+        if size < 0 or start+size > len(self.data):
+            raise EOFError('cannot read {:d} bytes at 0x{:06X} of {:d}'
+                           .format(size, start, len(self.data)))
+        self.offset = start+size
+        return bytes(self.data[start:start+size])
+
+    def get_struct(self, struct):
+        ## The single value packed by struct.
+        start = self.offset
+        if start+struct.size > len(self.data):
+            raise EOFError('cannot read {:d} bytes at 0x{:06X} of {:d}'
+                           .format(struct.size, start, len(self.data)))
+        self.offset = start+struct.size
+        return struct.unpack_from(self.data, start)[0]
+
+    def get_uint(self, size):
+        return int.from_bytes(self.get_data(size), 'little')
+
+    def get_int(self, size):
+        return int.from_bytes(self.get_data(size), 'little', signed=True)
+
+    def get_uint8(self):
+        return self.get_struct(UINT8)
+
+    def get_int8(self):
+        return self.get_struct(INT8)
+
+    def get_uint16(self):
+        return self.get_struct(UINT16)
+
+    def get_int16(self):
+        return self.get_struct(INT16)
+
+    def get_uint24(self):
+        return self.get_uint(3)
+
+    def get_int24(self):
+        return self.get_int(3)
+
+    def get_uint32(self):
+        return self.get_struct(UINT32)
+
+    def get_int32(self):
+        return self.get_struct(INT32)
+
+    def get_uint64(self):
+        return self.get_struct(UINT64)
+
+    def get_int64(self):
+        return self.get_struct(INT64)
+
+    def get_bool8(self):
+        return self.get_uint8() != 0
+
+    def get_bool16(self):
+        return self.get_uint16() != 0
+
+    def get_float32(self):
+        return self.get_struct(FLOAT32)
+
+    def get_float64(self):
+        return self.get_struct(FLOAT64)
+
+    def get_text(self, size):
+        return self.get_data(size).decode('latin-1')
+
+    def get_utf8(self, /, length_size=1):
+        return self.get_data(self.get_uint(length_size)).decode('utf8')
+
+    def get_vector(self, code, n):
+        ## n elements of the given struct code.
+        struct = Struct('<{:d}{:s}'.format(n, code))
+        return struct.unpack(self.get_data(struct.size))
+
+    def get_vector_int8(self, n):
+        return self.get_vector('b', n)
+
+    def get_vector_uint8(self, n):
+        return self.get_vector('B', n)
+
+    def get_vector_int16(self, n):
+        return self.get_vector('h', n)
+
+    def get_vector_uint16(self, n):
+        return self.get_vector('H', n)
+
+    def get_vector_int32(self, n):
+        return self.get_vector('i', n)
+
+    def get_vector_uint32(self, n):
+        return self.get_vector('I', n)
+
+    def get_vector_float32(self, n):
+        return self.get_vector('f', n)
+
+    def get_vector_float64(self, n):
+        return self.get_vector('d', n)
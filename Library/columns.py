@@ -0,0 +1,615 @@
+###---------------------------------------------------------------------------------------------
+### columns
+###
+### Stores PESv6 designs as tables of NumPy columns, for jobs that query many designs at
+### once, and loads them back into designs that put writes exactly as the originals. The
+### stitches of the PEC layers and the coordinates of the CSewSeg blocks get a row each;
+### threads, objects, PECs and the designs themselves get a row each with a column for
+### each of their attributes. Designs are written either together to an .npz file, or
+### appended one at a time to a catalog: a directory with a raw file for each column,
+### which can be memory-mapped as one dataset however many designs it holds. Run as a
+### script, writes the files given to an .npz file, or appends them to a catalog.
+###---------------------------------------------------------------------------------------------
+
+import json
+import numpy as np
+from sys        import argv, exit, stderr
+from os         import environ, makedirs
+from os.path    import basename, join, exists
+from argparse   import ArgumentParser, RawDescriptionHelpFormatter
+from pec        import PEC, Bitmap, Cmd
+from pesv6      import PESv6, PES_Object, RawObject, CSewSeg, Thread, OBJECT_TYPES
+from buffered_file import BufferedFileWriter
+from stitches   import layer_arrays
+from normalize  import COMMANDS
+from validate   import expand_paths
+
+description = "Writes .pes files as tables of columns to an .npz file or a catalog."
+
+## The attributes kept in tables of their own, or not kept at all.
+DESIGN_SKIP = {'source', 'anomalies', 'threads', 'objects', 'pecs',
+               'section_thumbnails', 'section_rgbs'}
+OBJECT_SKIP = {'blocks', 'colors'}
+PEC_SKIP = {'source', 'layers', 'thumbnails', 'thread_bitmaps', 'rgbs', 'threads',
+            'read_colors'}
+
+## PEC thread bitmaps have this many rows of 6-byte scanlines, with one for each layer.
+THREAD_BITMAP_ROWS = 24
+THREAD_BITMAP_WIDTH = 6
+
+## The tables of columns whose types are fixed, with their dtypes. The other tables
+## have a column for each attribute of the things they hold, typed by its values.
+FIXED = {
+    'designs':      {},
+    'threads':      {'design': 'i4'},
+    'objects':      {'design': 'i4'},
+    'blocks':       {'design': 'i4', 'object': 'i4', 'stitch_type': 'i4',
+                     'thread_index': 'i4', 'n_coordinates': 'i4'},
+    'coordinates':  {'design': 'i4', 'object': 'i4', 'block': 'i4', 'y': 'i2', 'x': 'i2'},
+    'colors':       {'design': 'i4', 'object': 'i4', 'block_index': 'i4',
+                     'thread_index': 'i4'},
+    'pecs':         {'design': 'i4'},
+    'layers':       {'design': 'i4', 'pec': 'i4', 'layer': 'i4', 'n_moves': 'i4',
+                     'end_cmd': 'u1', 'end_arg': 'i4', 'thread_type': 'i4',
+                     'thread_code': 'i4'},
+    'stitches':     {'design': 'i4', 'pec': 'i4', 'layer': 'i4', 'cmd': 'u1', 'dx': 'i4',
+                     'dy': 'i4', 'x': 'i4', 'y': 'i4'},
+    'thumbnails':   {'design': 'i4', 'pec': 'i4'},
+    'rgbs':         {'design': 'i4', 'pec': 'i4', 'r': 'u1', 'g': 'u1', 'b': 'u1'},
+    'sections':     {'design': 'i4', 'r': 'u1', 'g': 'u1', 'b': 'u1'}}
+
+OBJECT_CLASSES = {cls.__name__: cls for cls in (RawObject, *OBJECT_TYPES.values())}
+
+
+## Attribute columns
+##
+## The kind of an attribute column is 'bool', 'int', 'float', 'str' or 'bytes', or a
+## list: ['ints', n] or ['floats', n] for tuples of n numbers, ['bitmap', stride,
+## height] for Bitmaps. Strings, bytes and bitmaps are stored as the concatenation of
+## their bytes, in a uint8 column, with the offset each ends at in a '.ends' column.
+## Every attribute column has a '.present' column, false in the rows of things that
+## lack the attribute, which hold a default value.
+
+def kind_of(value):
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, int):
+        return 'int'
+    if isinstance(value, float):
+        return 'float'
+    if isinstance(value, str):
+        return 'str'
+    if isinstance(value, (bytes, bytearray)):
+        return 'bytes'
+    if isinstance(value, Bitmap):
+        return ['bitmap', value.stride, value.height]
+    if isinstance(value, tuple):
+        if all(isinstance(v, int) and not isinstance(v, bool) for v in value):
+            return ['ints', len(value)]
+        if all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in value):
+            return ['floats', len(value)]
+    raise TypeError('cannot store a {:s} in a column'.format(type(value).__name__))
+
+
+def variable(kind):
+    return kind in ('str', 'bytes') or kind[0] == 'bitmap'
+
+
+def encode_values(kind, values):
+
+    """Returns the arrays of an attribute column of kind holding values, where None
+    stands for a missing value, as a dictionary keyed by the suffix of their names."""
+
+    present = np.array([value is not None for value in values], dtype=bool)
+    if variable(kind):
+        blobs = [b'' if value is None else
+                 value.encode('utf-8', 'surrogatepass') if kind == 'str' else
+                 bytes(value) for value in values]
+        return {'': np.frombuffer(b''.join(blobs), dtype=np.uint8),
+                '.ends': np.cumsum([len(blob) for blob in blobs], dtype=np.int64),
+                '.present': present}
+    if kind in ('bool', 'int', 'float'):
+        dtype = {'bool': bool, 'int': np.int64, 'float': np.float64}[kind]
+        default = dtype(0)
+        return {'': np.array([default if value is None else value for value in values],
+                             dtype=dtype),
+                '.present': present}
+    dtype = np.int64 if kind[0] == 'ints' else np.float64
+    default = (0,)*kind[1]
+    return {'': np.array([default if value is None else value for value in values],
+                         dtype=dtype).reshape(-1, kind[1]),
+            '.present': present}
+
+
+def decode_value(kind, arrays, i):
+    ## The value in row i of an attribute column, or None if missing.
+    if not arrays['.present'][i]:
+        return None
+    if variable(kind):
+        ends = arrays['.ends']
+        data = bytes(arrays[''][(ends[i-1] if i else 0):ends[i]])
+        if kind == 'str':
+            return data.decode('utf-8', 'surrogatepass')
+        if kind == 'bytes':
+            return data
+        return Bitmap(data, kind[1], kind[2])
+    value = arrays[''][i]
+    if kind == 'bool':
+        return bool(value)
+    if kind in ('int', 'float'):
+        return value.item()
+    return tuple(value.tolist())
+
+
+def attributes(thing, skip=()):
+    return {name: value for name, value in vars(thing).items() if name not in skip}
+
+
+## Splitting designs into tables
+
+def design_tables(design):
+
+    """Returns the tables of design: for each, a pair of a dictionary of its fixed
+    columns as arrays, and a list of the attribute dictionaries of its rows, or None.
+    The design column is left at 0."""
+
+    tables = {}
+    def table(name, rows=None, /, **columns):
+        fixed = {column: np.asarray(columns.get(column, np.zeros(0)), dtype=dtype)
+                 for column, dtype in FIXED[name].items()}
+        if 'design' in fixed and rows is not None:
+            fixed['design'] = np.zeros(len(rows), dtype=FIXED[name]['design'])
+        tables[name] = (fixed, rows)
+
+    table('designs', [attributes(design, DESIGN_SKIP)])
+    table('threads', [attributes(thread) for thread in design.threads])
+    table('objects', [dict(attributes(obj, OBJECT_SKIP), type=type(obj).__name__)
+                      for obj in design.objects])
+
+    sewsegs = [(o, obj) for o, obj in enumerate(design.objects) if isinstance(obj, CSewSeg)]
+    blocks = [(o, b, block) for o, obj in sewsegs for b, block in enumerate(obj.blocks)]
+    coordinates = [np.asarray(block[2], dtype=np.int16).reshape(-1, 2)
+                   for o, b, block in blocks] or [np.zeros((0, 2), dtype=np.int16)]
+    counts = [len(c) for c in coordinates] if blocks else []
+    coordinates = np.concatenate(coordinates)
+    table('blocks',
+          design=np.zeros(len(blocks)),
+          object=[o for o, b, block in blocks],
+          stitch_type=[block[0] for o, b, block in blocks],
+          thread_index=[block[1] for o, b, block in blocks],
+          n_coordinates=counts)
+    table('coordinates',
+          design=np.zeros(len(coordinates)),
+          object=np.repeat([o for o, b, block in blocks], counts),
+          block=np.repeat([b for o, b, block in blocks], counts),
+          y=coordinates[:,0], x=coordinates[:,1])
+    colors = [(o, color) for o, obj in sewsegs for color in obj.colors]
+    table('colors',
+          design=np.zeros(len(colors)),
+          object=[o for o, color in colors],
+          block_index=[color[0] for o, color in colors],
+          thread_index=[color[1] for o, color in colors])
+
+    pecs = []
+    layers = []
+    stitches = []
+    thumbnails = []
+    rgbs = []
+    for p, pec in enumerate(design.pecs):
+        bitmaps = b''.join(scanline.to_bytes(THREAD_BITMAP_WIDTH, 'little')
+                           for row in pec.thread_bitmaps for scanline in row)
+        pecs.append(dict(attributes(pec, PEC_SKIP), thread_bitmaps=bitmaps))
+        for i, layer in enumerate(pec.layers):
+            cmd, dx, dy = layer_arrays(layer)
+            end_cmd, end_args = layer[-1] if len(layer) > len(cmd) else (Cmd.STOP, [])
+            thread_type, thread_code = pec.threads[i]
+            layers.append((p, i, len(cmd), end_cmd, end_args[0] if end_args else 0,
+                           thread_type, thread_code))
+            stitches.append((np.full(len(cmd), p), np.full(len(cmd), i), cmd, dx, dy))
+        thumbnails += [(p, b''.join(scanline.to_bytes(pec.thumb_w, 'little')
+                                    for scanline in thumbnail))
+                       for thumbnail in pec.thumbnails]
+        rgbs += [(p, *rgb) for rgb in pec.rgbs]
+
+    table('pecs', pecs)
+    table('layers', design=np.zeros(len(layers)),
+          **dict(zip(('pec', 'layer', 'n_moves', 'end_cmd', 'end_arg', 'thread_type',
+                      'thread_code'), np.array(layers, dtype=np.int64).reshape(-1, 7).T)))
+    if stitches:
+        p, i, cmd, dx, dy = (np.concatenate(a) for a in zip(*stitches))
+    else:
+        p = i = cmd = dx = dy = np.zeros(0, dtype=np.int32)
+    ## Absolute positions start again from 0 at the start of each PEC.
+    x, y = np.cumsum(dx, dtype=np.int64), np.cumsum(dy, dtype=np.int64)
+    starts = np.searchsorted(p, p)
+    x -= np.append(0, x)[starts]
+    y -= np.append(0, y)[starts]
+    table('stitches', design=np.zeros(len(cmd)), pec=p, layer=i, cmd=cmd, dx=dx, dy=dy,
+          x=x, y=y)
+    table('thumbnails', [dict(data=data) for p, data in thumbnails],
+          pec=[p for p, data in thumbnails])
+    table('rgbs', design=np.zeros(len(rgbs)),
+          **dict(zip(('pec', 'r', 'g', 'b'), np.array(rgbs, dtype=np.int64).reshape(-1, 4).T)))
+
+    sections = list(zip(getattr(design, 'section_thumbnails', []),
+                        getattr(design, 'section_rgbs', [])))
+    table('sections', [dict(thumbnail=thumbnail) for thumbnail, rgb in sections],
+          **dict(zip(('r', 'g', 'b'), np.array([rgb for thumbnail, rgb in sections],
+                                               dtype=np.int64).reshape(-1, 3).T)))
+    return tables
+
+
+def update_schema(schema, name, rows):
+
+    """Adds the kinds of the attribute columns of rows to schema, a dictionary of the
+    kind of each attribute column of each table. Raises TypeError if an attribute has
+    a different kind than before, except that tuples of ints may go in a column of
+    tuples of floats."""
+
+    if rows is None:
+        return
+    kinds = schema.setdefault(name, {})
+    for row in rows:
+        for column, value in row.items():
+            kind = kind_of(value)
+            if kinds.setdefault(column, kind) == kind:
+                continue
+            if kind[0] == 'ints' and kinds[column] == ['floats', kind[1]]:
+                continue
+            if kind[0] == 'floats' and kinds[column] == ['ints', kind[1]]:
+                kinds[column] = kind
+                continue
+            raise TypeError('{:s}.{:s} is {} in one row and {} in another'
+                            .format(name, column, kinds[column], kind))
+
+
+def table_arrays(schema, name, fixed, rows, /, design=0):
+
+    """Returns the arrays of a table of one design, keyed by '<table>.<column>' and
+    suffix, with the design column set to design. Every attribute column in schema is
+    included, with missing values where the rows lack it."""
+
+    arrays = {}
+    for column, values in fixed.items():
+        if column == 'design':
+            values = np.full(len(values), design, dtype=values.dtype)
+        arrays['{:s}.{:s}'.format(name, column)] = values
+    if rows is None:
+        return arrays
+    for column, kind in schema.get(name, {}).items():
+        for suffix, values in encode_values(kind, [row.get(column) for row in rows]).items():
+            arrays['{:s}.{:s}{:s}'.format(name, column, suffix)] = values
+    return arrays
+
+
+def shift_ends(arrays, lengths):
+
+    """Returns arrays to be appended to columns of the given lengths, with the ends of
+    variable columns moved past the data already there, and adds their lengths."""
+
+    shifted = {key: values+lengths.get(key[:-len('.ends')], 0) if key.endswith('.ends')
+               else values for key, values in arrays.items()}
+    for key, values in arrays.items():
+        lengths[key] = lengths.get(key, 0)+len(values)
+    return shifted
+
+
+## Rebuilding designs from tables
+
+class View:
+
+    ## The rows of one design in every table of a set of arrays, which may be
+    ## memory-mapped. The rows of each table are sorted by design, so those of one
+    ## design are found with a binary search.
+
+    def __init__(self, arrays, schema, design):
+        self.arrays = arrays
+        self.schema = schema
+        self.ranges = {}
+        for name in FIXED:
+            if name == 'designs':
+                self.ranges[name] = (design, design+1)
+            else:
+                column = arrays['{:s}.design'.format(name)]
+                self.ranges[name] = tuple(np.searchsorted(column, (design, design+1)).tolist())
+
+    def column(self, name, column):
+        start, end = self.ranges[name]
+        return np.asarray(self.arrays['{:s}.{:s}'.format(name, column)][start:end])
+
+    def rows(self, name):
+        ## The attribute dictionaries of the rows, without the missing attributes.
+        start, end = self.ranges[name]
+        columns = []
+        for column, kind in self.schema.get(name, {}).items():
+            key = '{:s}.{:s}'.format(name, column)
+            arrays = {suffix: self.arrays[key+suffix]
+                      for suffix in ('', '.ends', '.present') if key+suffix in self.arrays}
+            columns.append((column, kind, arrays))
+        rows = []
+        for i in range(start, end):
+            row = {}
+            for column, kind, arrays in columns:
+                if (value := decode_value(kind, arrays, i)) is not None:
+                    row[column] = value
+            rows.append(row)
+        return rows
+
+
+def design_from(view):
+
+    """Returns the PESv6 design whose rows view holds."""
+
+    design = PESv6()
+    vars(design).update(view.rows('designs')[0])
+
+    design.threads = []
+    for row in view.rows('threads'):
+        thread = Thread()
+        vars(thread).update(row)
+        design.threads.append(thread)
+
+    design.objects = []
+    for row in view.rows('objects'):
+        obj = PES_Object()
+        obj.__class__ = OBJECT_CLASSES[row.pop('type')]
+        vars(obj).update(row)
+        design.objects.append(obj)
+    for obj in design.objects:
+        if isinstance(obj, CSewSeg):
+            obj.blocks = []
+            obj.colors = []
+
+    y, x = view.column('coordinates', 'y').tolist(), view.column('coordinates', 'x').tolist()
+    coordinates = list(zip(y, x))
+    start = 0
+    for o, stitch_type, thread_index, n in zip(
+            *(view.column('blocks', column).tolist()
+              for column in ('object', 'stitch_type', 'thread_index', 'n_coordinates'))):
+        design.objects[o].blocks.append((stitch_type, thread_index,
+                                         coordinates[start:start+n]))
+        start += n
+    for o, block_index, thread_index in zip(
+            *(view.column('colors', column).tolist()
+              for column in ('object', 'block_index', 'thread_index'))):
+        design.objects[o].colors.append((block_index, thread_index))
+
+    design.pecs = []
+    for row in view.rows('pecs'):
+        pec = PEC()
+        bitmaps = row.pop('thread_bitmaps')
+        vars(pec).update(row)
+        scanlines = [int.from_bytes(bitmaps[i:i+THREAD_BITMAP_WIDTH], 'little')
+                     for i in range(0, len(bitmaps), THREAD_BITMAP_WIDTH)]
+        width = len(scanlines)//THREAD_BITMAP_ROWS
+        pec.thread_bitmaps = [scanlines[i:i+width]
+                              for i in range(0, len(scanlines), width or 1)]
+        pec.layers, pec.threads, pec.thumbnails, pec.rgbs = [], [], [], []
+        design.pecs.append(pec)
+
+    moves = [(COMMANDS[c], [dx, dy]) for c, dx, dy in
+             zip(*(view.column('stitches', column).tolist() for column in ('cmd', 'dx', 'dy')))]
+    start = 0
+    for p, n, end_cmd, end_arg, thread_type, thread_code in zip(
+            *(view.column('layers', column).tolist()
+              for column in ('pec', 'n_moves', 'end_cmd', 'end_arg', 'thread_type',
+                             'thread_code'))):
+        end = (Cmd.COLOR, [end_arg]) if end_cmd == Cmd.COLOR else (Cmd(end_cmd), [])
+        design.pecs[p].layers.append(moves[start:start+n]+[end])
+        design.pecs[p].threads.append((thread_type, thread_code))
+        start += n
+    for p, row in zip(view.column('thumbnails', 'pec').tolist(), view.rows('thumbnails')):
+        pec = design.pecs[p]
+        data = row['data']
+        pec.thumbnails.append([int.from_bytes(data[i:i+pec.thumb_w], 'little')
+                               for i in range(0, len(data), pec.thumb_w)])
+    for p, r, g, b in zip(*(view.column('rgbs', column).tolist()
+                            for column in ('pec', 'r', 'g', 'b'))):
+        design.pecs[p].rgbs.append((r, g, b))
+
+    if 'full_thumbnail' in vars(design):
+        design.section_thumbnails = [row['thumbnail'] for row in view.rows('sections')]
+        design.section_rgbs = list(zip(*(view.column('sections', column).tolist()
+                                         for column in ('r', 'g', 'b'))))
+    return design
+
+
+## .npz files
+
+def export(designs, path):
+
+    """Writes the tables of designs to an .npz file at path, under the name given."""
+
+    schema = {}
+    tables = [design_tables(design) for design in designs]
+    for design in tables:
+        for name, (fixed, rows) in design.items():
+            update_schema(schema, name, rows)
+    chunks = {}
+    lengths = {}
+    for i, design in enumerate(tables):
+        for name, (fixed, rows) in design.items():
+            arrays = shift_ends(table_arrays(schema, name, fixed, rows, design=i), lengths)
+            for key, values in arrays.items():
+                chunks.setdefault(key, []).append(values)
+    with open(path, 'wb') as file:
+        np.savez(file, schema=np.array(json.dumps(dict(kinds=schema, n_designs=len(designs)))),
+                 **{key: np.concatenate(values) for key, values in chunks.items()})
+
+
+def load(path, /, design=0):
+
+    """Returns the design with the given index from the .npz file at path."""
+
+    with np.load(path) as data:
+        schema = json.loads(str(data['schema']))
+        arrays = {key: data[key] for key in data.files if key != 'schema'}
+    return design_from(View(arrays, schema['kinds'], design))
+
+
+def load_all(path):
+
+    """Returns all designs in the .npz file at path."""
+
+    with np.load(path) as data:
+        schema = json.loads(str(data['schema']))
+        arrays = {key: data[key] for key in data.files if key != 'schema'}
+    return [design_from(View(arrays, schema['kinds'], design))
+            for design in range(schema['n_designs'])]
+
+
+## Catalogs
+
+class Catalog:
+
+    ## A directory with a raw file for each column, '<table>.<column>.bin', and
+    ## 'schema.json', which gives the kinds of the attribute columns, the dtype,
+    ## trailing shape and length of every column, and the number of designs. Designs
+    ## are appended by appending to the files, then rewriting the schema; anything a
+    ## failed append left past the recorded lengths is cut off by the next one.
+
+    SCHEMA = 'schema.json'
+
+    def __init__(self, path):
+        self.path = path
+        makedirs(path, exist_ok=True)
+        if exists(join(path, self.SCHEMA)):
+            with open(join(path, self.SCHEMA)) as file:
+                schema = json.load(file)
+        else:
+            schema = dict(kinds={}, columns={}, n_designs=0)
+        self.kinds = schema['kinds']
+        self.columns = schema['columns']    # key -> [dtype, trailing shape, length]
+        self.n_designs = schema['n_designs']
+
+    def __len__(self):
+        return self.n_designs
+
+    def file(self, key):
+        return join(self.path, key+'.bin')
+
+    def rows(self, name):
+        ## The number of rows in a table.
+        if name == 'designs':
+            return self.n_designs
+        return self.columns.get('{:s}.design'.format(name), (None, None, 0))[2]
+
+    def append(self, design):
+
+        """Appends design to the catalog. Returns its index."""
+
+        tables = design_tables(design)
+        kinds = json.loads(json.dumps(self.kinds))
+        for name, (fixed, rows) in tables.items():
+            update_schema(kinds, name, rows)
+        for name, columns in self.kinds.items():
+            for column, kind in columns.items():
+                if kinds[name][column] != kind:
+                    raise TypeError('{:s}.{:s} is {} in the catalog and {} in the design'
+                                    .format(name, column, kind, kinds[name][column]))
+
+        lengths = {key: length for key, (dtype, shape, length) in self.columns.items()}
+        chunks = {}
+        def add(arrays):
+            for key, values in shift_ends(arrays, lengths).items():
+                chunks.setdefault(key, []).append(values)
+
+        ## Columns new to the catalog are filled in for the designs before.
+        for name, columns in kinds.items():
+            for column, kind in columns.items():
+                if column not in self.kinds.get(name, {}):
+                    add({'{:s}.{:s}{:s}'.format(name, column, suffix): values for
+                         suffix, values in encode_values(kind, [None]*self.rows(name)).items()})
+        for name, (fixed, rows) in tables.items():
+            add(table_arrays(kinds, name, fixed, rows, design=self.n_designs))
+
+        for key, values in chunks.items():
+            values = np.concatenate(values)
+            dtype, shape, length = self.columns.get(key, (values.dtype.str,
+                                                          list(values.shape[1:]), 0))
+            with open(self.file(key), 'ab') as file:
+                file.truncate(length*np.dtype(dtype).itemsize*int(np.prod(shape)))
+                file.write(values.astype(dtype).tobytes())
+            self.columns[key] = [dtype, shape, length+len(values)]
+
+        self.kinds = kinds
+        self.n_designs += 1
+        with BufferedFileWriter(join(self.path, self.SCHEMA)) as file:
+            file.put_data(json.dumps(dict(kinds=self.kinds, columns=self.columns,
+                                          n_designs=self.n_designs)).encode())
+        return self.n_designs-1
+
+    def arrays(self):
+
+        """Returns every column memory-mapped, keyed by '<table>.<column>' and
+        suffix."""
+
+        arrays = {}
+        for key, (dtype, shape, length) in self.columns.items():
+            if length == 0:
+                arrays[key] = np.zeros((0, *shape), dtype=dtype)
+            else:
+                arrays[key] = np.memmap(self.file(key), dtype=dtype, mode='r',
+                                        shape=(length, *shape))
+        return arrays
+
+    def load(self, design, /, arrays=None):
+
+        """Returns the design with the given index. Pass arrays from the arrays method
+        when loading many, to map the files only once."""
+
+        return design_from(View(arrays or self.arrays(), self.kinds, design))
+
+
+def main():
+
+    if (script := environ.get('RUNPYTHON')):
+        command = basename(script)
+    else:
+        command = 'python3 {}'.format(argv[0])
+
+    parser = ArgumentParser(prog=command, description=description,
+                            allow_abbrev=False,
+                            formatter_class=RawDescriptionHelpFormatter)
+
+    parser.add_argument('paths', metavar='path', type=str, nargs='+',
+                        help="pathname of a file, or of a directory to search for .pes files")
+
+    output = parser.add_mutually_exclusive_group(required=True)
+
+    output.add_argument('-o', '--output',
+                        dest='output',
+                        type=str,
+                        help="pathname of the .npz file to write")
+
+    output.add_argument('-c', '--catalog',
+                        dest='catalog',
+                        type=str,
+                        help="pathname of the catalog directory to append the files to")
+
+    parser.set_defaults(output=None, catalog=None)
+
+    args = parser.parse_args()
+
+    catalog = Catalog(args.catalog) if args.catalog else None
+    designs = []
+    n_errors = 0
+    for path in expand_paths(args.paths):
+        try:
+            design = PESv6().get(path)
+            if catalog is not None:
+                catalog.append(design)
+            else:
+                designs.append(design)
+        except Exception as e:
+            print('{:s}: {:s}: {}'.format(path, type(e).__name__, e), file=stderr)
+            n_errors += 1
+
+    if args.output:
+        export(designs, args.output)
+
+    exit(1 if n_errors else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+###---------------------------------------------------------------------------------------------
+### compose
+###
+### Merges several PESv6 designs into one, e.g. a base design with per-order name
+### patches, or many designs laid out on one sheet.
+###---------------------------------------------------------------------------------------------
+
+import copy
+import numpy as np
+from pec        import Cmd
+from pesv6      import CSewSeg
+from stitches   import UNITS_PER_MM, pec_arrays, absolute, split_move, layer_spans
+
+## Index tables are padded with spaces.
+INDEX_PADDING = 0x20
+
+
+def thread_key(thread):
+    return thread.brand, thread.code, bytes(thread.rgbx[:3])
+
+
+class Placement:
+
+    ## What merging needs to know about the single PEC of a design: where each of its
+    ## layers starts and ends and the extent they cover, relative to the design's
+    ## origin. Computed once per distinct design, however many times it is placed.
+
+    def __init__(self, design):
+        if design.n_pecs != 1 or len(design.pecs) != 1:
+            raise ValueError('only single-hoop designs can be merged')
+        self.pec = design.pecs[0]
+        self.spans = layer_spans(self.pec)
+        layer, cmd, dx, dy = pec_arrays(self.pec)
+        x, y = absolute(dx, dy)
+        x = np.append(x, 0)
+        y = np.append(y, 0)
+        self.extent = (int(x.min()), int(y.min()), int(x.max()), int(y.max()))
+
+
+def merge_threads(designs):
+
+    """Returns the thread table with duplicates by (brand, code, rgb) removed, and for
+    each design an array mapping its thread indexes to indexes in that table."""
+
+    threads = []
+    indexes = {}
+    mappings = []
+    for design in designs:
+        mapping = []
+        for thread in design.threads:
+            if (key := thread_key(thread)) not in indexes:
+                indexes[key] = len(threads)
+                threads.append(thread)
+            mapping.append(indexes[key])
+        mappings.append(np.array(mapping, dtype=np.int32))
+    return threads, mappings
+
+
+def merge_object(obj, mapping, offset):
+
+    ## Copies obj with its thread indexes remapped and its coordinates translated.
+    ## CSewSeg coordinates are (y, x) pairs.
+    merged = copy.copy(obj)
+    if not isinstance(obj, CSewSeg):
+        return merged
+    x, y = offset
+    delta = np.array((y, x), dtype=np.int32)
+    merged.blocks = [(stitch_type, int(mapping[thread_index]),
+                      (np.asarray(coordinates, dtype=np.int32).reshape(-1, 2)+delta)
+                      .astype(np.int16))
+                     for stitch_type, thread_index, coordinates in obj.blocks]
+    merged.colors = [(block_index, int(mapping[thread_index]))
+                     for block_index, thread_index in obj.colors]
+    merged.extents1 = tuple(v+d for v, d in zip(obj.extents1, (x, y, x, y)))
+    merged.extents2 = tuple(v+d for v, d in zip(obj.extents2, (x, y, x, y)))
+    return merged
+
+
+def or_bitmaps(a, b):
+    return [p | q for p, q in zip(a, b)]
+
+
+def join_layers(base, pieces, /, thumbnail=None):
+
+    """Returns a copy of base with the layers given by pieces, a list of (pec, i, start,
+    end) tuples for layer i of pec, which starts and ends at the given (x, y)
+    positions. The moves of a layer are relative, so they are reused as they are,
+    preceded by a trim and jumps where the layer does not start where the previous
+    one ended. Adjacent layers sewn with the same color are combined, which saves a
+    color change. The indexes, colors, thread specifications, thread bitmaps and
+    layer thumbnails are rebuilt to match. The main thumbnail is thumbnail, by
+    default that of base."""
+
+    layers = []         # [moves, rgb, spec, thumbnail, bitmap column]
+    x = y = 0
+    for pec, i, (sx, sy), end in pieces:
+        moves = pec.layers[i][:-1]
+        if (sx, sy) != (x, y):
+            moves = split_move(Cmd.JUMP, sx-x, sy-y)+moves
+            moves[0] = (Cmd.TRIM, moves[0][1])
+        rgb = pec.layer_rgb(i)
+        bitmap = [row[i] for row in pec.thread_bitmaps]
+        if layers and layers[-1][1] == rgb:
+            layers[-1][0].extend(moves)
+            layers[-1][3] = or_bitmaps(layers[-1][3], pec.thumbnails[i+1])
+        else:
+            layers.append([moves, rgb, pec.threads[i], pec.thumbnails[i+1], bitmap])
+        x, y = end
+
+    joined = copy.copy(base)
+
+    ## The byte after a color change alternates between 1 and 2.
+    color = next((args[0] for layer in base.layers for cmd, args in layer
+                  if cmd == Cmd.COLOR), 2)
+    joined.layers = []
+    for i, (moves, *rest) in enumerate(layers):
+        if i < len(layers)-1:
+            joined.layers.append(moves+[(Cmd.COLOR, [color])])
+            color = 3-color
+        else:
+            joined.layers.append(moves+[(Cmd.STOP, [])])
+
+    rgbs = []
+    for moves, rgb, *rest in layers:
+        if rgb not in rgbs:
+            rgbs.append(rgb)
+    indexes = bytes(rgbs.index(rgb) for moves, rgb, *rest in layers)
+    joined.rgbs = rgbs
+    joined.indexes = indexes.ljust(len(base.indexes), bytes((INDEX_PADDING,)))
+    joined.redundant_indexes = indexes.ljust(len(base.redundant_indexes),
+                                             bytes((INDEX_PADDING,)))
+    joined.threads = [spec for moves, rgb, spec, *rest in layers]
+    joined.thread_bitmaps = [list(row) for row in zip(*(bitmap for *rest, bitmap in layers))]
+    joined.thumbnails = [base.thumbnails[0] if thumbnail is None else thumbnail]+[
+        layer[3] for layer in layers]
+    joined.n_layers = len(joined.layers)
+    joined.n_changes = joined.n_layers-1
+    return joined
+
+
+def merge_pecs(placements, offsets):
+
+    """Concatenates the stitches of the placed PECs into a new PEC."""
+
+    pieces = [(placement.pec, i, (ox+start[0], oy+start[1]), (ox+end[0], oy+end[1]))
+              for placement, (ox, oy) in zip(placements, offsets)
+              for i, (start, end) in enumerate(placement.spans)]
+    thumbnail = placements[0].pec.thumbnails[0]
+    for placement in placements[1:]:
+        thumbnail = or_bitmaps(thumbnail, placement.pec.thumbnails[0])
+    merged = join_layers(placements[0].pec, pieces, thumbnail=thumbnail)
+
+    ## Regenerate the extent of the whole design.
+    extents = np.array([(ox+p.extent[0], oy+p.extent[1], ox+p.extent[2], oy+p.extent[3])
+                        for p, (ox, oy) in zip(placements, offsets)])
+    merged.width = int(extents[:,2].max()-extents[:,0].min())
+    merged.height = int(extents[:,3].max()-extents[:,1].min())
+    return merged
+
+
+def merge(designs, /, offsets=None):
+
+    """Merges single-hoop designs into a new design that sews them one after another.
+    offsets gives the (x, y) position of each design's origin, in tenths of a
+    millimeter; by default all are at the origin. The header comes from the first
+    design. The thread table is merged with duplicates removed, and the thread
+    indexes of the objects are remapped to it."""
+
+    if offsets is None:
+        offsets = [(0, 0)]*len(designs)
+    if len(offsets) != len(designs):
+        raise ValueError('need one offset per design')
+
+    ## Placing the same design many times only analyses it once.
+    placements = {}
+    for design in designs:
+        if id(design) not in placements:
+            placements[id(design)] = Placement(design)
+    placements = [placements[id(design)] for design in designs]
+
+    threads, mappings = merge_threads(designs)
+
+    merged = copy.copy(designs[0])
+    merged.threads = threads
+    merged.objects = [merge_object(obj, mapping, offset)
+                      for design, mapping, offset in zip(designs, mappings, offsets)
+                      for obj in design.objects]
+    merged.pecs = [merge_pecs(placements, offsets)]
+    merged.n_pecs = 1
+    ## The header gives the size of the design in whole millimeters.
+    merged.design_width = -(-merged.pecs[0].width//UNITS_PER_MM)
+    merged.design_height = -(-merged.pecs[0].height//UNITS_PER_MM)
+    merged.n_section_thumbnails = 0
+    return merged
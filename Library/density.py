@@ -0,0 +1,265 @@
+###---------------------------------------------------------------------------------------------
+### density
+###
+### Finds where a design risks breaking thread: cells of a fine grid with too many needle
+### penetrations, cells sewn over by more than one layer of the same color, and stitches
+### shorter than a minimum length. The stitches of all layers of a PEC are rasterized
+### into the grid together. Run as a script, checks files as they are taken in, writes
+### the problems found as CSV and exits with status 1 if there were any, or if a file
+### could not be checked.
+###---------------------------------------------------------------------------------------------
+
+import csv
+import numpy as np
+from sys        import argv, exit, stdout, stderr
+from os         import environ
+from os.path    import basename, splitext, join
+from contextlib import nullcontext
+from argparse   import ArgumentParser, RawDescriptionHelpFormatter
+from pec        import Cmd
+from pesv6      import PESv6
+from stitches   import UNITS_PER_MM, pec_arrays, absolute
+from validate   import expand_paths
+
+description = "Reports dense regions, overlapping passes and short stitches in .pes files."
+
+## Grid cell size, in mm.
+DEFAULT_CELL = 1.0
+
+## Needle penetrations per square millimeter above which a cell is a hot spot.
+DEFAULT_MAX_DENSITY = 12.0
+
+## Stitches shorter than this many mm are reported.
+DEFAULT_MIN_LENGTH = 0.5
+
+## A PEC whose stitches spread wider or taller than this many mm, more than any hoop,
+## is not analysed, as its grid would take memory in proportion to the extent.
+MAX_EXTENT = 1000.0
+
+COLUMNS = ('path', 'kind', 'pec', 'layers', 'stitch', 'x_mm', 'y_mm', 'value')
+
+
+class Grid:
+
+    ## Maps positions in PEC units to the cells of a grid covering them. Positions
+    ## spread over more than max_extent in either direction raise a ValueError.
+
+    def __init__(self, x, y, cell, /, max_extent=MAX_EXTENT*UNITS_PER_MM):
+        self.cell = cell
+        self.x0 = int(x.min()) if len(x) else 0
+        self.y0 = int(y.min()) if len(y) else 0
+        width = int(x.max())-self.x0 if len(x) else 0
+        height = int(y.max())-self.y0 if len(y) else 0
+        if max(width, height) > max_extent:
+            raise ValueError('stitches span {:.0f} by {:.0f} mm, more than {:g} mm'
+                             .format(width/UNITS_PER_MM, height/UNITS_PER_MM,
+                                     max_extent/UNITS_PER_MM))
+        self.width = int(width//cell)+1
+        self.height = int(height//cell)+1
+
+    @property
+    def size(self):
+        return self.width*self.height
+
+    def index(self, x, y):
+        return ((y-self.y0)//self.cell).astype(np.int64)*self.width + \
+               ((x-self.x0)//self.cell).astype(np.int64)
+
+    def centre(self, index):
+        ## The (x, y) centre of cells, in mm.
+        row, column = np.divmod(index, self.width)
+        return ((self.x0+(column+0.5)*self.cell)/UNITS_PER_MM,
+                (self.y0+(row+0.5)*self.cell)/UNITS_PER_MM)
+
+
+def rasterize(x0, y0, x1, y1, cell):
+
+    """Samples the segments from (x0, y0) to (x1, y1) at intervals of at most half a
+    cell. Returns the index of the segment and the x and y of every sample."""
+
+    length = np.hypot(x1-x0, y1-y0)
+    n = np.maximum(1, np.ceil(2*length/cell)).astype(np.int64)
+    segment = np.repeat(np.arange(len(n)), n)
+    first = np.cumsum(n)-n
+    t = (np.arange(int(n.sum()))-first[segment]+0.5)/n[segment]
+    return (segment,
+            x0[segment]+t*(x1-x0)[segment],
+            y0[segment]+t*(y1-y0)[segment])
+
+
+def pec_density(pec, /, cell=DEFAULT_CELL, max_density=DEFAULT_MAX_DENSITY,
+                min_length=DEFAULT_MIN_LENGTH, max_extent=MAX_EXTENT):
+
+    """Analyses the stitches of pec. Returns a dictionary holding the grid, the needle
+    penetrations in each of its cells, and lists of hot spots, overlaps and short
+    stitches. Each list item is a dictionary of the cell or stitch position in mm,
+    the layers involved and a value: the penetrations per square millimeter, the
+    number of layers of one color, or the stitch length in mm. Raises a ValueError if
+    the stitches spread over more than max_extent mm."""
+
+    layer, cmd, dx, dy = pec_arrays(pec)
+    x, y = absolute(dx, dy)
+    stitch = np.flatnonzero(cmd == Cmd.STITCH)
+    x1, y1 = x[stitch], y[stitch]
+    x0, y0 = x1-dx[stitch], y1-dy[stitch]
+    stitch_layer = layer[stitch]
+
+    cell = cell*UNITS_PER_MM
+    grid = Grid(np.concatenate((x0, x1)), np.concatenate((y0, y1)), cell,
+                max_extent=max_extent*UNITS_PER_MM)
+    area = (cell/UNITS_PER_MM)**2
+
+    ## Hot spots: needle penetrations are the ends of the stitches.
+    n_layers = max(1, len(pec.layers))
+    penetrated = grid.index(x1, y1)
+    penetrations = np.bincount(penetrated, minlength=grid.size)
+    hot = np.flatnonzero(penetrations > max_density*area)
+    pairs = np.unique(penetrated*n_layers+stitch_layer)     # sorted by cell
+    bounds = np.searchsorted(pairs//n_layers, np.stack((hot, hot+1)))
+    hot_spots = [dict(x_mm=float(cx), y_mm=float(cy),
+                      layers=(pairs[start:end] % n_layers).tolist(),
+                      value=float(penetrations[index]/area))
+                 for index, cx, cy, start, end in zip(hot, *grid.centre(hot), *bounds)]
+
+    ## Overlaps: cells crossed by more than one layer of the same color. Only the
+    ## layers sewn in a color that another layer is also sewn in are rasterized.
+    colors = list(pec.indexes[:len(pec.layers)])
+    overlaps = []
+    for color in sorted(set(colors)):
+        if len(layers := [i for i, c in enumerate(colors) if c == color]) < 2:
+            continue
+        crossed = []
+        for i in layers:
+            mine = stitch_layer == i
+            segment, sx, sy = rasterize(x0[mine], y0[mine], x1[mine], y1[mine], cell)
+            crossed.append(np.zeros(grid.size, dtype=bool))
+            crossed[-1][grid.index(sx, sy)] = True
+        counts = np.sum(crossed, axis=0)
+        cells = np.flatnonzero(counts > 1)
+        by_layer = np.array([c[cells] for c in crossed])
+        for j, (index, cx, cy) in enumerate(zip(cells, *grid.centre(cells))):
+            overlaps.append(dict(x_mm=float(cx), y_mm=float(cy),
+                                 layers=[i for i, hit in zip(layers, by_layer[:,j]) if hit],
+                                 value=int(counts[index])))
+
+    ## Short stitches, with their index within their layer.
+    length = np.hypot(dx[stitch], dy[stitch])
+    first = np.searchsorted(layer, stitch_layer)
+    short_stitches = [dict(x_mm=float(x1[i])/UNITS_PER_MM, y_mm=float(y1[i])/UNITS_PER_MM,
+                           layers=[int(stitch_layer[i])], stitch=int(stitch[i]-first[i]),
+                           value=float(length[i])/UNITS_PER_MM)
+                      for i in np.flatnonzero(length < min_length*UNITS_PER_MM)]
+
+    return dict(grid=grid, penetrations=penetrations.reshape(grid.height, grid.width),
+                hot_spots=hot_spots, overlaps=overlaps, short_stitches=short_stitches)
+
+
+def write_heatmap(path, penetrations, /, scale=None):
+
+    """Writes the penetrations per cell as a binary PGM image, darker where denser.
+    Counts of scale and above are black; by default scale is the largest count."""
+
+    scale = scale or max(1, int(penetrations.max()))
+    pixels = 255-np.minimum(255, penetrations*255//scale).astype(np.uint8)
+    with open(path, 'wb') as file:
+        file.write('P5\n{:d} {:d}\n255\n'.format(pixels.shape[1], pixels.shape[0]).encode())
+        file.write(pixels[::-1].tobytes())     # PGM rows run top to bottom
+
+
+def write_csv(paths, ofile, /, cell=DEFAULT_CELL, max_density=DEFAULT_MAX_DENSITY,
+              min_length=DEFAULT_MIN_LENGTH, heatmaps=None):
+
+    """Checks every .pes file in paths, descending into directories, and streams the
+    problems found to ofile as CSV. With heatmaps set to a directory, writes a heatmap
+    of each PEC there. Files that cannot be read or analysed are reported to stderr.
+    Returns the number of problems and the number of such files."""
+
+    writer = csv.DictWriter(ofile, COLUMNS, lineterminator='\n')
+    writer.writeheader()
+    n_problems = n_failed = 0
+    for path in expand_paths(paths):
+        try:
+            design = PESv6().get(path)
+            results = [pec_density(pec, cell=cell, max_density=max_density,
+                                   min_length=min_length)
+                       for pec in design.pecs]
+        except Exception as e:
+            print('{:s}: {:s}: {}'.format(path, type(e).__name__, e), file=stderr)
+            n_failed += 1
+            continue
+        for p, result in enumerate(results):
+            for kind in ('hot_spots', 'overlaps', 'short_stitches'):
+                for row in result[kind]:
+                    writer.writerow(dict(path   = path,
+                                         kind   = kind,
+                                         pec    = p,
+                                         layers = ' '.join(map(str, row['layers'])),
+                                         stitch = row.get('stitch'),
+                                         x_mm   = '{:.1f}'.format(row['x_mm']),
+                                         y_mm   = '{:.1f}'.format(row['y_mm']),
+                                         value  = '{:.1f}'.format(row['value'])))
+                    n_problems += 1
+            if heatmaps is not None:
+                write_heatmap(join(heatmaps, '{:s}_{:d}.pgm'.format(
+                    splitext(basename(path))[0], p)), result['penetrations'])
+    return n_problems, n_failed
+
+
+def main():
+
+    if (script := environ.get('RUNPYTHON')):
+        command = basename(script)
+    else:
+        command = 'python3 {}'.format(argv[0])
+
+    parser = ArgumentParser(prog=command, description=description,
+                            allow_abbrev=False,
+                            formatter_class=RawDescriptionHelpFormatter)
+
+    parser.add_argument('paths', metavar='path', type=str, nargs='+',
+                        help="pathname of a file, or of a directory to search for .pes files")
+
+    parser.add_argument('-o', '--output',
+                        dest='output',
+                        type=str,
+                        help="pathname of the CSV file to write instead of stdout")
+
+    parser.add_argument('-c', '--cell',
+                        dest='cell',
+                        type=float,
+                        help="grid cell size in mm (default {:g})".format(DEFAULT_CELL))
+
+    parser.add_argument('-d', '--max-density',
+                        dest='max_density',
+                        type=float,
+                        help="penetrations per square mm above which a cell is a hot spot"
+                        " (default {:g})".format(DEFAULT_MAX_DENSITY))
+
+    parser.add_argument('-l', '--min-length',
+                        dest='min_length',
+                        type=float,
+                        help="length in mm below which a stitch is reported (default {:g})"
+                        .format(DEFAULT_MIN_LENGTH))
+
+    parser.add_argument('-m', '--heatmaps',
+                        dest='heatmaps',
+                        type=str,
+                        help="directory to write a .pgm heatmap of each PEC to")
+
+    parser.set_defaults(output=None, cell=DEFAULT_CELL, max_density=DEFAULT_MAX_DENSITY,
+                        min_length=DEFAULT_MIN_LENGTH, heatmaps=None)
+
+    args = parser.parse_args()
+
+    with (open(args.output, 'w', newline='') if args.output else
+          nullcontext(stdout)) as ofile:
+        n_problems, n_failed = write_csv(args.paths, ofile, cell=args.cell,
+                                         max_density=args.max_density,
+                                         min_length=args.min_length,
+                                         heatmaps=args.heatmaps)
+
+    exit(1 if n_problems or n_failed else 0)
+
+
+if __name__ == '__main__':
+    main()
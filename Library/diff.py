@@ -0,0 +1,350 @@
+###---------------------------------------------------------------------------------------------
+### diff
+###
+### Reports what changed between two versions of a design: header fields, threads,
+### objects and their CSewSeg blocks, PEC fields, layers and stitches. Every part is
+### compared by its encoded bytes first, so that identical parts are passed over in
+### linear time, and only the layers that differ are aligned stitch by stitch. Changes
+### are reported with their byte offsets in both files.
+###---------------------------------------------------------------------------------------------
+
+import numpy as np
+from sys        import argv, exit
+from os         import environ
+from os.path    import basename
+from difflib    import SequenceMatcher
+from argparse   import ArgumentParser, RawDescriptionHelpFormatter
+from pec        import Cmd, PEC_PROLOGUE
+from pesv6      import (PESv6, CSewSeg, PES_HEADER_PROLOGUE, PES_OBJECT_HEADER,
+                        CSEWSEG_BLOCK_HEADER, COORDINATE)
+from schema     import Record
+from stitches   import layer_arrays
+from template   import encode
+
+description = "Reports the differences between two .pes embroidery files."
+
+## The header prologue follows the 8-byte version.
+HEADER_START = 8
+
+
+class Change:
+
+    def __init__(self, kind, offset_a, offset_b, message):
+        self.kind = kind
+        self.offset_a = offset_a
+        self.offset_b = offset_b
+        self.message = message
+
+    def __repr__(self):
+        return '{:s}({!r:s}, {}, {}, {!r:s})'.format(
+            __class__.__name__, self.kind, self.offset_a, self.offset_b, self.message)
+
+    def __str__(self):
+        return '{:s} {:s} {:8s} {:s}'.format(
+            *('--------' if offset is None else '0x{:06X}'.format(offset)
+              for offset in (self.offset_a, self.offset_b)),
+            self.kind, self.message)
+
+
+def field_offsets(record, obj, start):
+    ## The offsets of the fields of record as written from obj at start. Fields after
+    ## a variable-width field have to be encoded to find where they fall.
+    offsets = {}
+    for field in record.fields:
+        offsets[field.name] = start
+        start += len(encode(Record(field).put, obj))
+    return offsets
+
+
+def align(a, b):
+
+    """Yields the opcodes of an alignment of sequences a and b, as SequenceMatcher
+    gives them, except for 'equal' ones. The common prefix and suffix are passed over
+    before aligning, so that a few changes in a long sequence are found quickly."""
+
+    n = min(len(a), len(b))
+    prefix = 0
+    while prefix < n and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < n-prefix and a[len(a)-1-suffix] == b[len(b)-1-suffix]:
+        suffix += 1
+    matcher = SequenceMatcher(None, a[prefix:len(a)-suffix], b[prefix:len(b)-suffix],
+                              autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != 'equal':
+            yield tag, prefix+i1, prefix+i2, prefix+j1, prefix+j2
+
+
+## Where two stitch arrays differ, the alignment is made in a window that starts with
+## WINDOW moves and doubles until a run of ANCHOR equal moves is found to resume at.
+WINDOW = 256
+ANCHOR = 8
+
+def align_arrays(a, b):
+
+    """Like align, for NumPy arrays, for long sequences with a few changes. The
+    equal runs between changes are found with vectorized comparisons, and only the
+    moves around each change are aligned with SequenceMatcher."""
+
+    i = j = 0
+    while i < len(a) and j < len(b):
+        n = min(len(a)-i, len(b)-j)
+        if len(unequal := np.flatnonzero(a[i:i+n] != b[j:j+n])) == 0:
+            i += n
+            j += n
+            break
+        i += int(unequal[0])
+        j += int(unequal[0])
+        window = WINDOW
+        while True:
+            wa, wb = a[i:i+window].tolist(), b[j:j+window].tolist()
+            matcher = SequenceMatcher(None, wa, wb, autojunk=False)
+            anchor = next((block for block in matcher.get_matching_blocks()
+                           if block.size >= ANCHOR), None)
+            if anchor or (i+window >= len(a) and j+window >= len(b)):
+                break
+            window *= 2
+        if anchor:
+            matcher = SequenceMatcher(None, wa[:anchor.a], wb[:anchor.b], autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag != 'equal':
+                yield tag, i+i1, i+i2, j+j1, j+j2
+        if not anchor:
+            return
+        i += anchor.a
+        j += anchor.b
+    if i < len(a):
+        yield 'delete', i, len(a), j, j
+    elif j < len(b):
+        yield 'insert', i, i, j, len(b)
+
+
+def describe(tag, i1, i2, j1, j2, what):
+    if tag == 'delete':
+        return '{:s} {:s} deleted'.format(what, span(i1, i2))
+    if tag == 'insert':
+        return '{:s} {:s} inserted'.format(what, span(j1, j2))
+    return '{:s} {:s} replaced by {:s}'.format(what, span(i1, i2), span(j1, j2))
+
+
+def span(i1, i2):
+    return '{:d}'.format(i1) if i2 == i1+1 else '{:d}-{:d}'.format(i1, i2-1)
+
+
+def offset_of(offsets, i):
+    return int(offsets[i]) if i < len(offsets) else None
+
+
+class Side:
+
+    ## One of the two designs, with the byte offsets of its parts.
+
+    def __init__(self, design):
+        if not design.source:
+            raise ValueError('designs to compare must be read with track=True')
+        self.design = design
+        self.source = design.source
+        self.header = field_offsets(PES_HEADER_PROLOGUE, design, HEADER_START)
+        ## The threads follow the transform, the three pattern counts and n_threads.
+        offset = self.header['transform']+6*4+3*2+2
+        self.thread_offsets = []
+        for thread in design.threads:
+            self.thread_offsets.append(offset)
+            offset += len(encode(thread.put))
+
+    def key(self, part, put):
+        ## The bytes part was read from, or its encoding if it has changed.
+        if (data := self.source.get(part)) is not None:
+            return bytes(data)
+        return encode(put)
+
+    def start(self, part):
+        return None if (span := self.source.span(part)) is None else span[0]
+
+    def block_offsets(self, obj):
+        offset = self.start(obj)
+        if offset is None:
+            return []
+        offset += PES_OBJECT_HEADER.size+2+len(obj.class_name)
+        offsets = []
+        for stitch_type, thread_index, coordinates in obj.blocks:
+            offsets.append(offset)
+            offset += CSEWSEG_BLOCK_HEADER.size+len(coordinates)*COORDINATE.size+2
+        return offsets
+
+    def stitch_offsets(self, layer, cmd, dx, dy):
+        if (offset := self.start(layer)) is None:
+            return []
+        short = cmd == Cmd.STITCH
+        size = (2-(short & (-64 <= dx) & (dx < 64))) + (2-(short & (-64 <= dy) & (dy < 64)))
+        return offset+np.concatenate(([0], np.cumsum(size)))
+
+
+def diff_fields(record, a, b, offsets_a, offsets_b, kind, /, prefix='', skip=()):
+    for field in record.fields:
+        if field.const is not None or field.name in skip:
+            continue
+        value_a, value_b = getattr(a, field.name), getattr(b, field.name)
+        if value_a != value_b:
+            yield Change(kind, offsets_a[field.name], offsets_b[field.name],
+                         '{:s}{:s}: {!r} -> {!r}'.format(prefix, field.name, value_a, value_b))
+
+
+def diff_blocks(a, b, obj_a, obj_b, where):
+    keys_a, keys_b = ([(stitch_type, thread_index,
+                        np.asarray(coordinates, dtype='<i2').tobytes())
+                       for stitch_type, thread_index, coordinates in obj.blocks]
+                      for obj in (obj_a, obj_b))
+    offsets_a, offsets_b = a.block_offsets(obj_a), b.block_offsets(obj_b)
+    for tag, i1, i2, j1, j2 in align(keys_a, keys_b):
+        yield Change('block', offset_of(offsets_a, i1), offset_of(offsets_b, j1),
+                     describe(tag, i1, i2, j1, j2, where+' block'))
+
+
+def diff_objects(a, b):
+    objects_a, objects_b = a.design.objects, b.design.objects
+    keys_a = [a.key(obj, obj.put) for obj in objects_a]
+    keys_b = [b.key(obj, obj.put) for obj in objects_b]
+    for tag, i1, i2, j1, j2 in align(keys_a, keys_b):
+        ## Objects replaced one for one by objects of the same type are compared
+        ## block by block.
+        if tag == 'replace' and i2-i1 == j2-j1:
+            for i, j in zip(range(i1, i2), range(j1, j2)):
+                obj_a, obj_b = objects_a[i], objects_b[j]
+                where = 'object {:d}'.format(i)
+                if type(obj_a) is not type(obj_b) or obj_a.class_name != obj_b.class_name:
+                    yield Change('object', a.start(obj_a), b.start(obj_b),
+                                 '{:s} {:s} replaced by {:s}'.format(
+                                     where, obj_a.class_name.decode(),
+                                     obj_b.class_name.decode()))
+                    continue
+                offsets_a = field_offsets(PES_OBJECT_HEADER, obj_a, a.start(obj_a) or 0)
+                offsets_b = field_offsets(PES_OBJECT_HEADER, obj_b, b.start(obj_b) or 0)
+                yield from diff_fields(PES_OBJECT_HEADER, obj_a, obj_b,
+                                       offsets_a, offsets_b, 'object', prefix=where+' ')
+                if isinstance(obj_a, CSewSeg):
+                    yield from diff_blocks(a, b, obj_a, obj_b, where)
+                    if obj_a.colors != obj_b.colors:
+                        yield Change('object', None, None, where+' color list changed')
+                elif obj_a.data != obj_b.data:
+                    yield Change('object', a.start(obj_a), b.start(obj_b),
+                                 where+' data changed')
+        else:
+            yield Change('object', offset_of([a.start(obj) for obj in objects_a], i1),
+                         offset_of([b.start(obj) for obj in objects_b], j1),
+                         describe(tag, i1, i2, j1, j2, 'object'))
+
+
+def diff_stitches(a, b, layer_a, layer_b, where):
+    (cmd_a, dx_a, dy_a), (cmd_b, dx_b, dy_b) = layer_arrays(layer_a), layer_arrays(layer_b)
+    offsets_a = a.stitch_offsets(layer_a, cmd_a, dx_a, dy_a)
+    offsets_b = b.stitch_offsets(layer_b, cmd_b, dx_b, dy_b)
+    ## Each move is packed into one integer, so that moves compare as scalars.
+    moves_a, moves_b = ((cmd.astype(np.int64)<<32) |
+                        ((dx.astype(np.int64) & 0xFFFF)<<16) | (dy.astype(np.int64) & 0xFFFF)
+                        for cmd, dx, dy in ((cmd_a, dx_a, dy_a), (cmd_b, dx_b, dy_b)))
+    for tag, i1, i2, j1, j2 in align_arrays(moves_a, moves_b):
+        yield Change('stitch', offset_of(offsets_a, i1), offset_of(offsets_b, j1),
+                     describe(tag, i1, i2, j1, j2, where+' stitch'))
+    if layer_a[-1] != layer_b[-1]:
+        yield Change('stitch', None, None, '{:s} ends with {} instead of {}'.format(
+            where, layer_b[-1], layer_a[-1]))
+
+
+def diff_pec(a, b, pec_a, pec_b, p):
+    where = 'PEC {:d}'.format(p)
+    start_a = a.start(pec_a.layers[0]) if pec_a.layers else None
+    start_b = b.start(pec_b.layers[0]) if pec_b.layers else None
+    if start_a is not None and start_b is not None:
+        fixed = {field.name: PEC_PROLOGUE.offset(field.name) for field in PEC_PROLOGUE.fields}
+        yield from diff_fields(PEC_PROLOGUE, pec_a, pec_b,
+                               {name: start_a-PEC_PROLOGUE.size+offset
+                                for name, offset in fixed.items()},
+                               {name: start_b-PEC_PROLOGUE.size+offset
+                                for name, offset in fixed.items()},
+                               'pec', prefix=where+' ', skip=('indexes',))
+
+    keys_a = [a.key(layer, lambda file, layer=layer: pec_a.put_layer(file, layer))
+              for layer in pec_a.layers]
+    keys_b = [b.key(layer, lambda file, layer=layer: pec_b.put_layer(file, layer))
+              for layer in pec_b.layers]
+    for tag, i1, i2, j1, j2 in align(keys_a, keys_b):
+        ## Layers replaced one for one are aligned stitch by stitch.
+        if tag == 'replace' and i2-i1 == j2-j1:
+            for i, j in zip(range(i1, i2), range(j1, j2)):
+                yield from diff_stitches(a, b, pec_a.layers[i], pec_b.layers[j],
+                                         '{:s} layer {:d}'.format(where, i))
+        else:
+            yield Change('layer', offset_of([a.start(layer) for layer in pec_a.layers], i1),
+                         offset_of([b.start(layer) for layer in pec_b.layers], j1),
+                         describe(tag, i1, i2, j1, j2, where+' layer'))
+
+    for i, (rgb_a, rgb_b) in enumerate(zip(pec_a.layer_rgbs(), pec_b.layer_rgbs())):
+        if rgb_a != rgb_b:
+            yield Change('color', None, None, '{:s} layer {:d} color {} -> {}'.format(
+                where, i, rgb_a, rgb_b))
+
+    for i, (thumbnail_a, thumbnail_b) in enumerate(zip(pec_a.thumbnails, pec_b.thumbnails)):
+        if thumbnail_a != thumbnail_b:
+            yield Change('bitmap', a.start(thumbnail_a), b.start(thumbnail_b),
+                         '{:s} thumbnail {:d} changed'.format(where, i))
+
+
+def diff(design_a, design_b):
+
+    """Yields the changes from design_a to design_b, both read with track=True."""
+
+    a, b = Side(design_a), Side(design_b)
+    yield from diff_fields(PES_HEADER_PROLOGUE, design_a, design_b, a.header, b.header,
+                           'header')
+
+    keys_a = [encode(thread.put) for thread in design_a.threads]
+    keys_b = [encode(thread.put) for thread in design_b.threads]
+    for tag, i1, i2, j1, j2 in align(keys_a, keys_b):
+        yield Change('thread', offset_of(a.thread_offsets, i1), offset_of(b.thread_offsets, j1),
+                     describe(tag, i1, i2, j1, j2, 'thread'))
+
+    yield from diff_objects(a, b)
+
+    for p, (pec_a, pec_b) in enumerate(zip(design_a.pecs, design_b.pecs)):
+        yield from diff_pec(a, b, pec_a, pec_b, p)
+    if len(design_a.pecs) != len(design_b.pecs):
+        yield Change('pec', None, None, '{:d} PECs -> {:d}'.format(
+            len(design_a.pecs), len(design_b.pecs)))
+
+
+def diff_files(path_a, path_b, /, strict=True):
+    return diff(PESv6().get(path_a, strict=strict, track=True),
+                PESv6().get(path_b, strict=strict, track=True))
+
+
+def main():
+
+    if (script := environ.get('RUNPYTHON')):
+        command = basename(script)
+    else:
+        command = 'python3 {}'.format(argv[0])
+
+    parser = ArgumentParser(prog=command, description=description,
+                            allow_abbrev=False,
+                            formatter_class=RawDescriptionHelpFormatter)
+
+    parser.add_argument('path_a', metavar='old', type=str,
+                        help="pathname of the original .pes file")
+
+    parser.add_argument('path_b', metavar='new', type=str,
+                        help="pathname of the revised .pes file")
+
+    args = parser.parse_args()
+
+    n_changes = 0
+    for change in diff_files(args.path_a, args.path_b):
+        print(change)
+        n_changes += 1
+
+    exit(1 if n_changes else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+###---------------------------------------------------------------------------------------------
+### duplicates
+###
+### Finds near-duplicate designs: the same stitches re-saved, recolored or moved. The
+### fingerprint of a design is a MinHash signature of the cells of a grid over its bounding
+### box that its stitches cross, which does not change with the position of the design or
+### the colors of its layers. Fingerprints are kept in a locality-sensitive hash
+### index, whose buckets hold the designs that agree on a band of the signature, so a query
+### only compares the few designs sharing a bucket with it. Run as a script, reports each
+### file that is a near duplicate of one taken in before it, or of one in a saved index.
+###---------------------------------------------------------------------------------------------
+
+import csv
+import numpy as np
+from sys        import argv, exit, stdout, stderr
+from os         import environ
+from os.path    import basename, exists
+from contextlib import nullcontext
+from argparse   import ArgumentParser, RawDescriptionHelpFormatter
+from pec        import Cmd
+from pesv6      import PESv6
+from stitches   import pec_arrays, absolute
+from density    import rasterize
+from validate   import expand_paths
+
+description = "Reports near-duplicate .pes files by the geometry of their stitches."
+
+## The bounding box of a design is divided into GRID by GRID cells.
+GRID = 48
+
+## The signature holds BANDS bands of ROWS hash values each. Two designs share a bucket
+## with a probability of 1-(1-s**ROWS)**BANDS for a similarity s, which rises sharply
+## around (1/BANDS)**(1/ROWS), about 0.42.
+BANDS = 32
+ROWS = 4
+
+## The hash functions are (a*cell+b) mod PRIME, with a and b drawn from a generator
+## seeded with SEED, so that signatures computed at different times can be compared.
+PRIME = (1<<31)-1
+SEED = 0x5E5
+
+DEFAULT_THRESHOLD = 0.8
+
+## Designs whose width or height differ by more than this fraction are not duplicates.
+SIZE_TOLERANCE = 0.05
+
+COLUMNS = ('path', 'duplicate', 'similarity')
+
+rng = np.random.default_rng(SEED)
+HASH_A = rng.integers(1, PRIME, BANDS*ROWS, dtype=np.int64)[:,None]
+HASH_B = rng.integers(0, PRIME, BANDS*ROWS, dtype=np.int64)[:,None]
+del rng
+
+
+class Fingerprint:
+
+    ## signature is an array of BANDS*ROWS hash values; width and height are those of
+    ## the bounding box of the stitches, in PEC units.
+
+    def __init__(self, signature, width, height):
+        self.signature = signature
+        self.width = width
+        self.height = height
+
+    def bands(self):
+        ## A hashable key for each band of the signature.
+        return [band.tobytes() for band in self.signature.reshape(BANDS, ROWS)]
+
+
+def stitches(design):
+    ## The (x0, y0, x1, y1) ends of the stitches of all PECs of design, each relative
+    ## to the start of its PEC, as an (n, 4) array.
+    ends = [np.zeros((0, 4), dtype=np.int64)]
+    for pec in design.pecs:
+        layer, cmd, dx, dy = pec_arrays(pec)
+        x, y = absolute(dx, dy)
+        stitch = cmd == Cmd.STITCH
+        ends.append(np.column_stack(((x-dx)[stitch], (y-dy)[stitch], x[stitch], y[stitch])))
+    return np.concatenate(ends)
+
+
+def fingerprint(design):
+
+    """Returns the Fingerprint of design. The grid is laid over the bounding box of
+    the stitches, with square cells, so the cells occupied only depend on the shape
+    the stitches make. The cells are those the thread crosses rather than those the
+    needle goes into, so that splitting or merging stitches changes little."""
+
+    ends = stitches(design)
+    if not len(ends):
+        return Fingerprint(np.full(BANDS*ROWS, PRIME, dtype=np.int64), 0, 0)
+    points = ends.reshape(-1, 2)
+    low = points.min(axis=0)
+    width, height = (points.max(axis=0)-low).tolist()
+    cell = max(1, width, height)/GRID
+    segment, x, y = rasterize(*(ends-np.tile(low, 2)).T, cell)
+    column = np.minimum(GRID-1, x//cell).astype(np.int64)
+    row = np.minimum(GRID-1, y//cell).astype(np.int64)
+    cells = np.unique(row*GRID+column)
+    signature = ((HASH_A*cells+HASH_B) % PRIME).min(axis=1)
+    return Fingerprint(signature, width, height)
+
+
+def similarity(a, b):
+    ## The estimated Jaccard similarity of the cells occupied by two designs.
+    return float(np.mean(a.signature == b.signature))
+
+
+def similar_sizes(a, b, /, tolerance=SIZE_TOLERANCE):
+    return all(abs(p-q) <= tolerance*max(p, q, 1)
+               for p, q in ((a.width, b.width), (a.height, b.height)))
+
+
+class Index:
+
+    ## Fingerprints under a key each, usually the pathname of the design, with a
+    ## bucket for each value of each band of the signature listing the fingerprints
+    ## that have it. Adding a key again replaces its fingerprint; the old one stays
+    ## in its buckets but is no longer current, and is skipped.
+
+    def __init__(self):
+        self.keys = []
+        self.fingerprints = []
+        self.current = {}       # key -> position in keys and fingerprints
+        self.buckets = [{} for band in range(BANDS)]
+
+    def __len__(self):
+        return len(self.current)
+
+    def __contains__(self, key):
+        return key in self.current
+
+    def add(self, key, fingerprint):
+        i = len(self.keys)
+        self.keys.append(key)
+        self.fingerprints.append(fingerprint)
+        self.current[key] = i
+        for buckets, band in zip(self.buckets, fingerprint.bands()):
+            buckets.setdefault(band, []).append(i)
+
+    def query(self, fingerprint, /, threshold=DEFAULT_THRESHOLD):
+
+        """Returns the (key, similarity) pairs of the fingerprints in the index at
+        least threshold similar to fingerprint and of a similar size, most similar
+        first. Only the fingerprints sharing a bucket with it are compared."""
+
+        candidates = set()
+        for buckets, band in zip(self.buckets, fingerprint.bands()):
+            candidates.update(buckets.get(band, ()))
+        matches = []
+        for i in sorted(candidates):
+            if self.current[self.keys[i]] != i:
+                continue
+            other = self.fingerprints[i]
+            if (s := similarity(fingerprint, other)) >= threshold and \
+               similar_sizes(fingerprint, other):
+                matches.append((self.keys[i], s))
+        return sorted(matches, key=lambda match: -match[1])
+
+    def save(self, path):
+        ## As a .npz file, under path as it is, without adding the extension.
+        fingerprints = [self.fingerprints[i] for i in self.current.values()]
+        with open(path, 'wb') as file:
+            np.savez(file, keys=np.array(list(self.current), dtype=str),
+                     signatures=np.array([f.signature for f in fingerprints],
+                                         dtype=np.int64).reshape(-1, BANDS*ROWS),
+                     sizes=np.array([(f.width, f.height) for f in fingerprints],
+                                    dtype=np.int64).reshape(-1, 2))
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        with np.load(path) as data:
+            for key, signature, (width, height) in zip(data['keys'].tolist(),
+                                                       data['signatures'], data['sizes']):
+                index.add(key, Fingerprint(signature, int(width), int(height)))
+        return index
+
+
+def write_csv(paths, ofile, /, index=None, threshold=DEFAULT_THRESHOLD):
+
+    """Fingerprints every .pes file in paths, descending into directories, and streams
+    to ofile as CSV the near duplicates of each among the files before it and those
+    already in index, to which the files are added, replacing any fingerprints they
+    had there. Returns the number of files with near duplicates."""
+
+    if index is None:
+        index = Index()
+    writer = csv.DictWriter(ofile, COLUMNS, lineterminator='\n')
+    writer.writeheader()
+    n_duplicates = 0
+    for path in expand_paths(paths):
+        try:
+            mark = fingerprint(PESv6().get(path))
+        except Exception as e:
+            print('{:s}: {:s}: {}'.format(path, type(e).__name__, e), file=stderr)
+            continue
+        matches = [(key, s) for key, s in index.query(mark, threshold=threshold)
+                   if key != path]
+        for key, s in matches:
+            writer.writerow(dict(path=path, duplicate=key, similarity='{:.3f}'.format(s)))
+        n_duplicates += bool(matches)
+        index.add(path, mark)
+    return n_duplicates
+
+
+def main():
+
+    if (script := environ.get('RUNPYTHON')):
+        command = basename(script)
+    else:
+        command = 'python3 {}'.format(argv[0])
+
+    parser = ArgumentParser(prog=command, description=description,
+                            allow_abbrev=False,
+                            formatter_class=RawDescriptionHelpFormatter)
+
+    parser.add_argument('paths', metavar='path', type=str, nargs='+',
+                        help="pathname of a file, or of a directory to search for .pes files")
+
+    parser.add_argument('-o', '--output',
+                        dest='output',
+                        type=str,
+                        help="pathname of the CSV file to write instead of stdout")
+
+    parser.add_argument('-i', '--index',
+                        dest='index',
+                        type=str,
+                        help="pathname of a .npz index to query and add the files to")
+
+    parser.add_argument('-t', '--threshold',
+                        dest='threshold',
+                        type=float,
+                        help="similarity, from 0 to 1, at which designs are near duplicates"
+                        " (default {:g})".format(DEFAULT_THRESHOLD))
+
+    parser.set_defaults(output=None, index=None, threshold=DEFAULT_THRESHOLD)
+
+    args = parser.parse_args()
+
+    index = Index.load(args.index) if args.index and exists(args.index) else Index()
+
+    with (open(args.output, 'w', newline='') if args.output else
+          nullcontext(stdout)) as ofile:
+        n_duplicates = write_csv(args.paths, ofile, index=index, threshold=args.threshold)
+
+    if args.index:
+        index.save(args.index)
+
+    exit(1 if n_duplicates else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+###---------------------------------------------------------------------------------------------
+### export
+###
+### Writes the stitches of the PECs of .pes files as Tajima .dst or Melco .exp files. The
+### moves of a PEC are encoded all at once with NumPy: DST records are 3 bytes holding each
+### coordinate in balanced ternary, EXP records are 2 signed bytes, with 2 byte prefixes for
+### jumps, trims and color changes. Moves too long for a record are split. Run as a script,
+### converts files as they are taken in, in a pool of worker processes if asked to.
+###---------------------------------------------------------------------------------------------
+
+import numpy as np
+from sys        import argv, exit, stderr
+from os         import environ
+from os.path    import basename, splitext, join, dirname
+from argparse   import ArgumentParser, RawDescriptionHelpFormatter
+from concurrent.futures import ProcessPoolExecutor
+from pec        import Cmd
+from pesv6      import PESv6
+from buffered_file import BufferedFileWriter
+from stitches   import pec_arrays, absolute
+from validate   import expand_paths
+
+description = "Converts .pes files to Tajima .dst or Melco .exp files."
+
+## The longest move along each axis in a single record.
+DST_LIMIT = 121
+EXP_LIMIT = 127
+
+## A trim is written to DST as at least this many jumps, which machines take as a trim.
+DST_TRIM_JUMPS = 3
+
+DST_HEADER_SIZE = 512
+DST_END = b'\x00\x00\xF3'
+
+## For each power of 3, the byte of a DST record holding it and the bits set in that
+## byte for +1 and -1, for x and for y. y is up in DST, down in PEC.
+DST_X_BITS = ((0, 0x01, 0x02), (1, 0x01, 0x02), (0, 0x04, 0x08), (1, 0x04, 0x08),
+              (2, 0x04, 0x08))
+DST_Y_BITS = ((0, 0x80, 0x40), (1, 0x80, 0x40), (0, 0x20, 0x10), (1, 0x20, 0x10),
+              (2, 0x20, 0x10))
+
+EXP_TRIM  = (0x80, 0x80, 0x07, 0x00)
+EXP_JUMP  = (0x80, 0x04)
+EXP_COLOR = (0x80, 0x01, 0x00, 0x00)
+
+
+def pec_moves(pec):
+
+    """Returns the cmd, dx and dy arrays of the moves of pec, with a COLOR move with
+    no displacement between each two layers."""
+
+    layer, cmd, dx, dy = pec_arrays(pec)
+    changes = np.searchsorted(layer, np.arange(1, len(pec.layers)))
+    return (np.insert(cmd, changes, Cmd.COLOR), np.insert(dx, changes, 0),
+            np.insert(dy, changes, 0))
+
+
+def split_moves(cmd, dx, dy, limit, /, parts=1):
+
+    """Splits every move into equal moves of at most limit units along each axis, and
+    into at least parts moves, which may be an array with a value for each move. Of a
+    trim split into several moves, only the first stays a trim; the rest are jumps."""
+
+    n = np.maximum(parts, -(-np.maximum(np.abs(dx), np.abs(dy))//limit))
+    n = np.maximum(1, n).astype(np.int64)
+    if (n == 1).all():
+        return cmd, dx, dy
+    move = np.repeat(np.arange(len(n)), n)
+    k = np.arange(len(move))-(np.cumsum(n)-n)[move]+1
+    split = n[move]
+    def steps(d):
+        d = d[move].astype(np.int64)
+        return d*k//split-d*(k-1)//split
+    cmd = cmd[move]
+    cmd[(cmd == Cmd.TRIM) & (k > 1)] = Cmd.JUMP
+    return cmd, steps(dx), steps(dy)
+
+
+def dst_records(cmd, dx, dy):
+
+    """Returns the DST records of moves that each fit a record, as an (n, 3) array."""
+
+    records = np.zeros((len(cmd), 3), dtype=np.uint8)
+    records[:,2] = 0x03
+    for values, bits in ((dx, DST_X_BITS), (-dy, DST_Y_BITS)):
+        ## The balanced ternary digits of v are the ternary digits of v+121, less 1.
+        u = np.asarray(values, dtype=np.int64)+DST_LIMIT
+        for byte, plus, minus in bits:
+            digit = u % 3
+            u //= 3
+            records[digit == 2, byte] |= plus
+            records[digit == 0, byte] |= minus
+    records[(cmd == Cmd.JUMP) | (cmd == Cmd.TRIM), 2] |= 0x80
+    records[cmd == Cmd.COLOR] = (0x00, 0x00, 0xC3)
+    return records
+
+
+def signed(value):
+    ## A sign followed by the magnitude right aligned in 5 characters.
+    return '{:s}{:5d}'.format('-' if value < 0 else '+', abs(value))
+
+
+def dst_header(label, n_records, n_colors, x, y):
+    ## x and y are the absolute positions reached, with y up.
+    fields = ('LA:{:<16s}\r'.format(label[:16]),
+              'ST:{:7d}\r'.format(n_records),
+              'CO:{:3d}\r'.format(n_colors),
+              '+X:{:5d}\r'.format(max(0, int(x.max(initial=0)))),
+              '-X:{:5d}\r'.format(max(0, -int(x.min(initial=0)))),
+              '+Y:{:5d}\r'.format(max(0, int(y.max(initial=0)))),
+              '-Y:{:5d}\r'.format(max(0, -int(y.min(initial=0)))),
+              'AX:{:s}\r'.format(signed(int(x[-1]) if len(x) else 0)),
+              'AY:{:s}\r'.format(signed(int(y[-1]) if len(y) else 0)),
+              'MX:{:s}\r'.format(signed(0)),
+              'MY:{:s}\r'.format(signed(0)),
+              'PD:******\r')
+    header = ''.join(fields).encode('ascii', 'replace')+b'\x1A'
+    return header.ljust(DST_HEADER_SIZE, b' ')
+
+
+def encode_dst(pec):
+
+    """Returns the contents of a .dst file of the stitches of pec."""
+
+    cmd, dx, dy = pec_moves(pec)
+    cmd, dx, dy = split_moves(cmd, dx, dy, DST_LIMIT,
+                              np.where(cmd == Cmd.TRIM, DST_TRIM_JUMPS, 1))
+    x, y = absolute(dx, -dy)
+    header = dst_header(pec.label.strip(), len(cmd)+1, len(pec.layers)-1, x, y)
+    return header+dst_records(cmd, dx, dy).tobytes()+DST_END
+
+
+def encode_exp(pec):
+
+    """Returns the contents of an .exp file of the stitches of pec."""
+
+    cmd, dx, dy = pec_moves(pec)
+    cmd, dx, dy = split_moves(cmd, dx, dy, EXP_LIMIT)
+    trim = cmd == Cmd.TRIM
+    jump = (cmd == Cmd.JUMP) | trim
+    color = cmd == Cmd.COLOR
+
+    ## Up to 8 bytes a move: a trim, a jump prefix and the move itself, of which
+    ## those that apply are kept.
+    records = np.zeros((len(cmd), 8), dtype=np.uint8)
+    keep = np.zeros((len(cmd), 8), dtype=bool)
+    records[:,0:4] = EXP_TRIM
+    keep[trim,0:4] = True
+    records[:,4:6] = EXP_JUMP
+    keep[jump,4:6] = True
+    records[:,6] = dx.astype(np.int8).view(np.uint8)
+    records[:,7] = (-dy).astype(np.int8).view(np.uint8)
+    records[color,4:8] = EXP_COLOR
+    keep[color,4:6] = True
+    keep[:,6:8] = True
+    return records[keep].tobytes()
+
+
+ENCODERS = {'dst': encode_dst, 'exp': encode_exp}
+
+
+def output_paths(path, n_pecs, extension, /, directory=None):
+    ## One file for each PEC, numbered if there are several.
+    stem = join(directory if directory is not None else dirname(path),
+                splitext(basename(path))[0])
+    if n_pecs == 1:
+        return [stem+'.'+extension]
+    return ['{:s}_{:d}.{:s}'.format(stem, p+1, extension) for p in range(n_pecs)]
+
+
+def export(path, extension, /, directory=None, atomic=True):
+
+    """Converts the .pes file at path to one file in the format given by extension,
+    'dst' or 'exp', for each of its PECs, written next to it or in directory. Returns
+    the pathnames written."""
+
+    design = PESv6().get(path)
+    paths = output_paths(path, len(design.pecs), extension, directory=directory)
+    for pec, output in zip(design.pecs, paths):
+        with BufferedFileWriter(output, atomic=atomic) as file:
+            file.put_data(ENCODERS[extension](pec))
+    return paths
+
+
+def export_file(args):
+    ## export, with exceptions returned rather than raised, for a pool to map.
+    path, extension, directory = args
+    try:
+        return path, export(path, extension, directory=directory)
+    except Exception as e:
+        return path, e
+
+
+def export_files(paths, extension, /, directory=None, workers=None):
+
+    """Converts every .pes file in paths, descending into directories. Yields a
+    (path, result) pair for each file, where result is the list of pathnames written
+    or the exception raised. With workers set, files are converted concurrently in a
+    pool of that many processes."""
+
+    jobs = ((path, extension, directory) for path in expand_paths(paths))
+    if not workers:
+        yield from map(export_file, jobs)
+        return
+    with ProcessPoolExecutor(workers) as pool:
+        yield from pool.map(export_file, jobs, chunksize=16)
+
+
+def main():
+
+    if (script := environ.get('RUNPYTHON')):
+        command = basename(script)
+    else:
+        command = 'python3 {}'.format(argv[0])
+
+    parser = ArgumentParser(prog=command, description=description,
+                            allow_abbrev=False,
+                            formatter_class=RawDescriptionHelpFormatter)
+
+    parser.add_argument('paths', metavar='path', type=str, nargs='+',
+                        help="pathname of a file, or of a directory to search for .pes files")
+
+    parser.add_argument('-f', '--format',
+                        dest='format',
+                        choices=sorted(ENCODERS),
+                        help="format to convert to (default dst)")
+
+    parser.add_argument('-d', '--directory',
+                        dest='directory',
+                        type=str,
+                        help="directory to write the files to instead of next to each .pes file")
+
+    parser.add_argument('-j', '--workers',
+                        dest='workers',
+                        type=int,
+                        help="number of processes to convert files in")
+
+    parser.set_defaults(format='dst', directory=None, workers=None)
+
+    args = parser.parse_args()
+
+    n_errors = 0
+    for path, result in export_files(args.paths, args.format, directory=args.directory,
+                                     workers=args.workers):
+        if isinstance(result, Exception):
+            print('{:s}: {:s}: {}'.format(path, type(result).__name__, result), file=stderr)
+            n_errors += 1
+        else:
+            print('\n'.join(result))
+
+    exit(1 if n_errors else 0)
+
+
+if __name__ == '__main__':
+    main()
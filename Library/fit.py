@@ -0,0 +1,307 @@
+###---------------------------------------------------------------------------------------------
+### fit
+###
+### Finds the smallest hoop a design fits in, and the rotation and translation that fit
+### it there. The extent of the design at each rotation is computed from the convex
+### hull of its stitches, for a whole sweep of rotations at once. Run as a script, writes
+### the fit of every design in a catalog as CSV.
+###---------------------------------------------------------------------------------------------
+
+import re
+import csv
+import numpy as np
+from sys        import argv, stdout, stderr
+from os         import environ
+from os.path    import basename, splitext
+from contextlib import nullcontext
+from argparse   import ArgumentParser, RawDescriptionHelpFormatter
+from pec        import Cmd
+from pesv6      import PESv6, HOOP, CSewSeg
+from stitches   import UNITS_PER_MM, pec_arrays, absolute, split_move
+from validate   import expand_paths
+
+description = "Finds the smallest hoop each .pes embroidery file fits in."
+
+## Rotations other than right angles are tried in steps of this many degrees, and at
+## the angles of the hull's edges, one of which gives the smallest area.
+DEFAULT_STEP = 1.0
+
+## The largest move a PEC coordinate holds.
+MAX_MOVE = 1023
+
+COLUMNS = ('path', 'hoop', 'angle', 'width_mm', 'height_mm', 'dx_mm', 'dy_mm')
+
+
+def hoop_size(hoop):
+    ## The (width, height) of a hoop in PEC units, from its name.
+    match = re.fullmatch(r'SIZE_(\d+)x(\d+)', hoop.name)
+    return int(match[1])*UNITS_PER_MM, int(match[2])*UNITS_PER_MM
+
+
+def design_points(design):
+
+    """Returns an (n, 2) array of the (x, y) stitch positions of design. The CSewSeg
+    coordinates place all hoop sections in one space, so they are used if there are
+    any. Otherwise the positions are those of the first PEC, relative to its start."""
+
+    blocks = [np.asarray(coordinates, dtype=np.int32).reshape(-1, 2)
+              for obj in design.objects if isinstance(obj, CSewSeg)
+              for stitch_type, thread_index, coordinates in obj.blocks]
+    if blocks:
+        return np.concatenate(blocks)[:,::-1]   # CSewSeg coordinates are (y, x)
+    layer, cmd, dx, dy = pec_arrays(design.pecs[0])
+    x, y = absolute(dx, dy)
+    return np.column_stack((np.append(x, 0), np.append(y, 0)))
+
+
+def convex_hull(points):
+
+    """Returns the vertices of the convex hull of points in counterclockwise order.
+    Points inside the polygon through the extreme points in eight directions cannot be
+    on the hull, and are dropped with vectorized tests before the monotone chain."""
+
+    points = np.asarray(points, dtype=np.int64).reshape(-1, 2)
+    x, y = points[:,0], points[:,1]
+    extremes = points[np.unique([f(v) for v in (x, y, x+y, x-y)
+                                 for f in (np.argmin, np.argmax)])]
+    if len(extremes) >= 3:
+        centre = extremes.mean(axis=0)
+        polygon = extremes[np.argsort(np.arctan2(extremes[:,1]-centre[1],
+                                                 extremes[:,0]-centre[0]))]
+        inside = np.ones(len(points), dtype=bool)
+        for (x0, y0), (x1, y1) in zip(polygon, np.roll(polygon, -1, axis=0)):
+            inside &= (x1-x0)*(y-y0)-(y1-y0)*(x-x0) > 0
+        points = points[~inside]
+    points = np.unique(points, axis=0)
+    if len(points) < 3:
+        return points
+
+    ## Andrew's monotone chain. np.unique has sorted the points by x, then y.
+    def chain(points):
+        hull = []
+        for p in points:
+            while len(hull) >= 2 and ((hull[-1][0]-hull[-2][0])*(p[1]-hull[-2][1]) -
+                                      (hull[-1][1]-hull[-2][1])*(p[0]-hull[-2][0])) <= 0:
+                hull.pop()
+            hull.append(p)
+        return hull
+
+    points = points.tolist()
+    lower = chain(points)
+    upper = chain(reversed(points))
+    return np.array(lower[:-1]+upper[:-1], dtype=np.int64)
+
+
+def rotated_extents(hull, angles):
+
+    """Returns the (min_x, min_y, max_x, max_y) of hull rotated counterclockwise by each
+    of angles, in radians, as an (n, 4) array."""
+
+    c, s = np.cos(angles)[:,None], np.sin(angles)[:,None]
+    x = c*hull[None,:,0]-s*hull[None,:,1]
+    y = s*hull[None,:,0]+c*hull[None,:,1]
+    return np.stack((x.min(axis=1), y.min(axis=1), x.max(axis=1), y.max(axis=1)), axis=1)
+
+
+def signed(angle):
+    ## A rotation of angle+180 degrees has the same extent as angle, so angles are
+    ## given between -90 and 90.
+    return angle if angle <= 90.0 else angle-180.0
+
+
+class Fit:
+
+    ## The rotation, counterclockwise in degrees, and the translation, in PEC units,
+    ## that centre the design in hoop, and its size once rotated.
+
+    def __init__(self, hoop, angle, width, height, translation):
+        self.hoop = hoop
+        self.angle = angle
+        self.width = width
+        self.height = height
+        self.translation = translation
+
+    def __repr__(self):
+        return '{:s}({}, {:g}, {:g}, {:g}, {})'.format(
+            __class__.__name__, self.hoop, self.angle, self.width, self.height,
+            self.translation)
+
+    def __str__(self):
+        return '{:s} at {:g} degrees, {:.1f} x {:.1f} mm'.format(
+            self.hoop.name, self.angle,
+            self.width/UNITS_PER_MM, self.height/UNITS_PER_MM)
+
+
+def find_fit(points, /, free=False, step=DEFAULT_STEP, margin=0):
+
+    """Returns the Fit in the smallest hoop that points fit in, leaving margin units on
+    every side, or None if they fit in none. Without rotating, and then rotated by a
+    right angle, are preferred. With free set, the smallest other rotation that fits
+    is tried next."""
+
+    hull = convex_hull(points)
+    angles = [0.0, 90.0]
+    if free:
+        ## Rotating by another 90 degrees swaps the width and height, so the candidates
+        ## below 90 degrees are tried in both orientations, smallest rotation first.
+        edges = np.roll(hull, -1, axis=0)-hull
+        candidates = (set(np.arange(step, 90.0, step).tolist()) |
+                      set((np.degrees(np.arctan2(-edges[:,1], edges[:,0])) % 90.0).tolist()))
+        candidates = (candidates | {angle+90.0 for angle in candidates}) - {0.0, 90.0}
+        angles += sorted(candidates, key=lambda angle: abs(signed(angle)))
+    angles = np.array(angles)
+    extents = rotated_extents(hull, np.radians(angles))
+    widths = extents[:,2]-extents[:,0]+2*margin
+    heights = extents[:,3]-extents[:,1]+2*margin
+
+    for hoop in sorted(HOOP, key=lambda hoop: np.prod(hoop_size(hoop))):
+        w, h = hoop_size(hoop)
+        if len(fits := np.flatnonzero((widths <= w) & (heights <= h))):
+            i = fits[0]
+            centre = (extents[i,:2]+extents[i,2:])/2
+            return Fit(hoop, signed(float(angles[i])),
+                       float(widths[i]-2*margin), float(heights[i]-2*margin),
+                       (-int(round(centre[0])), -int(round(centre[1]))))
+    return None
+
+
+def fit_design(design, /, free=False, step=DEFAULT_STEP, margin=0):
+    return find_fit(design_points(design), free=free, step=step, margin=margin)
+
+
+def transform(points, fit):
+    ## Rotates (x, y) points by the fit's angle and translates them.
+    angle = np.radians(fit.angle)
+    c, s = np.cos(angle), np.sin(angle)
+    x, y = points[:,0], points[:,1]
+    return np.column_stack((np.rint(c*x-s*y)+fit.translation[0],
+                            np.rint(s*x+c*y)+fit.translation[1])).astype(np.int64)
+
+
+def apply_fit(design, fit):
+
+    """Rotates and translates the CSewSeg coordinates of design as fit says, and
+    rotates the stitches of each PEC about its starting point, which is where the
+    machine places it. The hoop size in the header is set to the fit's hoop. The
+    thumbnails are left as they are."""
+
+    for obj in design.objects:
+        if not isinstance(obj, CSewSeg):
+            continue
+        obj.blocks = [(stitch_type, thread_index,
+                       transform(np.asarray(coordinates, dtype=np.int32).reshape(-1, 2)[:,::-1],
+                                 fit)[:,::-1].astype(np.int16))
+                      for stitch_type, thread_index, coordinates in obj.blocks]
+        for name in ('extents1', 'extents2'):
+            x0, y0, x1, y1 = getattr(obj, name)
+            corners = transform(np.array([(x0, y0), (x1, y0), (x0, y1), (x1, y1)]), fit)
+            setattr(obj, name, tuple(int(v) for v in (*corners.min(axis=0),
+                                                      *corners.max(axis=0))))
+
+    rotation = Fit(fit.hoop, fit.angle, fit.width, fit.height, (0, 0))
+    for pec in design.pecs:
+        layer, cmd, dx, dy = pec_arrays(pec)
+        x, y = absolute(dx, dy)
+        positions = transform(np.column_stack((np.append(0, x), np.append(0, y))), rotation)
+        moves = iter(np.diff(positions, axis=0).tolist())
+        layers = []
+        for old in pec.layers:
+            layers.append(new := [])
+            for cmd, args in old:
+                if cmd == Cmd.COLOR or cmd == Cmd.STOP:
+                    new.append((cmd, args))
+                    continue
+                dx, dy = next(moves)
+                if max(abs(dx), abs(dy)) > MAX_MOVE:
+                    new.extend(split_move(cmd, dx, dy, limit=MAX_MOVE))
+                else:
+                    new.append((cmd, [dx, dy]))
+        pec.layers = layers
+        pec.width = int(positions[:,0].max()-positions[:,0].min())
+        pec.height = int(positions[:,1].max()-positions[:,1].min())
+
+    design.hoop_width, design.hoop_height = (size//UNITS_PER_MM for size in hoop_size(fit.hoop))
+
+
+def write_csv(paths, ofile, /, free=False, step=DEFAULT_STEP, margin=0, apply=False):
+
+    """Streams the fit of every .pes file in paths, descending into directories, to
+    ofile as CSV. With apply set, each design that fits is also written with the fit
+    applied, next to the original with _fit added to its name."""
+
+    writer = csv.DictWriter(ofile, COLUMNS, lineterminator='\n')
+    writer.writeheader()
+    for path in expand_paths(paths):
+        try:
+            design = PESv6().get(path)
+            fit = fit_design(design, free=free, step=step, margin=margin)
+        except Exception as e:
+            print('{:s}: {:s}: {}'.format(path, type(e).__name__, e), file=stderr)
+            continue
+        if fit is None:
+            writer.writerow(dict(path=path))
+            continue
+        writer.writerow(dict(path      = path,
+                             hoop      = fit.hoop.name,
+                             angle     = '{:g}'.format(fit.angle),
+                             width_mm  = '{:.1f}'.format(fit.width/UNITS_PER_MM),
+                             height_mm = '{:.1f}'.format(fit.height/UNITS_PER_MM),
+                             dx_mm     = '{:.1f}'.format(fit.translation[0]/UNITS_PER_MM),
+                             dy_mm     = '{:.1f}'.format(fit.translation[1]/UNITS_PER_MM)))
+        if apply:
+            apply_fit(design, fit)
+            design.put(splitext(path)[0]+'_fit.pes')
+
+
+def main():
+
+    if (script := environ.get('RUNPYTHON')):
+        command = basename(script)
+    else:
+        command = 'python3 {}'.format(argv[0])
+
+    parser = ArgumentParser(prog=command, description=description,
+                            allow_abbrev=False,
+                            formatter_class=RawDescriptionHelpFormatter)
+
+    parser.add_argument('paths', metavar='path', type=str, nargs='+',
+                        help="pathname of a file, or of a directory to search for .pes files")
+
+    parser.add_argument('-o', '--output',
+                        dest='output',
+                        type=str,
+                        help="pathname of the CSV file to write instead of stdout")
+
+    parser.add_argument('-f', '--free',
+                        dest='free',
+                        action='store_true',
+                        help="try rotations other than right angles")
+
+    parser.add_argument('-s', '--step',
+                        dest='step',
+                        type=float,
+                        help="step in degrees between free rotations (default {:g})"
+                        .format(DEFAULT_STEP))
+
+    parser.add_argument('-m', '--margin',
+                        dest='margin',
+                        type=float,
+                        help="margin in mm to leave on every side (default 0)")
+
+    parser.add_argument('-a', '--apply',
+                        dest='apply',
+                        action='store_true',
+                        help="write each design that fits, rotated, to <name>_fit.pes")
+
+    parser.set_defaults(output=None, free=False, step=DEFAULT_STEP, margin=0.0, apply=False)
+
+    args = parser.parse_args()
+
+    with (open(args.output, 'w', newline='') if args.output else
+          nullcontext(stdout)) as ofile:
+        write_csv(args.paths, ofile, free=args.free, step=args.step,
+                  margin=args.margin*UNITS_PER_MM, apply=args.apply)
+
+
+if __name__ == '__main__':
+    main()
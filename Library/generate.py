@@ -0,0 +1,305 @@
+###---------------------------------------------------------------------------------------------
+### generate
+###
+### Generates stitches from vector shapes: tatami fills of polygons, satin columns between
+### two rails and running stitches along polylines. The stitches are built into CSewSeg
+### objects and a matching PEC, on top of a template design that provides the header, the
+### thread table and the fields whose meaning is not known. Positions are (x, y) in PEC
+### units, tenths of a millimeter; lengths and spacings are in millimeters.
+###---------------------------------------------------------------------------------------------
+
+import copy
+import numpy as np
+from pec        import Cmd
+from pesv6      import CSewSeg, BLOCK_STITCH, BLOCK_JUMP
+from stitches   import UNITS_PER_MM, split_move
+from compose    import join_layers
+from regroup    import color_list
+from normalize  import normalize_moves, COMMANDS
+from normalize  import DEFAULT_MAX_LENGTH, DEFAULT_MIN_LENGTH, DEFAULT_TRIM_LENGTH
+
+## Tatami rows are this far apart, and their stitches this long, in mm.
+DEFAULT_SPACING = 0.4
+DEFAULT_LENGTH = 3.0
+
+## Running stitches are at most this long, in mm.
+DEFAULT_RUN_LENGTH = 2.5
+
+## The stitches of each tatami row are offset by this fraction of a stitch length from
+## those of the row before, which spreads the needle penetrations into a diagonal
+## pattern instead of a visible line.
+STAGGER = 1/3
+
+## The shortest stitch at either end of a tatami row, as a fraction of a stitch length.
+MIN_FRACTION = 1/4
+
+## The number of coordinates of a block is a uint16.
+MAX_BLOCK = 0xFFFF
+
+## PEC coordinates are limited to 12 bits; longer jumps are split.
+PEC_LIMIT = 1000
+
+
+class Element:
+
+    ## Stitches sewn in one thread, given by the (n, 2) array of the positions the
+    ## needle goes to, and for each position whether it is reached by a jump rather
+    ## than a stitch. The first position is where the element starts.
+
+    def __init__(self, thread_index, points, /, jumps=None):
+        self.thread_index = thread_index
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        self.points = np.rint(points).astype(np.int32)
+        if jumps is None:
+            jumps = np.zeros(len(self.points), dtype=bool)
+        self.jumps = np.asarray(jumps, dtype=bool)
+
+
+def rotation(angle):
+    angle = np.radians(angle)
+    c, s = np.cos(angle), np.sin(angle)
+    return np.array(((c, -s), (s, c)))
+
+
+def scanlines(rings, spacing):
+
+    """Intersects the polygon given by rings, a list of (m, 2) arrays of the vertices
+    of its outline and holes, with horizontal lines spacing apart. Returns the row
+    of each segment inside the polygon and the x at which it enters and leaves it,
+    by the even-odd rule. A vertex on a line counts for the edge above it only, so
+    the crossings of each line come in pairs."""
+
+    starts = np.concatenate([ring for ring in rings])
+    ends = np.concatenate([np.roll(ring, -1, axis=0) for ring in rings])
+    y0 = starts[:,1].min()
+    lo = np.minimum(starts[:,1], ends[:,1])
+    hi = np.maximum(starts[:,1], ends[:,1])
+    first = np.ceil((lo-y0)/spacing-0.5).astype(np.int64)
+    n = np.maximum(0, np.ceil((hi-y0)/spacing-0.5).astype(np.int64)-first)
+    edge = np.repeat(np.arange(len(n)), n)
+    row = first[edge]+np.arange(len(edge))-(np.cumsum(n)-n)[edge]
+    y = y0+(row+0.5)*spacing
+    (xa, ya), (xb, yb) = starts[edge].T, ends[edge].T
+    x = xa+(y-ya)*(xb-xa)/(yb-ya)
+    order = np.lexsort((x, row))
+    row, x = row[order], x[order]
+    return row[0::2], x[0::2], x[1::2], y0
+
+
+def tatami(thread_index, rings, /, angle=0.0, spacing=DEFAULT_SPACING,
+           length=DEFAULT_LENGTH):
+
+    """Returns an Element filling the polygon given by rings, the outline followed by
+    any holes, with rows of stitches at angle degrees, spacing mm apart, of stitches
+    of length mm. Rows are sewn back and forth. Where the next row does not overlap
+    the one before, or a row is split by a hole or a concavity, the needle jumps."""
+
+    spacing *= UNITS_PER_MM
+    length *= UNITS_PER_MM
+    turn = rotation(-angle)
+    rings = [np.asarray(ring, dtype=np.float64).reshape(-1, 2) @ turn.T for ring in rings]
+    row, x_in, x_out, y0 = scanlines(rings, spacing)
+    keep = x_out > x_in
+    row, x_in, x_out = row[keep], x_in[keep], x_out[keep]
+    if not len(row):
+        return Element(thread_index, np.zeros((0, 2)))
+
+    ## Each segment is sewn from where it enters to where it leaves, through the
+    ## points of a grid of stitch lengths, offset on each row by the stagger. Grid
+    ## points too close to either end are left out, so as not to make tiny stitches.
+    base = np.concatenate(rings)[:,0].min()+(row % round(1/STAGGER))*STAGGER*length
+    m0 = np.floor((x_in-base)/length+MIN_FRACTION).astype(np.int64)+1
+    m1 = np.ceil((x_out-base)/length-MIN_FRACTION).astype(np.int64)-1
+    n = np.maximum(0, m1-m0+1)+2
+    segment = np.repeat(np.arange(len(n)), n)
+    j = np.arange(len(segment))-(np.cumsum(n)-n)[segment]
+    x = np.where(j == 0, x_in[segment],
+                 np.where(j == n[segment]-1, x_out[segment],
+                          base[segment]+(m0[segment]+j-1)*length))
+
+    ## Every other row is sewn right to left.
+    direction = np.where(row[segment] % 2, -1, 1)
+    order = np.lexsort((direction*x, row[segment]))
+    segment, x = segment[order], x[order]
+    y = y0+(row[segment]+0.5)*spacing
+
+    ## Moving on to another segment sews if it is on the next row and overlaps the
+    ## segment before, and jumps otherwise.
+    a, b = segment[:-1], segment[1:]
+    jumps = np.append(False, (a != b) & ~((np.abs(row[a]-row[b]) == 1) &
+                                          (x_in[a] <= x_out[b]) & (x_in[b] <= x_out[a])))
+    return Element(thread_index, np.column_stack((x, y)) @ turn, jumps=jumps)
+
+
+def resample(points, n):
+    ## n+1 points evenly spaced along the polyline through points.
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    walked = np.append(0, np.cumsum(np.hypot(*np.diff(points, axis=0).T)))
+    at = np.linspace(0, walked[-1], n+1)
+    return np.column_stack((np.interp(at, walked, points[:,0]),
+                            np.interp(at, walked, points[:,1])))
+
+
+def polyline_length(points):
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    return float(np.hypot(*np.diff(points, axis=0).T).sum())
+
+
+def satin(thread_index, left, right, /, spacing=DEFAULT_SPACING):
+
+    """Returns an Element sewing a satin column across the two rails left and right,
+    polylines running the same way, going back and forth between them at about
+    spacing mm apart along the longer rail."""
+
+    spacing *= UNITS_PER_MM
+    n = max(1, int(np.ceil(max(polyline_length(left), polyline_length(right))/spacing)))
+    points = np.stack((resample(left, n), resample(right, n)), axis=1).reshape(-1, 2)
+    return Element(thread_index, points)
+
+
+def running(thread_index, points, /, length=DEFAULT_RUN_LENGTH):
+
+    """Returns an Element sewing along the polyline through points, each of its
+    segments split into equal stitches of at most length mm."""
+
+    length *= UNITS_PER_MM
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    d = np.diff(points, axis=0)
+    n = np.maximum(1, np.ceil(np.hypot(*d.T)/length)).astype(np.int64)
+    segment = np.repeat(np.arange(len(n)), n)
+    t = (np.arange(len(segment))-(np.cumsum(n)-n)[segment]+1)/n[segment]
+    return Element(thread_index,
+                   np.vstack((points[:1], points[segment]+t[:,None]*d[segment])))
+
+
+def element_moves(element, /, max_length, min_length, trim_length):
+
+    """Returns the cmd, dx and dy arrays of the moves of element from its first
+    position, normalized. Lengths are in PEC units."""
+
+    d = np.diff(element.points, axis=0)
+    cmd = np.where(element.jumps[1:], Cmd.JUMP, Cmd.STITCH).astype(np.int32)
+    return normalize_moves(cmd, d[:,0], d[:,1], max_length=max_length,
+                           min_length=min_length, trim_length=trim_length)
+
+
+def blocks(element, cmd, dx, dy):
+
+    """Returns the CSewSeg blocks of element sewn by the moves cmd, dx and dy: a sewn
+    block for each run of stitches and a jump block for each run of jumps and trims,
+    so that the blocks go through the positions the PEC moves go to."""
+
+    points = np.cumsum(np.vstack((element.points[:1], np.column_stack((dx, dy)))), axis=0)
+    coordinates = points[:,::-1].astype(np.int16)             # CSewSeg coordinates are (y, x)
+    if not len(cmd):
+        return []
+    sewn = cmd == Cmd.STITCH
+    breaks = (np.flatnonzero(sewn[1:] != sewn[:-1])+1).tolist()
+    result = []
+    for start, end in zip([0]+breaks, breaks+[len(cmd)]):
+        stitch_type = BLOCK_STITCH if sewn[start] else BLOCK_JUMP
+        ## Moves start to end go through coordinates start to end inclusive. A block
+        ## holds at most MAX_BLOCK coordinates; a longer run is split into blocks that
+        ## share the coordinate where one ends and the next starts.
+        for first in range(start, end, MAX_BLOCK-1):
+            result.append((stitch_type, element.thread_index,
+                           coordinates[first:min(end, first+MAX_BLOCK-1)+1]))
+    return result
+
+
+def pec_layer(cmd, dx, dy):
+
+    """Returns the PEC layer of the moves cmd, dx and dy, with jumps longer than the
+    PEC limit split, ended with a STOP for join_layers to replace."""
+
+    moves = []
+    for c, x, y in zip(cmd.tolist(), dx.tolist(), dy.tolist()):
+        if c != Cmd.STITCH and max(abs(x), abs(y)) > PEC_LIMIT:
+            steps = split_move(Cmd.JUMP, x, y, limit=PEC_LIMIT)
+            steps[0] = (COMMANDS[c], steps[0][1])
+            moves += steps
+        else:
+            moves.append((COMMANDS[c], [x, y]))
+    return moves+[(Cmd.STOP, [])]
+
+
+def render(points, extent, width, height):
+
+    """Returns the scanlines of a width by height pixel thumbnail of the points, with
+    extent, (xmin, ymin, xmax, ymax), scaled to fit within a pixel margin."""
+
+    scanlines = np.zeros((height, width), dtype=bool)
+    if len(points):
+        xmin, ymin, xmax, ymax = extent
+        scale = min((width-3)/max(1, xmax-xmin), (height-3)/max(1, ymax-ymin))
+        column = np.rint(1+(points[:,0]-xmin)*scale).astype(np.int64)
+        row = np.rint(1+(points[:,1]-ymin)*scale).astype(np.int64)
+        scanlines[row, column] = True
+    data = np.packbits(scanlines, axis=1, bitorder='little')
+    return [int.from_bytes(scanline.tobytes(), 'little') for scanline in data]
+
+
+def pec_thread(thread):
+    ## The PEC thread specification, (type, code), of a PES thread.
+    return thread.color_type & 0xFF, int(thread.code) if thread.code.isdigit() else 0
+
+
+def generate(template, elements, /, max_length=DEFAULT_MAX_LENGTH,
+             min_length=DEFAULT_MIN_LENGTH, trim_length=DEFAULT_TRIM_LENGTH):
+
+    """Returns a copy of template that sews elements, in order, in place of its own
+    stitches. Each element becomes a CSewSeg object, modelled on the first of
+    template, and a layer of a single PEC, with adjacent layers of one thread joined.
+    Thread indexes refer to the thread table of template. The stitches are
+    normalized with the given lengths in mm, the same for the CSewSeg blocks and the
+    PEC. Thumbnails are drawn from the
+    stitches; the thread bitmaps, whose meaning is not known, are those of the first
+    layer of template."""
+
+    model = next((obj for obj in template.objects if isinstance(obj, CSewSeg)), None)
+    if model is None:
+        raise ValueError('the template needs a CSewSeg object')
+    elements = [element for element in elements if len(element.points)]
+    points = np.concatenate([element.points for element in elements] or [np.zeros((0, 2))])
+    extent = (*points.min(axis=0).tolist(), *points.max(axis=0).tolist()) if len(points) \
+             else (0, 0, 0, 0)
+
+    normalized = [element_moves(element, max_length=max_length*UNITS_PER_MM,
+                                min_length=min_length*UNITS_PER_MM,
+                                trim_length=trim_length*UNITS_PER_MM)
+                  for element in elements]
+
+    design = copy.copy(template)
+    design.objects = []
+    for element, (cmd, dx, dy) in zip(elements, normalized):
+        obj = copy.copy(model)
+        obj.blocks = blocks(element, cmd, dx, dy)
+        obj.colors = color_list(obj.blocks)
+        obj.extents1 = obj.extents2 = (*element.points.min(axis=0).tolist(),
+                                       *element.points.max(axis=0).tolist())
+        design.objects.append(obj)
+
+    ## A PEC with a layer for each element, from which join_layers builds the one
+    ## written, with travels between the elements and the tables to match.
+    base = template.pecs[0]
+    rgbs = [tuple(template.threads[element.thread_index].rgbx[:3]) for element in elements]
+    staged = copy.copy(base)
+    staged.layers = [pec_layer(cmd, dx, dy) for cmd, dx, dy in normalized]
+    staged.rgbs = list(dict.fromkeys(rgbs))
+    staged.indexes = bytes(staged.rgbs.index(rgb) for rgb in rgbs)
+    staged.threads = [pec_thread(template.threads[element.thread_index])
+                      for element in elements]
+    staged.thread_bitmaps = [[row[0]]*len(elements) for row in base.thread_bitmaps]
+    size = (base.thumb_w*8, base.thumb_h)
+    staged.thumbnails = [render(points, extent, *size)]+[
+        render(element.points, extent, *size) for element in elements]
+
+    ends = [(element.points[0].tolist(), element.points[-1].tolist()) for element in elements]
+    pec = join_layers(base, [(staged, i, start, end) for i, (start, end) in enumerate(ends)],
+                      thumbnail=staged.thumbnails[0])
+    pec.width = int(max(0, extent[2])-min(0, extent[0]))
+    pec.height = int(max(0, extent[3])-min(0, extent[1]))
+    design.pecs = [pec]
+    design.n_pecs = 1
+    design.n_section_thumbnails = 0
+    return design
@@ -0,0 +1,291 @@
+###---------------------------------------------------------------------------------------------
+### normalize
+###
+### Brings the stitches of a design within what a machine sews well: stitches longer
+### than a maximum are split into equal stitches, runs of consecutive stitches shorter
+### than a minimum are merged, and travels by jumps longer than a threshold start with
+### a trim. The PEC layers and the CSewSeg blocks go through the same steps, one layer
+### or one chain of blocks sewn without a jump at a time, so memory use does not grow
+### with the size of the design.
+###---------------------------------------------------------------------------------------------
+
+import numpy as np
+from bisect     import bisect_left
+from sys        import argv, exit, stderr
+from os         import environ
+from os.path    import basename
+from argparse   import ArgumentParser, RawDescriptionHelpFormatter
+from pec        import Cmd
+from pesv6      import PESv6, CSewSeg, BLOCK_JUMP
+from stitches   import UNITS_PER_MM, layer_arrays
+
+description = "Splits long stitches, merges tiny ones and trims before long jumps in .pes files."
+
+## Stitches longer than this many mm are split.
+DEFAULT_MAX_LENGTH = 12.0
+
+## Consecutive stitches shorter than this many mm are merged.
+DEFAULT_MIN_LENGTH = 0.5
+
+## Travels by jumps longer than this many mm start with a trim.
+DEFAULT_TRIM_LENGTH = 5.0
+
+COMMANDS = {cmd.value: cmd for cmd in Cmd}
+
+
+def merge_starts(cmd, dx, dy, min_length):
+
+    """Returns the indexes of the moves that start the moves of merge_short, which
+    adds up the moves from each to the next."""
+
+    length = np.hypot(dx, dy)
+    short = (cmd == Cmd.STITCH) & (length < min_length)
+    if not short.any():
+        return np.arange(len(cmd))
+    first = np.flatnonzero(short & ~np.append(False, short[:-1])).tolist()
+    last = np.flatnonzero(short & ~np.append(short[1:], False)).tolist()
+    walked = np.append(0, np.cumsum(length)).tolist()
+    keep = ~short
+    ## Each merged stitch starts where the one before reaches min_length, which is
+    ## sequential, so the starts are found one merged stitch at a time. Stitch i goes
+    ## from walked[i] to walked[i+1].
+    for start, end in zip(first, last):
+        keep[start] = True
+        at = start
+        while True:
+            at = bisect_left(walked, walked[at]+min_length, at+1, end+1)
+            if at > end or walked[end+1]-walked[at] < min_length:
+                break
+            keep[at] = True
+    return np.flatnonzero(keep)
+
+
+def merge_short(cmd, dx, dy, min_length):
+
+    """Merges each run of consecutive stitches shorter than min_length into stitches
+    of at least min_length, following the run's path: a merged stitch ends with the
+    first stitch that brings it to min_length. What is left at the end of a run goes
+    into the stitch before it, and a run shorter than min_length becomes one stitch."""
+
+    starts = merge_starts(cmd, dx, dy, min_length)
+    if len(starts) == len(cmd):
+        return cmd, dx, dy
+    return cmd[starts], np.add.reduceat(dx, starts), np.add.reduceat(dy, starts)
+
+
+def split_counts(cmd, dx, dy, max_length):
+    ## The number of moves split_long makes of each move.
+    length = np.hypot(dx, dy)
+    n = np.where(cmd == Cmd.STITCH, np.maximum(1, np.ceil(length/max_length)), 1)
+    return n.astype(np.int64)
+
+
+def split_long(cmd, dx, dy, max_length):
+
+    """Splits each stitch longer than max_length into the fewest equal stitches that
+    are not, rounded so that they add up to the original stitch."""
+
+    n = split_counts(cmd, dx, dy, max_length)
+    if (n == 1).all():
+        return cmd, dx, dy
+    move = np.repeat(np.arange(len(n)), n)
+    k = np.arange(len(move))-(np.cumsum(n)-n)[move]+1
+    parts = n[move]
+    def steps(d):
+        d = d[move].astype(np.int64)
+        return (d*k//parts-d*(k-1)//parts).astype(dx.dtype)
+    return cmd[move], steps(dx), steps(dy)
+
+
+def trim_jumps(cmd, dx, dy, trim_length):
+
+    """Makes the first move of each travel by jumps longer than trim_length a trim,
+    unless the travel already has one. Changes cmd in place."""
+
+    travel = (cmd == Cmd.JUMP) | (cmd == Cmd.TRIM)
+    first = np.flatnonzero(travel & ~np.append(False, travel[:-1]))
+    if not len(first):
+        return cmd
+    starts = np.zeros(len(cmd), dtype=bool)
+    starts[first] = True
+    run = np.cumsum(starts)-1
+    lengths = np.bincount(run[travel], weights=np.hypot(dx, dy)[travel],
+                          minlength=len(first))
+    trims = np.bincount(run[cmd == Cmd.TRIM], minlength=len(first))
+    cmd[first[(lengths > trim_length) & (trims == 0)]] = Cmd.TRIM
+    return cmd
+
+
+def normalize_moves(cmd, dx, dy, /, max_length, min_length, trim_length=None):
+
+    """Returns the cmd, dx and dy arrays of the moves with short stitches merged, long
+    stitches split and, unless trim_length is None, trims added before long jumps.
+    Lengths are in PEC units."""
+
+    cmd, dx, dy = merge_short(cmd, dx, dy, min_length)
+    cmd, dx, dy = split_long(cmd, dx, dy, max_length)
+    if trim_length is not None:
+        cmd = trim_jumps(cmd.copy(), dx, dy, trim_length)
+    return cmd, dx, dy
+
+
+def normalize_layer(layer, /, max_length, min_length, trim_length):
+
+    """Returns the PEC layer normalized, or layer itself if nothing changes, so that
+    a layer read from a tracked source is still copied from it on put."""
+
+    cmd, dx, dy = layer_arrays(layer)
+    new_cmd, new_dx, new_dy = normalize_moves(cmd, dx, dy, max_length=max_length,
+                                              min_length=min_length,
+                                              trim_length=trim_length)
+    if (len(new_cmd) == len(cmd) and (new_cmd == cmd).all() and
+        (new_dx == dx).all() and (new_dy == dy).all()):
+        return layer
+    return [(COMMANDS[c], [x, y]) for c, x, y in
+            zip(new_cmd.tolist(), new_dx.tolist(), new_dy.tolist())]+layer[len(cmd):]
+
+
+def normalize_chain(chain, /, max_length, min_length):
+
+    """Returns the (y, x) coordinates of the sewn CSewSeg blocks of chain, each of
+    which starts where the one before ends, normalized as one run of stitches, the
+    way the PEC layer that sews them is. The run is split back into blocks where it
+    was split before, or at the end of the merged stitch that a split was merged
+    into. A block that does not change is returned as it is, others as NumPy arrays."""
+
+    points = [np.asarray(coordinates, dtype=np.int32).reshape(-1, 2) for coordinates in chain]
+    run = np.vstack(points[:1]+[p[1:] for p in points[1:]])
+    if len(run) < 2:
+        return list(chain)
+    dy, dx = np.diff(run, axis=0).T
+    cmd = np.full(len(dx), Cmd.STITCH, dtype=np.int32)
+    starts = merge_starts(cmd, dx, dy, min_length)
+    cmd, dx, dy = cmd[starts], np.add.reduceat(dx, starts), np.add.reduceat(dy, starts)
+    n = split_counts(cmd, dx, dy, max_length)
+    cmd, dx, dy = split_long(cmd, dx, dy, max_length)
+    new = np.cumsum(np.vstack((run[:1], np.column_stack((dy, dx)))), axis=0).astype(np.int16)
+
+    ## The index in run, then in new, of the point where each block starts, and of the
+    ## last point.
+    splits = np.append(0, np.cumsum([len(p)-1 for p in points]))
+    splits = np.append(0, np.cumsum(n))[np.searchsorted(starts, splits)]
+    blocks = []
+    for coordinates, old, start, end in zip(chain, points, splits[:-1], splits[1:]):
+        block = new[start:end+1]
+        blocks.append(coordinates if len(block) == len(old) and (block == old).all()
+                      else block)
+    return blocks
+
+
+def sewn_chains(design):
+
+    """Yields the chains of sewn CSewSeg blocks of design, as lists of (object, block
+    index) pairs, in which each block is sewn in the same thread as the one before
+    and starts where it ends. Like the PEC moves that sew them, a chain can go on
+    from one object to the next, but stops at a jump block or another object."""
+
+    chain = []
+    end = None
+    for obj in design.objects:
+        if not isinstance(obj, CSewSeg):
+            end = None
+            continue
+        for j, (stitch_type, thread_index, coordinates) in enumerate(obj.blocks):
+            if stitch_type == BLOCK_JUMP or not len(coordinates):
+                end = None
+                continue
+            if end != (thread_index, tuple(coordinates[0])) and chain:
+                yield chain
+                chain = []
+            chain.append((obj, j))
+            end = (thread_index, tuple(coordinates[-1]))
+    if chain:
+        yield chain
+
+
+def normalize(design, /, max_length=DEFAULT_MAX_LENGTH, min_length=DEFAULT_MIN_LENGTH,
+              trim_length=DEFAULT_TRIM_LENGTH):
+
+    """Normalizes the stitches of design in place, with lengths given in mm. A CSewSeg
+    object that changes gets a new list of blocks and is touched, so that a design
+    read with track=True writes it anew rather than copying its source. Returns the
+    number of PEC layers and CSewSeg blocks changed."""
+
+    max_length *= UNITS_PER_MM
+    min_length *= UNITS_PER_MM
+    trim_length *= UNITS_PER_MM
+    n_changed = 0
+    new_blocks = {}     # id of object -> (object, new list of blocks)
+    for chain in sewn_chains(design):
+        new = normalize_chain([obj.blocks[j][2] for obj, j in chain],
+                              max_length=max_length, min_length=min_length)
+        for (obj, j), coordinates in zip(chain, new):
+            if coordinates is not obj.blocks[j][2]:
+                blocks = new_blocks.setdefault(id(obj), (obj, list(obj.blocks)))[1]
+                blocks[j] = obj.blocks[j][:2]+(coordinates,)
+                n_changed += 1
+    for obj, blocks in new_blocks.values():
+        obj.blocks = blocks
+        design.touch(obj)
+    for pec in design.pecs:
+        layers = [normalize_layer(layer, max_length=max_length, min_length=min_length,
+                                  trim_length=trim_length) for layer in pec.layers]
+        if (changed := sum(a is not b for a, b in zip(layers, pec.layers))):
+            pec.layers = layers
+            n_changed += changed
+    return n_changed
+
+
+def main():
+
+    if (script := environ.get('RUNPYTHON')):
+        command = basename(script)
+    else:
+        command = 'python3 {}'.format(argv[0])
+
+    parser = ArgumentParser(prog=command, description=description,
+                            allow_abbrev=False,
+                            formatter_class=RawDescriptionHelpFormatter)
+
+    parser.add_argument('input', metavar='input', type=str,
+                        help="pathname of the .pes file to read")
+
+    parser.add_argument('output', metavar='output', type=str,
+                        help="pathname of the .pes file to write")
+
+    parser.add_argument('-s', '--max-length',
+                        dest='max_length',
+                        type=float,
+                        help="length in mm above which a stitch is split (default {:g})"
+                        .format(DEFAULT_MAX_LENGTH))
+
+    parser.add_argument('-m', '--min-length',
+                        dest='min_length',
+                        type=float,
+                        help="length in mm below which consecutive stitches are merged"
+                        " (default {:g})".format(DEFAULT_MIN_LENGTH))
+
+    parser.add_argument('-t', '--trim-length',
+                        dest='trim_length',
+                        type=float,
+                        help="length in mm of a jump above which a trim is added"
+                        " (default {:g})".format(DEFAULT_TRIM_LENGTH))
+
+    parser.set_defaults(max_length=DEFAULT_MAX_LENGTH, min_length=DEFAULT_MIN_LENGTH,
+                        trim_length=DEFAULT_TRIM_LENGTH)
+
+    args = parser.parse_args()
+
+    try:
+        design = PESv6().get(args.input, track=True)
+        n_changed = normalize(design, max_length=args.max_length,
+                              min_length=args.min_length, trim_length=args.trim_length)
+        design.put(args.output)
+    except Exception as e:
+        print('{:s}: {:s}: {}'.format(args.input, type(e).__name__, e), file=stderr)
+        exit(1)
+    print('{:s}: {:d} layers and blocks changed'.format(args.output, n_changed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+###---------------------------------------------------------------------------------------------
+### pack
+###
+### A single-file archive of many designs. Each design is stored as the segments of its
+### encoding: header, thread table, objects, and for each PEC its prologue, stitches and
+### thumbnails, then the tables that follow the PECs. Segments are stored once by
+### content, so thread tables and bitmaps shared between designs take no extra space.
+### A file that its design does not encode back to byte for byte is stored whole instead,
+### so that what is extracted is always the file that was added.
+###
+### The file is only ever appended to. Each batch of additions writes its new segments,
+### then an index of the new entries and segments that links to the previous index, then
+### a footer locating it. Entries are looked up in the index and their segments read
+### through a memory map.
+###---------------------------------------------------------------------------------------------
+
+import os
+import json
+import mmap
+import numpy as np
+from sys        import argv, exit, stderr
+from os         import environ
+from os.path    import basename, exists
+from hashlib    import sha1
+from struct     import Struct
+from argparse   import ArgumentParser, RawDescriptionHelpFormatter
+from pec        import Cmd, Bitmap, PEC_PROLOGUE, PEC_DIMENSIONS
+from pesv6      import PESv6, PES_File_Writer
+from anomalies  import Severity, Anomaly, FormatError
+from stitches   import pec_arrays
+from template   import encode
+from validate   import expand_paths
+
+description = "Adds .pes embroidery files to a pack, and lists or extracts them."
+
+MAGIC = b'PESPACK\x00'
+FOOTER = Struct('<QI8s')    # index offset, index length, magic
+FOOTER_MAGIC = b'PESPIDX\x00'
+
+## The header fields recorded in the index.
+HEADER_FIELDS = ('name', 'category', 'author', 'keywords', 'comments', 'hoop_size',
+                 'hoop_width', 'hoop_height', 'design_width', 'design_height')
+
+
+def segments(design):
+
+    """Returns the encoding of design, as put writes it, split into (kind, bytes)
+    segments."""
+
+    data = encode(design.put_file)
+
+    def prologue(file):
+        design.put_version(file)
+        design.put_header_prologue(file)
+    threads_start = len(encode(prologue))+3*2     # the three pattern counts
+
+    def threads(file):
+        file.put_uint16(len(design.threads))
+        for thread in design.threads:
+            thread.put(file)
+    threads_end = threads_start+len(encode(threads))
+
+    lengths = [('header', threads_start),
+               ('threads', threads_end-threads_start),
+               ('objects', design.pec_offset-threads_end)]
+    for pec in design.pecs:
+        lengths.append(('pec prologue', PEC_PROLOGUE.size))
+        lengths.append(('stitches', pec.thumbnail_offset-PEC_DIMENSIONS.size))
+        lengths.extend([('thumbnail', pec.thumb_w*pec.thumb_h)]*len(pec.thumbnails))
+    lengths.extend([('indexes', 1+len(pec.redundant_indexes)) for pec in design.pecs])
+    lengths.extend([('thread bitmaps', 6*sum(map(len, pec.thread_bitmaps)))
+                    for pec in design.pecs])
+    lengths.extend([('colors', 3*len(pec.layers)) for pec in design.pecs])
+    specs = [('thread specifications', 3*len(pec.threads)) for pec in design.pecs]
+    lengths.append(('section data', len(data)-sum(n for kind, n in lengths+specs)))
+    lengths.extend(specs)
+
+    result = []
+    offset = 0
+    for kind, n in lengths:
+        result.append((kind, data[offset:offset+n]))
+        offset += n
+    assert offset == len(data), 'segments do not cover the design'
+    return result
+
+
+class Pack:
+
+    def __init__(self, path):
+        self.path = path
+        if not exists(path):
+            with open(path, 'wb') as file:
+                file.write(MAGIC)
+        self.file = open(path, 'r+b')
+        self.map = None
+        self.entries = {}
+        self.blobs = {}
+        self.index = None
+        self.pending = []
+        self.new_blobs = {}
+        self.load()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def close(self):
+        self.flush()
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+
+    ## Reading
+
+    def load(self):
+        if self.map is not None:
+            self.map.close()
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise FormatError(Anomaly(0, Severity.FATAL,
+                                      '{:s} is not a pack'.format(self.path)))
+        self.index = self.find_footer()
+        chain = []
+        location = self.index
+        while location is not None:
+            chain.append(index := self.get_index(location))
+            location = index['previous']
+        self.entries = {}
+        self.blobs = {}
+        for index in reversed(chain):
+            self.blobs.update(index['blobs'])
+            for entry in index['entries']:
+                self.entries[entry['key']] = entry
+
+    def get_index(self, location):
+        offset, length = location
+        return json.loads(self.map[offset:offset+length])
+
+    def find_footer(self):
+        ## The footer is normally the last thing in the file. If an append was cut
+        ## short, the last complete footer before it is used.
+        end = len(self.map)
+        while (end := self.map.rfind(FOOTER_MAGIC, 0, end)) >= 0:
+            offset, length, magic = FOOTER.unpack_from(self.map,
+                                                       end+len(FOOTER_MAGIC)-FOOTER.size)
+            try:
+                self.get_index((offset, length))
+            except ValueError:
+                continue
+            return [offset, length]
+        return None
+
+    def read(self, key):
+
+        """Returns the bytes of the .pes file stored as key."""
+
+        return b''.join(self.map[offset:offset+length]
+                        for offset, length in (self.blobs[digest]
+                                               for digest in self.entries[key]['segments']))
+
+    def get(self, key, /, strict=True):
+
+        """Returns the design stored as key, read back with PESv6.get."""
+
+        return PESv6().get_bytes(self.read(key), strict=strict)
+
+    def export(self, key, path):
+        with PES_File_Writer(path) as file:
+            file.put_data(self.read(key))
+
+    def thumbnail(self, key, /, pec=0):
+
+        """Returns the main thumbnail of a PEC of the design stored as key, reading only
+        its bytes, unless the design was stored whole."""
+
+        if self.entries[key]['thumbnails'][pec] is None:
+            pec = self.get(key).pecs[pec]
+            return Bitmap(b''.join(scanline.to_bytes(pec.thumb_w, 'little')
+                                   for scanline in pec.thumbnails[0]),
+                          pec.thumb_w, pec.thumb_h)
+        digest, stride, height = self.entries[key]['thumbnails'][pec]
+        offset, length = self.blobs[digest]
+        return Bitmap(self.map[offset:offset+length], stride, height)
+
+    def find(self, predicate):
+        return (entry for entry in self.entries.values() if predicate(entry))
+
+
+    ## Appending
+
+    def put_blob(self, data):
+        digest = sha1(data).hexdigest()
+        if digest not in self.blobs:
+            self.file.seek(0, os.SEEK_END)
+            self.blobs[digest] = [self.file.tell(), len(data)]
+            self.new_blobs[digest] = self.blobs[digest]
+            self.file.write(data)
+        return digest
+
+    def add(self, key, design, /, data=None):
+
+        """Adds design to the pack as key, replacing any design already stored as key.
+        data is the .pes file design was read from, if any; it is stored as one
+        segment if design does not encode back to it. The segments are written now,
+        and the index when the pack is flushed or closed. Until then the design
+        cannot be read back."""
+
+        parts = segments(design)
+        if data is not None and b''.join(part for kind, part in parts) != data:
+            parts = [('file', bytes(data))]
+        digests = []
+        thumbnails = [None]*len(design.pecs)
+        pec = -1
+        for kind, part in parts:
+            digests.append(self.put_blob(part))
+            if kind == 'pec prologue':
+                pec += 1
+            elif kind == 'thumbnail' and thumbnails[pec] is None:
+                thumbnails[pec] = [digests[-1], design.pecs[pec].thumb_w,
+                                   design.pecs[pec].thumb_h]
+
+        entry = {field: getattr(design, field) for field in HEADER_FIELDS}
+        entry.update(key        = key,
+                     threads    = [[thread.brand, thread.code, thread.description,
+                                    '#{:02X}{:02X}{:02X}'.format(*thread.rgbx[:3])]
+                                   for thread in design.threads],
+                     layers     = [len(pec.layers) for pec in design.pecs],
+                     stitches   = [int(np.count_nonzero(pec_arrays(pec)[1] == Cmd.STITCH))
+                                   for pec in design.pecs],
+                     thumbnails = thumbnails,
+                     segments   = digests)
+        self.entries[key] = entry
+        self.pending.append(entry)
+
+    def flush(self):
+        if not self.pending:
+            return
+        index = json.dumps(dict(previous=self.index,
+                                blobs=self.new_blobs,
+                                entries=self.pending)).encode('utf8')
+        self.file.seek(0, os.SEEK_END)
+        self.index = [self.file.tell(), len(index)]
+        self.file.write(index)
+        self.file.write(FOOTER.pack(*self.index, FOOTER_MAGIC))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = []
+        self.new_blobs = {}
+        self.load()
+
+
+def main():
+
+    if (script := environ.get('RUNPYTHON')):
+        command = basename(script)
+    else:
+        command = 'python3 {}'.format(argv[0])
+
+    parser = ArgumentParser(prog=command, description=description,
+                            allow_abbrev=False,
+                            formatter_class=RawDescriptionHelpFormatter)
+
+    parser.add_argument('pack', type=str,
+                        help="pathname of the pack, created if it does not exist")
+
+    parser.add_argument('paths', metavar='path', type=str, nargs='*',
+                        help="pathname of a file, or of a directory to search for .pes files,"
+                        " to add")
+
+    parser.add_argument('-l', '--list',
+                        dest='list',
+                        action='store_true',
+                        help="list the designs in the pack")
+
+    parser.add_argument('-x', '--extract',
+                        dest='extract',
+                        type=str,
+                        nargs='+',
+                        help="keys of designs to write to .pes files in the current directory")
+
+    parser.set_defaults(list=False, extract=[])
+
+    args = parser.parse_args()
+
+    status = 0
+    with Pack(args.pack) as pack:
+        for path in expand_paths(args.paths):
+            try:
+                with open(path, 'rb') as file:
+                    data = file.read()
+                pack.add(path, PESv6().get_bytes(data), data=data)
+            except Exception as e:
+                print('{:s}: {:s}: {}'.format(path, type(e).__name__, e), file=stderr)
+                status = 1
+        pack.flush()
+        if args.list:
+            for key, entry in pack.entries.items():
+                print('{:s}: {!r:s}, {:d} threads, {:s} stitches'.format(
+                    key, entry['name'], len(entry['threads']),
+                    '+'.join(map(str, entry['stitches']))))
+        for key in args.extract:
+            pack.export(key, basename(key))
+    exit(status)
+
+
+if __name__ == '__main__':
+    main()
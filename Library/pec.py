@@ -1,6 +1,13 @@
+from sys import argv
+from os import environ
+from os.path import basename, splitext
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
 from enum import IntEnum
 from turds import twos_complement, sign_extend
-from binary_file import BinaryFileReader, BinaryFileWriter
+from binary_file import BinaryFileReader
+from buffered_file import BufferedFileWriter
+from schema import Field, Record
+from anomalies import Severity, Anomaly, FormatError
 
 class Cmd(IntEnum):
     STITCH = 0
@@ -10,10 +17,55 @@ class Cmd(IntEnum):
     STOP   = 15
 
 
+PEC_HEADER = Record(
+    Field('label_marker',       'text',         3,  const='LA:'),
+    Field('label',              'text',         16),
+    Field('carriage_return',    'uint8',            const=ord('\r')),
+    Field('unknown1',           'data',         11),
+    Field('unknown2',           'data',         3),
+    Field('thumb_w',            'uint8'),           # in bytes, typically 6
+    Field('thumb_h',            'uint8'),           # in scanlines, typically 38
+    Field('unknown3a',          'data',         1),
+    Field('unknown3b',          'data',         1),
+    Field('hoop_position',      'vector_int8',  2),
+    Field('unknown4a',          'data',         1),
+    Field('unknown4b',          'data',         4),
+    Field('unknown4c',          'data',         1),
+    Field('unknown4d',          'data',         2))
+
+PEC_INDEXES = Record(
+    Field('n_changes',          'uint8'),
+    Field('indexes',            'data',         463))
+
+PEC_DIMENSIONS = Record(
+    Field('unknown5',           'data',         2),
+    Field('thumbnail_offset',   'uint24',           fmt='0x{:06X}'),
+    Field('unknown6',           'data',         3),
+    Field('width',              'uint16'),
+    Field('height',             'uint16'),
+    Field('unknown_width',      'uint16'),
+    Field('unknown_height',     'uint16'))
+
+## The whole PEC prologue is fixed-width, so it is read and written in one call.
+PEC_PROLOGUE = PEC_HEADER + PEC_INDEXES + PEC_DIMENSIONS
+
+
 class PEC_File_Reader(BinaryFileReader):
 
-    def __init__(self, path):
+    ## In strict mode, the first error raises a FormatError. Otherwise every anomaly
+    ## is collected in self.anomalies and parsing carries on as well as it can.
+    def __init__(self, path, /, strict=True):
         super(__class__, self).__init__(path)
+        self.strict = strict
+        self.anomalies = []
+
+    def check(self, condition, message, /, severity=Severity.ERROR, offset=None):
+        if not condition:
+            anomaly = Anomaly(self.tell() if offset is None else offset, severity, message)
+            self.anomalies.append(anomaly)
+            if self.strict and severity >= Severity.ERROR:
+                raise FormatError(anomaly)
+        return condition
 
     def get_coord(self):
         b1 = self.get_uint8()
@@ -38,18 +90,67 @@ class PEC_File_Reader(BinaryFileReader):
                 args = [index[0]]
             else:
                 cmd2, value2 = self.get_coord()
-                assert cmd2 == cmd1, (
-                    "commands don't match ({} != {}) before 0x{:04X}"
-                    .format(cmd1, cmd2, self.tell()))
+                self.check(cmd2 == cmd1,
+                           "commands don't match ({} != {})".format(cmd1, cmd2))
                 cmd = Cmd(cmd1)
                 args = [value1, value2]
         return cmd, args
 
 
-class PEC_File_Writer(BinaryFileWriter):
+def decode_coord(data, i):
+    ## Returns cmd, value and the offset of the next byte, like get_coord.
+    b1 = data[i]
+    if b1&0x80 == 0:        # single-byte coordinate
+        return 0, sign_extend(b1, 7), i+1
+    w = (b1<<8) | data[i+1]
+    return (w>>12)&0x7, sign_extend(w&0xFFF, 12), i+2
 
-    def __init__(self, path):
-        super(__class__, self).__init__(path)
+
+def decode_stitches(data, n_layers):
+
+    """Decodes n_layers layers of stitch instructions from bytes, with the same results
+    as reading them one at a time with get_instruction. Returns the layers, the offset
+    of the end of each complete layer, the number of bytes used, and a list of
+    (offset, message) pairs describing any anomalies. Being a plain function of bytes,
+    it can run in a worker process."""
+
+    layers = []
+    ends = []
+    problems = []
+    i = 0
+    try:
+        for n in range(n_layers):
+            layers.append(layer := [])
+            while True:
+                if data[i] == 0xFF:         # end of coordinates
+                    layer.append((Cmd.STOP, []))
+                    i += 1
+                    break
+                cmd1, value1, i = decode_coord(data, i)
+                if cmd1 == 7 and value1&0xFFF == 0xEB0:
+                    layer.append((Cmd.COLOR, [data[i]]))  # alternates between 1 and 2
+                    i += 1
+                    break
+                if data[i] == 0xFF:
+                    problems.append((i, 'end of coordinates in the middle of a move'))
+                    return layers, ends, i, problems
+                cmd2, value2, i = decode_coord(data, i)
+                if cmd2 != cmd1:
+                    problems.append((i, "commands don't match ({} != {})".format(cmd1, cmd2)))
+                layer.append((Cmd(cmd1), [value1, value2]))
+            ends.append(i)
+    except IndexError:
+        problems.append((len(data), 'stitch data ends in layer {:d}'.format(n)))
+    except ValueError as e:
+        problems.append((i, str(e)))
+    return layers, ends, i, problems
+
+
+class PEC_File_Writer(BufferedFileWriter):
+
+    ## The file is assembled in memory and written in one go when the writer closes.
+    def __init__(self, path=None, /, atomic=True):
+        super(__class__, self).__init__(path, atomic=atomic)
 
     def put_coord(self, cmd, n):
         if -64 <= n < 64 and cmd == 0:
@@ -72,121 +173,157 @@ class PEC_File_Writer(BinaryFileWriter):
 
 
 
+class Bitmap:
+
+    ## A monochrome bitmap kept as the undecoded bytes from the file until its scanlines
+    ## are first accessed. Each scanline is an integer whose bit i is pixel i. It is
+    ## written back from the original bytes unless the scanlines have been decoded.
+
+    def __init__(self, data, stride, height):
+        assert len(data) == stride*height, (
+            'bitmap data is {:d} bytes instead of {:d}x{:d}'
+            .format(len(data), stride, height))
+        self.data = data
+        self.stride = stride
+        self.height = height
+        self._scanlines = None
+
+    @classmethod
+    def get(cls, file, stride, height):
+        return cls(file.get_data(stride*height), stride, height)
+
+    @property
+    def scanlines(self):
+        if self._scanlines is None:
+            self._scanlines = [int.from_bytes(self.data[i:i+self.stride], 'little')
+                               for i in range(0, len(self.data), self.stride)]
+        return self._scanlines
+
+    @scanlines.setter
+    def scanlines(self, scanlines):
+        self._scanlines = list(scanlines)
+
+    def __bytes__(self):
+        if self._scanlines is None:
+            return bytes(self.data)
+        return b''.join(scanline.to_bytes(self.stride, 'little')
+                        for scanline in self._scanlines)
+
+    def put(self, file):
+        file.put_data(bytes(self))
+
+
+
 class PEC:
 
-    def __init__(self):
-        pass
+    ## With a source, the layers and thumbnails read are recorded in it, and those
+    ## left unchanged are copied from it when the PEC is put.
+    def __init__(self, source=None):
+        self.source = source
+        self.read_colors = None
 
     def get(self, file):
+        thumbnails_start = self.get_prologue(file)
+        self.get_stitches(file, thumbnails_start)
+        self.get_thumbnails(file)
+        return self
 
-        ## Header
-        assert file.get_text(3) == 'LA:', (
-            'no PEC marker found before 0x{:04X}'
-            .format(file.tell()))
-        self.label          = file.get_text(16)
-        assert (ch := chr(file.get_uint8())) == '\r', (
-            'expected carriage return but got {!r:s} at end of PEC label before 0x{:04X}'
-            .format(ch, file.tell()))
-        self.unknown1       = file.get_data(11)
-        self.unknown2       = file.get_data(3)
-        self.thumb_w        = file.get_uint8()   # in bytes, typically 6
-        self.thumb_h        = file.get_uint8()   # in scanlines, typically 38 
-        self.unknown3a      = file.get_data(1)
-        self.unknown3b      = file.get_data(1)
-        self.hoop_position  = file.get_vector_int8(2)
-        self.unknown4a      = file.get_data(1)
-        self.unknown4b      = file.get_data(4)
-        self.unknown4c      = file.get_data(1)
-        self.unknown4d      = file.get_data(2)
-
-        ## Color Chart Indexes
-        self.n_changes      = file.get_uint8()
-        self.n_layers       = self.n_changes+1
-        self.indexes        = file.get_data(463)
-
-        ## Artwork Dimensions
-        self.unknown5            = file.get_data(2)
-        self.thumbnail_offset    = file.get_uint24()
-        self.unknown6            = file.get_data(3)
-        self.width               = file.get_uint16()
-        self.height              = file.get_uint16()
-        self.unknown_width       = file.get_uint16()
-        self.unknown_height      = file.get_uint16()
+    def get_prologue(self, file):
+        ## Header, Color Chart Indexes and Artwork Dimensions. Returns the offset of the
+        ## thumbnails, which is where the stitches should end.
+        PEC_PROLOGUE.get(file, self)
+        self.n_layers = self.n_changes+1
+        end_of_index_list = file.tell()-PEC_DIMENSIONS.size
+        return end_of_index_list+self.thumbnail_offset
 
-        ## Stitches
+    def get_stitches(self, file, thumbnails_start):
         self.layers = []
         for i in range(self.n_layers):
             self.layers.append(layer := [])
+            start = file.tell()
             while True:
                 cmd, args = file.get_instruction()
                 layer.append((cmd, args))
                 if cmd == Cmd.COLOR or cmd == Cmd.STOP:
                     break
-
-        ## Thumbnails
-        self.thumbnails = [[file.get_uint(self.thumb_w)
-                            for j in range(self.thumb_h)]
-                           for i in range(self.n_layers+1)]        
-
-        return self
+            if self.source:
+                self.source.record(layer, start, file.tell())
+        file.check(file.tell() == thumbnails_start,
+                   'thumbnail_offset 0x{:06X} does not match end of stitches'
+                   .format(self.thumbnail_offset), Severity.WARNING)
+
+    def get_thumbnails(self, file):
+        self.thumbnails = []
+        for i in range(self.n_layers+1):
+            start = file.tell()
+            self.thumbnails.append(thumbnail := [file.get_uint(self.thumb_w)
+                                                 for j in range(self.thumb_h)])
+            if self.source:
+                self.source.record(thumbnail, start, file.tell())
+
+
+    @staticmethod
+    def skip(file):
+        ## Moves past a PEC using only its prologue, without decoding the stitches.
+        prologue = PEC_PROLOGUE.get(file)
+        end_of_index_list = file.tell()-PEC_DIMENSIONS.size
+        n_thumbnails = prologue['n_changes']+2
+        file.seek(end_of_index_list + prologue['thumbnail_offset'] +
+                  n_thumbnails*prologue['thumb_w']*prologue['thumb_h'])
 
 
     def put(self, file):
 
-        ## Header
-        file.put_text          ('LA:')
-        file.put_text          (self.label)
-        file.put_uint8         (ord('\r'))
-        file.put_data          (self.unknown1)
-        file.put_data          (self.unknown2)
-        file.put_uint8         (self.thumb_w)
-        file.put_uint8         (self.thumb_h)
-        file.put_data          (self.unknown3a)
-        file.put_data          (self.unknown3b)
-        file.put_vector_int8   (self.hoop_position)
-        file.put_data          (self.unknown4a)
-        file.put_data          (self.unknown4b)
-        file.put_data          (self.unknown4c)
-        file.put_data          (self.unknown4d)
-        
-        ## Color Chart Indexes
-        file.put_uint8         (self.n_changes)
-        file.put_data          (self.indexes)
-
-        ## Artwork Dimensions
-        file.put_data          (self.unknown5)
-        file.put_uint24        (self.thumbnail_offset)
-        file.put_data          (self.unknown6)
-        file.put_uint16        (self.width)
-        file.put_uint16        (self.height)
-        file.put_uint16        (self.unknown_width)
-        file.put_uint16        (self.unknown_height)
+        ## Header, Color Chart Indexes and Artwork Dimensions. The thumbnail offset
+        ## is patched in once the length of the stitches is known.
+        self.n_layers = len(self.layers)
+        self.n_changes = self.n_layers-1
+        start = file.tell()
+        self.put_prologue(file)
+        end_of_index_list = file.tell()-PEC_DIMENSIONS.size
+        file.placeholder('thumbnail_offset', 3,
+                         offset=start+PEC_PROLOGUE.offset('thumbnail_offset'))
 
         ## Stitches
         for layer in self.layers:
-            for cmd, args in layer:
-                file.put_instruction(cmd, args)
+            self.put_layer(file, layer)
+        self.thumbnail_offset = file.tell()-end_of_index_list
+        file.patch('thumbnail_offset', self.thumbnail_offset)
+
+        self.put_thumbnails(file)
 
-        ## Thumbnails
+    def put_prologue(self, file):
+        PEC_PROLOGUE.put(file, self, indexes=self.file_colors()[0])
+
+    def put_layer(self, file, layer):
+        if self.source and (data := self.source.get(layer)) is not None:
+            file.put_data(data)
+            return
+        for cmd, args in layer:
+            file.put_instruction(cmd, args)
+
+    def put_thumbnails(self, file):
         for thumbnail in self.thumbnails:
+            if self.source and (data := self.source.get(thumbnail)) is not None:
+                file.put_data(data)
+                continue
             for scanline in thumbnail:
                 file.put_uint(self.thumb_w, scanline)
 
 
     def get_redundant_indexes(self, file):
-        assert (n_changes := file.get_uint8()) == self.n_changes, (
-            'Different number of changes ({:d} versus {:d}) before 0x{:04X}'
-            .format(n_changes, self.n_changes, file.tell()))
+        n_changes = file.get_uint8()
+        file.check(n_changes == self.n_changes,
+                   'different number of changes ({:d} versus {:d})'
+                   .format(n_changes, self.n_changes))
         self.redundant_indexes = file.get_data(127)
-        assert all(index == redundant_index
-                   for index, redundant_index in zip(self.indexes[:self.n_changes],
-                                                     self.redundant_indexes[:self.n_changes]))
-                                                         
-                   
+        file.check(self.indexes[:self.n_changes] == self.redundant_indexes[:self.n_changes],
+                   'redundant indexes do not match indexes')
+
 
     def put_redundant_indexes(self, file):
         file.put_uint8 (self.n_changes)
-        file.put_data  (self.redundant_indexes)
+        file.put_data  (self.file_colors()[1])
 
 
     def get_thread_bitmaps(self, file):
@@ -208,9 +345,16 @@ class PEC:
             self.rgbs.append(tuple(file.get_data(3)))
 
     def put_thread_colors(self, file):
-        for rgb in self.rgbs:
+        for rgb in self.file_colors()[2]:
             file.put_data(bytes(rgb))
 
+    def layer_rgb(self, i):
+        ## The color of layer i, once remapped.
+        return tuple(self.rgbs[self.indexes[i]])
+
+    def layer_rgbs(self):
+        return [self.layer_rgb(i) for i in range(len(self.layers))]
+
 
     def get_thread_specifications(self, file):
         self.threads = [(file.get_uint8(), file.get_uint16()) # type, code
@@ -224,17 +368,114 @@ class PEC:
 
     def remap(self):
 
-        unique_rgbs = []
-        for rgb in self.rgbs:
-            if rgb not in unique_rgbs:
-                unique_rgbs.append(rgb)
-        self.rgbs = unique_rgbs
-
-        mapping = {}
-        index = 0
-        for old_index in self.indexes:
-            if old_index not in mapping:
-                mapping[old_index] = index
-                index += 1
-        self.indexes = bytes(mapping[color] for color in self.indexes)
-        self.redundant_indexes = bytes(mapping[color] for color in self.redundant_indexes)
+        ## As read, the indexes are color chart indexes and rgbs holds the color of each
+        ## layer. Both are renumbered by color, so that rgbs holds each color once and
+        ## the color of layer i is rgbs[indexes[i]]; the bytes past the layers are left
+        ## as they are. What was read is kept for file_colors.
+
+        read = (self.indexes, self.redundant_indexes, self.rgbs)
+        self.rgbs = list(dict.fromkeys(self.rgbs))
+        layers = bytes(self.rgbs.index(rgb) for rgb in read[2])
+        self.indexes = layers+self.indexes[len(layers):]
+        self.redundant_indexes = (layers+self.redundant_indexes[len(layers):]
+                                  )[:len(self.redundant_indexes)]
+        self.read_colors = (self.colors_state(), read)
+
+    def colors_state(self):
+        return (len(self.layers), bytes(self.indexes), bytes(self.redundant_indexes),
+                [tuple(rgb) for rgb in self.rgbs])
+
+    def file_colors(self):
+
+        """Returns the indexes, the redundant indexes and the color of each layer to
+        write: those read, if they are unchanged since remap, so that a design is
+        written back as it was read, else the remapped ones."""
+
+        if self.read_colors and self.read_colors[0] == self.colors_state():
+            return self.read_colors[1]
+        return self.indexes, self.redundant_indexes, self.layer_rgbs()
+
+
+
+class PECv1(PEC):
+
+    ## A standalone .pec file is the magic number and version followed by a single PEC,
+    ## laid out exactly as the first PEC embedded in a PES file. The thread indexes are
+    ## left as they are in the file, i.e. not remapped as they are by PESv6.
+
+    def get_version(self, file):
+        version = file.get_text(8)
+        file.check(version == '#PEC0001', 'unsupported version {!r:s}'.format(version))
+
+    def put_version(self, file):
+        file.put_text('#PEC0001')
+
+    def get(self, path, /, strict=True):
+        with PEC_File_Reader(path, strict=strict) as file:
+            self.anomalies = file.anomalies
+            return self.get_file(file)
+
+    def get_file(self, file):
+        self.get_version(file)
+        return PEC.get(self, file)
+
+    def put(self, path):
+        with PEC_File_Writer(path) as file:
+            self.put_file(file)
+
+    def put_file(self, file):
+        self.put_version(file)
+        PEC.put(self, file)
+
+    def get_from_pes(self, path, /, index=0, strict=True):
+
+        """Reads the PEC embedded in a PES file by seeking straight to pec_offset, which
+        is the first field after the magic number and version. The PES objects are not
+        read at all, and any PECs before the one at index are skipped over without
+        decoding their stitches."""
+
+        with PEC_File_Reader(path, strict=strict) as file:
+            self.anomalies = file.anomalies
+            magic = file.get_text(4)
+            file.check(magic == '#PES', 'not a PES file (magic={!r:s})'.format(magic))
+            file.get_text(4)
+            file.seek(file.get_uint32())
+            for i in range(index):
+                PEC.skip(file)
+            return PEC.get(self, file)
+
+
+description = "Extracts the PEC from .pes files into standalone .pec files."
+
+def main():
+
+    if (script := environ.get('RUNPYTHON')):
+        command = basename(script)
+    else:
+        command = 'python3 {}'.format(argv[0])
+
+    parser = ArgumentParser(prog=command, description=description,
+                            allow_abbrev=False,
+                            formatter_class=RawDescriptionHelpFormatter)
+
+    parser.add_argument('paths', metavar='path', type=str, nargs='+',
+                        help="pathname of a .pes file")
+
+    parser.add_argument('-i', '--index',
+                        dest='index',
+                        type=int,
+                        help="index of the PEC to extract from multi-hoop designs")
+
+    parser.set_defaults(index=0)
+
+    args = parser.parse_args()
+
+    for path in args.paths:
+        base, ext = splitext(path)
+        if args.index:
+            base += '_{:d}'.format(args.index)
+        PECv1().get_from_pes(path, index=args.index).put(base+'.pec')
+
+
+if __name__ == '__main__':
+    main()
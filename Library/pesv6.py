@@ -1,6 +1,13 @@
+import re
 from enum import Enum
+from struct import Struct
+from concurrent.futures import Executor, ProcessPoolExecutor
 from binary_file import BinaryFileReader, BinaryFileWriter
-from pec import PEC_File_Reader, PEC_File_Writer, PEC
+from buffered_file import BufferedFileReader
+from pec import PEC_File_Reader, PEC_File_Writer, PEC, Bitmap, decode_stitches
+from schema import Field, Record
+from anomalies import Severity
+from source import Source
 
 class HOOP(Enum):
     SIZE_100x100 = 0
@@ -9,28 +16,148 @@ class HOOP(Enum):
     SIZE_272x408 = 3
 
 
+PES_HEADER_PROLOGUE = Record(
+    Field('pec_offset',                 'uint32',           fmt='hex'),
+    Field('n_pecs',                     'uint16'),
+    Field('hoop_size',                  'text',         2),
+    Field('name',                       'utf8'),
+    Field('category',                   'utf8'),
+    Field('author',                     'utf8'),
+    Field('keywords',                   'utf8'),
+    Field('comments',                   'utf8'),
+    Field('optimize_hoop_change',       'bool16'),
+    Field('custom_design_page',         'bool16'),
+    Field('hoop_width',                 'uint16'),
+    Field('hoop_height',                'uint16'),
+    Field('design_page_area',           'uint16'),      # doc says "hoop rotation (1=90 degrees)"
+    Field('design_width',               'uint16'),
+    Field('design_height',              'uint16'),
+    Field('section_width',              'uint16'),
+    Field('section_height',             'uint16'),
+    Field('unknown1',                   'uint16'),      # doc: must be in same ranges as section width & height
+    Field('background_color',           'uint16'),
+    Field('foreground_color',           'uint16'),
+    Field('show_grid',                  'bool16'),
+    Field('with_axes',                  'bool16'),
+    Field('snap_to_grid',               'bool16'),
+    Field('grid_interval',              'uint16'),
+    Field('unknown2',                   'data',         2),
+    Field('optimize_entry_exit_point',  'bool16'),
+    Field('from_image',                 'utf8'),
+    Field('transform',                  'vector_float32', 6))
+
+PES_HEADER_EPILOGUE = Record(
+    Field('n_objects',                  'uint16'),
+    Field('end_marker',                 'uint32',           fmt='hex', const=0x0000FFFF))
+
+PES_THREAD = Record(
+    Field('code',                       'tagged_string'),
+    Field('rgbx',                       'data',         4),
+    Field('color_type',                 'uint32'),
+    Field('description',                'tagged_string'),
+    Field('brand',                      'tagged_string'),
+    Field('chart',                      'tagged_string'))  # chart name?
+
+PES_OBJECT_HEADER = Record(
+    Field('extents1',                   'vector_int16', 4),
+    Field('extents2',                   'vector_int16', 4),
+    Field('transform_matrix',           'vector_float32', 6),
+    Field('unknown1',                   'data',         2),
+    Field('x_translation',              'int16'),
+    Field('y_translation',              'int16'),
+    Field('width',                      'int16'),
+    Field('height',                     'int16'),
+    Field('unknown2',                   'data',         8),
+    Field('n_blocks',                   'uint16'),
+    Field('end_marker',                 'uint32',           fmt='hex', const=0x0000FFFF))
+
+CSEWSEG_BLOCK_HEADER = Record(
+    Field('stitch_type',                'uint16'),
+    Field('thread_index',               'uint16'),
+    Field('n_coordinates',              'uint16'))
+
+## CSewSeg block types: sewn, or a move to where the next sewn block starts.
+BLOCK_STITCH = 0
+BLOCK_JUMP = 1
+
+PES_PHYSICAL_DIMENSIONS = Record(
+    Field('physical_width',             'int16'),
+    Field('physical_height',            'int16'))
+
+## Bitmap sizes in the section data, as (bytes per scanline, scanlines).
+SECTION_THUMBNAIL_SIZE  = (11, 69)
+HUGE_THUMBNAIL_SIZE     = (30, 456)
+
+COORDINATE = Struct('<hh')
+COLOR = Struct('<HH')     # block_index, thread_index
+
+IDENTITY_TRANSFORM = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+
+## A tagged string is this marker, a uint8 count of UTF-16 code units and the code units,
+## little-endian, with characters outside the BMP as surrogate pairs.
+TAGGED_STRING_MARKER = 0xFFFEFF
+TAGGED_STRING_ENCODING = 'utf-16-le'
+
+
+def decode_tagged_string(data):
+    ## Unpaired surrogates are kept as they are, so that every string read is written
+    ## back the same.
+    return data.decode(TAGGED_STRING_ENCODING, 'surrogatepass')
+
+
+def encode_tagged_string(string):
+    return string.encode(TAGGED_STRING_ENCODING, 'surrogatepass')
+
+
 
 class PES_File_Reader(PEC_File_Reader):
 
-    def __init__(self, path):
-        super(__class__, self).__init__(path)
+    def __init__(self, path, /, strict=True):
+        super(__class__, self).__init__(path, strict=strict)
 
     def get_tagged_string(self):
-        assert self.get_uint24() == 0xFFFEFF
+        tag = self.get_uint24()
+        self.check(tag == TAGGED_STRING_MARKER, 'bad tagged string marker 0x{:06X}'.format(tag))
         length = self.get_uint8()
-        return(''.join(chr(self.get_uint16()) for _ in range(length)))  # unicode?
+        return decode_tagged_string(self.get_data(2*length))
+
+    def get_utf8(self, /, length_size=1):
+        ## Bytes that are not UTF-8 are decoded to lone surrogates, which put_utf8
+        ## encodes back to the same bytes.
+        data = self.get_data(self.get_uint(length_size))
+        try:
+            return data.decode('utf-8')
+        except UnicodeDecodeError:
+            self.check(False, 'string {!r} is not UTF-8'.format(data), Severity.WARNING)
+            return data.decode('utf-8', 'surrogateescape')
+
+
+class PES_Buffer_Reader(BufferedFileReader, PES_File_Reader):
+
+    ## A PES_File_Reader over bytes in memory rather than a file. BufferedFileReader
+    ## provides the fields; the checks and the PEC and PES fields come from
+    ## PES_File_Reader.
+    def __init__(self, data, /, strict=True):
+        BufferedFileReader.__init__(self, data)
+        self.strict = strict
+        self.anomalies = []
+
+    get_utf8 = PES_File_Reader.get_utf8
 
 
 class PES_File_Writer(PEC_File_Writer):
 
-    def __init__(self, path):
-        super(__class__, self).__init__(path)
+    def __init__(self, path=None, /, atomic=True):
+        super(__class__, self).__init__(path, atomic=atomic)
 
     def put_tagged_string(self, string):
-        self.put_uint24(0xFFFEFF)
-        self.put_uint8(len(string))
-        for chr in string:
-            self.put_uint16(ord(chr))
+        data = encode_tagged_string(string)
+        if len(data) > 2*0xFF:
+            raise ValueError('tagged string {!r:s} is longer than 255 UTF-16 code units'
+                             .format(string))
+        self.put_uint24(TAGGED_STRING_MARKER)
+        self.put_uint8(len(data)//2)
+        self.put_data(data)
 
 
 class Thread:
@@ -75,106 +202,161 @@ class Thread:
             self.chart          == other.chart))
 
     def get(self, file):
-        self.code = file.get_tagged_string()
-        self.rgbx           = file.get_data(4)
-        self.color_type     = file.get_uint32()
-        self.description    = file.get_tagged_string()
-        self.brand   = file.get_tagged_string()
-        self.chart   = file.get_tagged_string() # chart name?
+        PES_THREAD.get(file, self)
         return self
 
     def put(self, file):
-        file.put_tagged_string(self.code)
-        file.put_data(self.rgbx)
-        file.put_uint32(self.color_type)
-        file.put_tagged_string(self.description)
-        file.put_tagged_string(self.brand)
-        file.put_tagged_string(self.chart) # chart name?
+        PES_THREAD.put(file, self)
+
 
 
+## Maps the class name that follows each object header to the class that handles the
+## object's data. Handlers are added with the register_object_type decorator.
+OBJECT_TYPES = {}
+
+def register_object_type(cls):
+    OBJECT_TYPES[cls.class_name] = cls
+    return cls
+
 
 class PES_Object:
 
     def __init__(self):
         pass
 
-    def get(self, file):
-        self.extents1 = file.get_vector_int16(4)
-        self.extents2 = file.get_vector_int16(4)
-        self.transform_matrix = file.get_vector_float32(6)
-        self.unknown1 = file.get_data(2)
-        self.x_translation = file.get_int16()
-        self.y_translation = file.get_int16()
-        self.width = file.get_int16()
-        self.height = file.get_int16()
-        self.unknown2 = file.get_data(8)
-        self.n_blocks = file.get_uint16()
-        assert file.get_uint32() == 0x0000FFFF
-        self.__class__ = eval(file.get_utf8(length_size=2)) # make a young girl squeal
-        return self.get(file)
+    ## Reads the common object header and the class name, then switches to the handler
+    ## registered for that name, or to RawObject if there is none, and reads the rest.
+    ## end is the offset the object's data cannot extend beyond, normally pec_offset.
+    def get(self, file, /, end):
+        PES_OBJECT_HEADER.get(file, self)
+        class_name = file.get_data(file.get_uint16())
+        if (cls := OBJECT_TYPES.get(class_name)) is None:
+            cls, self.class_name = RawObject, class_name
+        self.__class__ = cls
+        return self.get(file, end=end)
+
 
+    def put(self, file):
+        PES_OBJECT_HEADER.put(file, self)
+        file.put_uint16(len(self.class_name))
+        file.put_data(self.class_name)
+
+
+class RawObject(PES_Object):
+
+    ## An object whose data is not parsed. The length of an object's data is not
+    ## recorded in the file, so the data is taken to run up to the header of the next
+    ## object, identified by its end marker and class name, or up to end. The data is
+    ## read and searched in chunks that double in size, so finding the next header
+    ## takes time in proportion to the object rather than to the rest of the file.
+    END_MARKER = re.compile(rb'\xFF\xFF\x00\x00([\x01-\x40])\x00')
+    CLASS_NAME = re.compile(rb'C[0-9A-Za-z_]+')
+    EXTENTS = Struct('<8h')
+    CHUNK_SIZE = 0x1000
+
+    def is_header(self, data, match):
+        ## Whether the end marker match is that of an object header: it must have room
+        ## for the header before it and be followed by a class name. Unless the class is
+        ## registered, the extents must also be ordered, which stitch data rarely is.
+        header_start = match.start()-(PES_OBJECT_HEADER.size-4)
+        name = bytes(data[match.end():match.end()+match[1][0]])
+        if header_start < 0 or not self.CLASS_NAME.fullmatch(name):
+            return False
+        if name in OBJECT_TYPES:
+            return True
+        left1, top1, right1, bottom1, left2, top2, right2, bottom2 = \
+            self.EXTENTS.unpack_from(data, header_start)
+        return left1 <= right1 and top1 <= bottom1 and left2 <= right2 and top2 <= bottom2
+
+    def find_header(self, data, searched, complete):
+        ## The offset of the first object header in data at or after searched, or None,
+        ## and where to search from once more of the data has been read.
+        for match in self.END_MARKER.finditer(data, searched):
+            if not complete and match.end()+match[1][0] > len(data):
+                return None, match.start()      # the class name is cut off
+            if self.is_header(data, match):
+                return match.start()-(PES_OBJECT_HEADER.size-4), None
+        return None, max(searched, len(data)-5)
+
+    def get(self, file, /, end):
+        start = file.tell()
+        data = bytearray()
+        searched = 0
+        while start+len(data) < end:
+            data += file.get_data(min(max(len(data), self.CHUNK_SIZE), end-start-len(data)))
+            header_start, searched = self.find_header(data, searched, start+len(data) == end)
+            if header_start is not None:
+                del data[header_start:]
+                file.seek(start+header_start)
+                break
+        data = bytes(data)
+        file.check(self.class_name in OBJECT_TYPES,
+                   'unknown object type {!r:s} kept as {:d} raw bytes'
+                   .format(self.class_name, len(data)), Severity.INFO, start)
+        self.data = data
+        return self
 
     def put(self, file):
-        file.put_vector_int16(self.extents1)
-        file.put_vector_int16(self.extents2)
-        file.put_vector_float32(self.transform_matrix)
-        file.put_data(self.unknown1)
-        file.put_int16(self.x_translation)
-        file.put_int16(self.y_translation)
-        file.put_int16(self.width)
-        file.put_int16(self.height)
-        file.put_data(self.unknown2)
-        file.put_uint16(self.n_blocks)
-        file.put_uint32(0x0000FFFF)
-        file.put_utf8(self.__class__.__name__, length_size=2)
+        super().put(file)
+        file.put_data(self.data)
+
 
+## The layouts of these are not known yet, so they are passed through as raw bytes.
 
+@register_object_type
+class CEmbRect(RawObject):
+    class_name = b'CEmbRect'
+
+@register_object_type
+class CEmbCirc(RawObject):
+    class_name = b'CEmbCirc'
+
+
+@register_object_type
 class CSewSeg(PES_Object):
 
-    def __init__(self, header):
-        super(__class__, self).__init__(header)
-        
+    class_name = b'CSewSeg'
+
     def get_stitch_list(self, file):
         self.blocks = []
         for i in range(self.n_blocks):
-            stitch_type = file.get_uint16()
-            thread_index = file.get_uint16()
-            n_coordinates = file.get_uint16()
-            coordinates = [file.get_vector_int16(2) for _ in range(n_coordinates)]
-            self.blocks.append((stitch_type, thread_index, coordinates))
+            header = CSEWSEG_BLOCK_HEADER.get(file)
+            data = file.get_data(header['n_coordinates']*COORDINATE.size)
+            coordinates = list(COORDINATE.iter_unpack(data))
+            self.blocks.append((header['stitch_type'], header['thread_index'], coordinates))
             if i < self.n_blocks-1:
-                assert file.get_uint16() == 0x8003 # continuation code
+                code = file.get_uint16()
+                file.check(code == 0x8003, # continuation code
+                           'bad continuation code 0x{:04X}'.format(code))
 
     def put_stitch_list(self, file):
-        for j, block in enumerate(self.blocks):
-            file.put_uint16(block[0]) # stitch_type
-            file.put_uint16(block[1]) # thread_index
-            coordinates = block[2]
-            file.put_uint16(len(coordinates))
-            for coordinate in coordinates:
-                file.put_vector_int16(coordinate)
+        for j, (stitch_type, thread_index, coordinates) in enumerate(self.blocks):
+            CSEWSEG_BLOCK_HEADER.put(file, None,
+                                     stitch_type=stitch_type,
+                                     thread_index=thread_index,
+                                     n_coordinates=len(coordinates))
+            if hasattr(coordinates, 'tobytes'):     # a NumPy array of coordinate pairs
+                file.put_data(coordinates.astype('<i2').tobytes())
+            else:
+                file.put_data(b''.join(COORDINATE.pack(*coordinate)
+                                       for coordinate in coordinates))
             if j < len(self.blocks)-1:
                 file.put_uint16(0x8003) # continuation code
 
     def get_color_list(self, file):
         n_colors = file.get_uint16()
-        self.colors = []
-        for i in range(n_colors):
-            block_index = file.get_uint16()
-            thread_index = file.get_uint16()
-            self.colors.append((block_index, thread_index))
+        self.colors = list(COLOR.iter_unpack(file.get_data(n_colors*COLOR.size)))
 
     def put_color_list(self, file):
         file.put_uint16(len(self.colors))
-        for color in self.colors:
-            file.put_uint16(color[0]) # block_index
-            file.put_uint16(color[1]) # thread_index
+        file.put_data(b''.join(COLOR.pack(*color) for color in self.colors))
 
     def get_excess(self, file):
-        assert file.get_uint32() == 0 and file.get_uint32() == 0
+        excess = (file.get_uint32(), file.get_uint32())
+        file.check(excess == (0, 0), 'unexpected excess {}'.format(excess))
         for i in range(len(self.colors)):
-            assert file.get_uint32() == 0
-            assert file.get_uint32() == i
+            excess = (file.get_uint32(), file.get_uint32())
+            file.check(excess == (0, i), 'unexpected excess {} for color {:d}'.format(excess, i))
 
     def put_excess(self, file):
         file.put_uint32(0)
@@ -183,13 +365,14 @@ class CSewSeg(PES_Object):
             file.put_uint32(0)
             file.put_uint32(i)
 
-    def get(self, file):
+    def get(self, file, /, end=None):
         self.get_stitch_list(file)
         self.get_color_list(file)
         self.get_excess(file)
         return self
 
     def put(self, file):
+        self.n_blocks = len(self.blocks)
         super().put(file)
         self.put_stitch_list(file)
         self.put_color_list(file)
@@ -197,91 +380,51 @@ class CSewSeg(PES_Object):
 
 
 
+## The process pools PECs are decoded in, by number of workers, kept for reuse.
+WORKER_POOLS = {}
+
+def worker_pool(workers):
+    if isinstance(workers, Executor):
+        return workers
+    if (pool := WORKER_POOLS.get(workers)) is None:
+        pool = WORKER_POOLS[workers] = ProcessPoolExecutor(workers)
+    return pool
+
+
 class PESv6:
 
     def __init__(self):
-        pass
+        self.source = None
 
     def get_version(self, file):
-        assert file.get_text(8) == '#PES0060'
+        version = file.get_text(8)
+        file.check(version == '#PES0060', 'unsupported version {!r:s}'.format(version))
 
     def put_version(self, file):
         file.put_text('#PES0060')
 
     def get_header_prologue(self, file):
-        self.pec_offset                  = file.get_uint32()
-        self.n_pecs                      = file.get_uint16()
-        self.hoop_size                   = file.get_text(2)
-        self.name                        = file.get_utf8()
-        self.category                    = file.get_utf8()
-        self.author                      = file.get_utf8()
-        self.keywords                    = file.get_utf8()
-        self.comments                    = file.get_utf8()
-        self.optimize_hoop_change        = file.get_bool16()
-        self.custom_design_page          = file.get_bool16()
-        self.hoop_width                  = file.get_uint16()
-        self.hoop_height                 = file.get_uint16()
-        self.design_page_area            = file.get_uint16()
-        self.design_width                = file.get_uint16()
-        self.design_height               = file.get_uint16()
-        self.section_width               = file.get_uint16()
-        self.section_height              = file.get_uint16()
-        self.unknown1                    = file.get_uint16()
-        self.background_color            = file.get_uint16()
-        self.foreground_color            = file.get_uint16()
-        self.show_grid                   = file.get_bool16()
-        self.with_axes                   = file.get_bool16()
-        self.snap_to_grid                = file.get_bool16()
-        self.grid_interval               = file.get_uint16()
-        self.unknown2                    = file.get_data(2)
-        self.optimize_entry_exit_point   = file.get_bool16()
-        self.from_image                  = file.get_utf8()
-        self.transform                   = file.get_vector_float32(6)
+        PES_HEADER_PROLOGUE.get(file, self)
 
     def put_header_prologue(self, file):
-        file.put_uint32              (self.pec_offset)
-        file.put_uint16              (self.n_pecs)
-        file.put_text                (self.hoop_size)
-        file.put_utf8                (self.name)
-        file.put_utf8                (self.category)
-        file.put_utf8                (self.author)
-        file.put_utf8                (self.keywords)
-        file.put_utf8                (self.comments)
-        file.put_bool16              (self.optimize_hoop_change)
-        file.put_bool16              (self.custom_design_page)
-        file.put_uint16              (self.hoop_width)
-        file.put_uint16              (self.hoop_height)
-        file.put_uint16              (self.design_page_area)
-        file.put_uint16              (self.design_width)
-        file.put_uint16              (self.design_height)
-        file.put_uint16              (self.section_width)
-        file.put_uint16              (self.section_height)
-        file.put_uint16              (self.unknown1)
-        file.put_uint16              (self.background_color)
-        file.put_uint16              (self.foreground_color)
-        file.put_bool16              (self.show_grid)
-        file.put_bool16              (self.with_axes)
-        file.put_bool16              (self.snap_to_grid)
-        file.put_uint16              (self.grid_interval)
-        file.put_data                (self.unknown2)
-        file.put_bool16              (self.optimize_entry_exit_point)
-        file.put_utf8                (self.from_image)
-        file.put_vector_float32      ([1.0, 0.0, 0.0, 1.0, 0.0, 0.0])
+        ## pec_offset is patched in when the PECs are reached.
+        file.placeholder('pec_offset', 4,
+                         offset=file.tell()+PES_HEADER_PROLOGUE.offset('pec_offset'))
+        PES_HEADER_PROLOGUE.put(file, self, n_pecs=len(self.pecs),
+                                transform=IDENTITY_TRANSFORM)
 
     def get_header_epilogue(self, file):
-        n_objects = file.get_uint16()
-        assert file.get_uint32() == 0x0000FFFF  # end of header marker
-        return n_objects
+        return PES_HEADER_EPILOGUE.get(file)['n_objects']
 
     def put_header_epilogue(self, file):
-        file.put_uint16(len(self.objects))
-        file.put_uint32(0x0000FFFF)             # end of header marker
+        PES_HEADER_EPILOGUE.put(file, self, n_objects=len(self.objects))
 
     def get_header(self, file):
         self.get_header_prologue(file)
-        assert (n_fill_patterns    := file.get_uint16()) == 0
-        assert (n_motif_patterns   := file.get_uint16()) == 0
-        assert (n_feather_patterns := file.get_uint16()) == 0
+        for kind in ('fill', 'motif', 'feather'):
+            n_patterns = file.get_uint16()
+            file.check(n_patterns == 0,
+                       '{:d} {:s} patterns are not supported'.format(n_patterns, kind))
         n_threads = file.get_uint16()
         self.threads = [Thread().get(file) for i in range(n_threads)]
         return self.get_header_epilogue(file)
@@ -297,87 +440,189 @@ class PESv6:
         self.put_header_epilogue(file)
 
     def get_cembone_tag(self, file):
-        assert file.get_utf8(length_size=2) == 'CEmbOne'
+        tag = file.get_utf8(length_size=2)
+        file.check(tag == 'CEmbOne', 'expected CEmbOne but got {!r:s}'.format(tag))
 
     def put_cembone_tag(self, file):
         file.put_utf8('CEmbOne', length_size=2)
 
     def get_object(self, file):
-        return PES_Object().get(file)
+        start = file.tell()
+        obj = PES_Object().get(file, end=self.pec_offset)
+        if self.source:
+            self.source.record(obj, start, file.tell())
+        return obj
 
     def put_object(self, file, obj):
-        obj.put(file)
+        if self.source and (data := self.source.get(obj)) is not None:
+            file.put_data(data)
+        else:
+            obj.put(file)
+
 
 
+    ## Designs spread across several hoops have a thumbnail and a color for each
+    ## section, then a thumbnail, the physical dimensions and a huge thumbnail of the
+    ## whole design. The bitmaps are only decoded when their scanlines are used.
 
     def get_section_data(self, file):
         self.n_section_thumbnails = file.get_uint16()
         if self.n_section_thumbnails == 0:
             return
-        pass  # TODO: complete this method
-        
+        self.section_thumbnails = [Bitmap.get(file, *SECTION_THUMBNAIL_SIZE)
+                                   for i in range(self.n_section_thumbnails)]
+        self.section_rgbs = [tuple(file.get_data(3))
+                             for i in range(self.n_section_thumbnails)]
+        self.full_thumbnail = Bitmap.get(file, *SECTION_THUMBNAIL_SIZE)
+        PES_PHYSICAL_DIMENSIONS.get(file, self)
+        self.huge_thumbnail = Bitmap.get(file, *HUGE_THUMBNAIL_SIZE)
+
     def put_section_data(self, file):
         file.put_uint16(self.n_section_thumbnails)
-        pass  # TODO: complete this method
-
-
-
-    def get(self, path):
-
-        with PES_File_Reader(path) as file:
-
-            self.get_version(file)
-            n_objects = self.get_header(file)
-            self.get_cembone_tag(file)
-            self.objects = [self.get_object(file) for _ in range(n_objects)]
-
-            ## If the design is spread across multiple hoops, there will
-            ## be a PEC for any hoop that includes any part of the design.
-            ## The data for each of these PECs is not contiguous in the
-            ## file. Rather the basic data for each of the PECs comes first.
-            ## This is followed by index table for each, followed by the thread
-            ## bitmaps for each, followed by the thread RGBs for each. At
-            ## this point there is a section containing bitmaps for the
-            ## entire design. Finally, there are thread specs for each of
-            ## the PECs.
-            self.pecs = [PEC().get(file) for _ in range(self.n_pecs)]
-            for pec in self.pecs:
-                pec.get_redundant_indexes(file)
-            for pec in self.pecs:
-                pec.get_thread_bitmaps(file)
-            for pec in self.pecs:
-                pec.get_thread_colors(file)
-            self.get_section_data(file)
-            for pec in self.pecs:
-                pec.get_thread_specifications(file)
-
-            for pec in self.pecs:
-                pec.remap()
+        if self.n_section_thumbnails == 0:
+            return
+        for thumbnail in self.section_thumbnails:
+            thumbnail.put(file)
+        for rgb in self.section_rgbs:
+            file.put_data(bytes(rgb))
+        self.full_thumbnail.put(file)
+        PES_PHYSICAL_DIMENSIONS.put(file, self)
+        self.huge_thumbnail.put(file)
+
+
+
+    ## With workers set, the stitches of the PECs are decoded concurrently in a pool
+    ## of processes, which is kept for later reads. The stitches of each PEC are taken
+    ## to end where its thumbnail_offset says. If one does not, the PECs are read
+    ## again in order as without workers, so that the same anomalies are reported.
+
+    def get_pecs(self, file, workers):
+        start = file.tell()
+        n_anomalies = len(file.anomalies)
+        pecs = [PEC(self.source) for _ in range(self.n_pecs)]
+        try:
+            stitch_data = []
+            for pec in pecs:
+                thumbnails_start = pec.get_prologue(file)
+                stitch_data.append((file.tell(), file.get_data(thumbnails_start-file.tell())))
+                pec.get_thumbnails(file)
+            results = list(worker_pool(workers).map(decode_stitches,
+                                                    [data for begin, data in stitch_data],
+                                                    [pec.n_layers for pec in pecs]))
+            in_order = all(not problems and used == len(data) for (begin, data),
+                           (layers, ends, used, problems) in zip(stitch_data, results))
+        except Exception:
+            in_order = False
+        if not in_order:
+            del file.anomalies[n_anomalies:]
+            for pec in pecs:
+                self.touch(*getattr(pec, 'thumbnails', ()))
+            file.seek(start)
+            return [PEC(self.source).get(file) for _ in range(self.n_pecs)]
+        for pec, (begin, data), (layers, ends, used, problems) in zip(pecs, stitch_data,
+                                                                      results):
+            pec.layers = layers
+            if self.source:
+                for layer, first, last in zip(layers, [0]+ends, ends):
+                    self.source.record(layer, begin+first, begin+last)
+        return pecs
+
+    ## With track set, the file's bytes are kept, and put copies the objects, PEC
+    ## layers and thumbnails that have not changed straight from them. touch makes put
+    ## encode parts again even so.
+
+    def get(self, path, /, strict=True, workers=None, track=False):
+        ## workers is a number of processes, or an Executor to decode with.
+        self.source = None
+        if track:
+            with open(path, 'rb') as file:
+                self.source = Source(file.read())
+        with PES_File_Reader(path, strict=strict) as file:
+            self.anomalies = file.anomalies
+            return self.get_file(file, workers=workers)
+
+    def get_bytes(self, data, /, strict=True, workers=None, track=False):
+        ## Like get, from the bytes of a file, which may be a memoryview of a memory map.
+        self.source = Source(bytes(data)) if track else None
+        with PES_Buffer_Reader(data, strict=strict) as file:
+            self.anomalies = file.anomalies
+            return self.get_file(file, workers=workers)
+
+    def get_file(self, file, /, workers=None):
+
+        self.get_version(file)
+        n_objects = self.get_header(file)
+        self.get_cembone_tag(file)
+        self.objects = [self.get_object(file) for _ in range(n_objects)]
+        file.check(file.tell() == self.pec_offset,
+                   'pec_offset 0x{:06X} does not match end of objects'.format(self.pec_offset),
+                   Severity.WARNING)
+
+        ## If the design is spread across multiple hoops, there will
+        ## be a PEC for any hoop that includes any part of the design.
+        ## The data for each of these PECs is not contiguous in the
+        ## file. Rather the basic data for each of the PECs comes first.
+        ## This is followed by index table for each, followed by the thread
+        ## bitmaps for each, followed by the thread RGBs for each. At
+        ## this point there is a section containing bitmaps for the
+        ## entire design. Finally, there are thread specs for each of
+        ## the PECs.
+        if workers and self.n_pecs > 1:
+            self.pecs = self.get_pecs(file, workers)
+        else:
+            self.pecs = [PEC(self.source).get(file) for _ in range(self.n_pecs)]
+        for pec in self.pecs:
+            pec.get_redundant_indexes(file)
+        for pec in self.pecs:
+            pec.get_thread_bitmaps(file)
+        for pec in self.pecs:
+            pec.get_thread_colors(file)
+        self.get_section_data(file)
+        for pec in self.pecs:
+            pec.get_thread_specifications(file)
+
+        for pec in self.pecs:
+            pec.remap()
 
         return self
 
 
-    def put(self, path):
-
-        with PES_File_Writer(path) as file:
-
-            self.put_version(file)
-            self.put_header(file)
-            self.put_cembone_tag(file)
-            for obj in self.objects:
-                self.put_object(file, obj)
-
-            for pec in self.pecs:
-                pec.put(file)
-            for pec in self.pecs:
-                pec.put_redundant_indexes(file)
-            for pec in self.pecs:
-                pec.put_thread_bitmaps(file)
-            for pec in self.pecs:
-                pec.put_thread_colors(file)
-            self.put_section_data(file)
-            for pec in self.pecs:
-                pec.put_thread_specifications(file)
+    def touch(self, *parts):
+        if self.source:
+            for part in parts:
+                self.source.discard(part)
+
+    def put(self, path, /, atomic=True):
+        with PES_File_Writer(path, atomic=atomic) as file:
+            self.put_file(file)
+
+    def put_file(self, file):
+
+        self.put_version(file)
+        self.put_header(file)
+        self.put_cembone_tag(file)
+        for obj in self.objects:
+            self.put_object(file, obj)
+
+        self.pec_offset = file.tell()
+        self.n_pecs = len(self.pecs)
+        file.patch('pec_offset', self.pec_offset)
+        for pec in self.pecs:
+            pec.put(file)
+        self.put_pec_tables(file)
+
+    def put_pec_tables(self, file):
+        ## Everything after the PECs themselves. None of it refers to an offset in
+        ## the file, so it can be encoded on its own.
+        for pec in self.pecs:
+            pec.put_redundant_indexes(file)
+        for pec in self.pecs:
+            pec.put_thread_bitmaps(file)
+        for pec in self.pecs:
+            pec.put_thread_colors(file)
+        self.put_section_data(file)
+        for pec in self.pecs:
+            pec.put_thread_specifications(file)
 
 
 if __name__ == '__main__':
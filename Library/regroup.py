@@ -0,0 +1,308 @@
+###---------------------------------------------------------------------------------------------
+### regroup
+###
+### Reorders what is sewn so that runs of one thread color come together, saving color
+### changes. Something sewn later may only be moved ahead of something sewn earlier in
+### another color if the two do not overlap, as judged by their bounding boxes, since
+### whichever is sewn last is on top. The units reordered are the runs of one color of the
+### CSewSeg blocks, across objects, and the PEC layers that match them, which are put in
+### the same order so that the CSewSeg objects and the PECs sew alike.
+###---------------------------------------------------------------------------------------------
+
+import copy
+import numpy as np
+from sys        import argv, exit, stderr
+from os         import environ
+from os.path    import basename
+from heapq      import heappush, heappop
+from argparse   import ArgumentParser, RawDescriptionHelpFormatter
+from pec        import Cmd
+from pesv6      import PESv6, CSewSeg, BLOCK_JUMP
+from stitches   import pec_arrays, absolute, layer_spans
+from compose    import join_layers
+
+description = "Reorders the objects, blocks and layers of a .pes file to save color changes."
+
+## The box of something with no coordinates, which overlaps nothing.
+EMPTY_BOX = (np.inf, np.inf, -np.inf, -np.inf)
+
+## The box of something whose extent is not known, which overlaps everything.
+UNKNOWN_BOX = (-np.inf, -np.inf, np.inf, np.inf)
+
+
+class BoxIndex:
+
+    ## Bounding boxes (xmin, ymin, xmax, ymax), sorted by xmin so that the boxes that
+    ## can overlap a given box are found with a binary search, and then filtered on
+    ## the other three sides all at once.
+
+    def __init__(self, boxes):
+        self.boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        self.order = np.argsort(self.boxes[:,0], kind='stable')
+        self.xmin = self.boxes[self.order,0]
+
+    def overlapping(self, box):
+        ## The indices of the boxes that overlap box, in no particular order.
+        xmin, ymin, xmax, ymax = box
+        candidates = self.order[:np.searchsorted(self.xmin, xmax, side='right')]
+        boxes = self.boxes[candidates]
+        hit = (boxes[:,2] >= xmin) & (boxes[:,1] <= ymax) & (boxes[:,3] >= ymin)
+        return candidates[hit]
+
+
+def box(points):
+    ## The bounding box of an (n, 2) array of points.
+    if not len(points):
+        return EMPTY_BOX
+    return (*points.min(axis=0).tolist(), *points.max(axis=0).tolist())
+
+
+def sew_order(firsts, lasts, boxes):
+
+    """Returns an order in which to sew units that start in the colors firsts, end in
+    the colors lasts and cover boxes. A color of None stands for colors not known. A
+    unit stays after every earlier unit it overlaps, unless both are sewn entirely in
+    the same color. Otherwise units are taken greedily: next is a unit that starts in
+    the color the previous one ended in, or failing that the earliest unit free to go,
+    so the original order is kept where nothing is gained."""
+
+    n = len(firsts)
+    index = BoxIndex(boxes)
+    after = [[] for i in range(n)]
+    n_before = [0]*n
+    for i in range(n):
+        single = firsts[i] is not None and firsts[i] == lasts[i]
+        for j in index.overlapping(index.boxes[i]).tolist():
+            if j > i and not (single and firsts[j] == lasts[j] == firsts[i]):
+                after[i].append(j)
+                n_before[j] += 1
+
+    ## The units free to go, by the color they start in, earliest first.
+    ready = {}
+    for i in range(n):
+        if not n_before[i]:
+            heappush(ready.setdefault(firsts[i], []), i)
+
+    order = []
+    color = None
+    while ready:
+        if color not in ready:
+            color = min(ready, key=lambda color: ready[color][0])
+        i = heappop(ready[color])
+        if not ready[color]:
+            del ready[color]
+        order.append(i)
+        color = lasts[i]
+        for j in after[i]:
+            n_before[j] -= 1
+            if not n_before[j]:
+                heappush(ready.setdefault(firsts[j], []), j)
+    return order
+
+
+def block_points(coordinates):
+    ## CSewSeg coordinates are (y, x).
+    return np.asarray(coordinates, dtype=np.int32).reshape(-1, 2)[:,::-1]
+
+
+def color_list(blocks):
+    ## The (block_index, thread_index) pairs of a CSewSeg color list, one for the
+    ## first block and one for each block in a color other than the previous one's.
+    colors = []
+    for j, (stitch_type, thread_index, coordinates) in enumerate(blocks):
+        if not colors or colors[-1][1] != thread_index:
+            colors.append((j, thread_index))
+    return colors
+
+
+class Runs:
+
+    ## The CSewSeg blocks of a design split into runs of one color, the units that
+    ## are reordered, each matching a PEC layer. A run holds the (object, block)
+    ## positions of its blocks in sewing order. A jump block goes with the sewn block
+    ## after it, and so does any object that is not a CSewSeg object with blocks, as
+    ## an ('object', obj) item. What follows the last sewn block stays at the end.
+
+    def __init__(self, design):
+        runs = []       # (color, items, points)
+        pending = []
+        for o, obj in enumerate(design.objects):
+            if not isinstance(obj, CSewSeg) or not obj.blocks:
+                pending.append(('object', obj))
+                continue
+            for j, (stitch_type, thread_index, coordinates) in enumerate(obj.blocks):
+                pending.append((o, j))
+                if stitch_type == BLOCK_JUMP:
+                    continue
+                rgb = tuple(design.threads[thread_index].rgbx[:3])
+                if not runs or runs[-1][0] != rgb:
+                    runs.append((rgb, [], []))
+                runs[-1][1].extend(pending)
+                runs[-1][2].append(block_points(coordinates))
+                pending = []
+        self.colors = [color for color, items, points in runs]
+        self.items = [items for color, items, points in runs]
+        self.boxes = [UNKNOWN_BOX if any(item[0] == 'object' for item in items) else
+                      box(np.concatenate(points)) for color, items, points in runs]
+        self.tail = pending
+
+    def __len__(self):
+        return len(self.colors)
+
+    def order(self):
+        ## Runs with objects that are not parsed are taken to overlap everything, and
+        ## to be in no color, so that nothing is moved across them.
+        colors = [None if box == UNKNOWN_BOX else color
+                  for color, box in zip(self.colors, self.boxes)]
+        return sew_order(colors, colors, self.boxes)
+
+
+def reorder_objects(design, runs, order):
+
+    """Returns the objects of design with the runs of their blocks in the given order.
+    A CSewSeg object whose runs are split up becomes a copy for each part, with its
+    own color list. Jump blocks start where the block sewn before them now ends, and
+    jump blocks are added where a run moved within an object does not start where
+    the block before it ends."""
+
+    objects = []
+    sources = []        # the original position of each block, by object
+    current = None
+    for item in [item for i in order for item in runs.items[i]]+runs.tail:
+        if item[0] == 'object':
+            objects.append(item[1])
+            sources.append(None)
+            current = None
+            continue
+        o, j = item
+        if current != o:
+            obj = copy.copy(design.objects[o])
+            obj.blocks = []
+            objects.append(obj)
+            sources.append([])
+            current = o
+        objects[-1].blocks.append(design.objects[o].blocks[j])
+        sources[-1].append(item)
+
+    previous = {}       # the block sewn before each block, originally
+    last = None
+    for o, obj in enumerate(design.objects):
+        if isinstance(obj, CSewSeg):
+            for j in range(len(obj.blocks)):
+                previous[(o, j)] = last
+                last = (o, j)
+
+    last = end = None
+    for obj, positions in zip(objects, sources):
+        if positions is None:
+            continue
+        blocks = []
+        for position, (stitch_type, thread_index, coordinates) in zip(positions, obj.blocks):
+            points = np.asarray(coordinates, dtype=np.int16).reshape(-1, 2)
+            if previous[position] != last and end is not None and len(points):
+                if stitch_type == BLOCK_JUMP:
+                    points = np.vstack((end, points[1:])).astype(np.int16)
+                    coordinates = points
+                elif blocks and blocks[-1][0] != BLOCK_JUMP and (points[0] != end).any():
+                    blocks.append((BLOCK_JUMP, thread_index,
+                                   np.vstack((end, points[0])).astype(np.int16)))
+            blocks.append((stitch_type, thread_index, coordinates))
+            if len(points):
+                end = points[-1]
+            last = position
+        obj.blocks = blocks
+        obj.colors = color_list(blocks)
+    return objects
+
+
+def regroup_pec(pec):
+
+    """Returns pec with its layers reordered, and adjacent layers of the same color
+    joined, or pec itself if no layer moves. The color of a layer is its RGB value."""
+
+    ## Only the stitches count, from where each starts to where it ends: jumps and
+    ## trims leave no thread behind.
+    layer, cmd, dx, dy = pec_arrays(pec)
+    x, y = absolute(dx, dy)
+    stitch = np.flatnonzero(cmd == Cmd.STITCH)
+    points = np.stack((np.column_stack((x, y))[stitch],
+                       np.column_stack((x-dx, y-dy))[stitch]), axis=1)
+    ends = np.searchsorted(layer[stitch], np.arange(len(pec.layers)), side='right').tolist()
+    boxes = [box(points[start:end].reshape(-1, 2)) for start, end in zip([0]+ends[:-1], ends)]
+    colors = pec.layer_rgbs()
+    order = sew_order(colors, colors, boxes)
+    if order == sorted(order):
+        return pec
+    spans = layer_spans(pec)
+    return join_layers(pec, [(pec, i, *spans[i]) for i in order])
+
+
+def color_changes(design):
+    ## The number of color changes in the PECs of design.
+    return sum(len(pec.layers)-1 for pec in design.pecs if pec.layers)
+
+
+def regroup(design):
+
+    """Reorders design in place to save color changes. The runs of one color of the
+    CSewSeg blocks are put in a new order, and the layers of every PEC in the same
+    order, so that both sew alike. That needs a layer in every PEC for each run, in
+    the same color; if not, nothing is changed, unless there are no CSewSeg blocks,
+    when the layers of each PEC are reordered on their own. Returns True if anything
+    changed."""
+
+    runs = Runs(design)
+    if not len(runs):
+        pecs = [regroup_pec(pec) for pec in design.pecs]
+        if all(new is old for new, old in zip(pecs, design.pecs)):
+            return False
+        design.pecs = pecs
+        return True
+    for pec in design.pecs:
+        if pec.layer_rgbs() != runs.colors:
+            return False
+    order = runs.order()
+    if order == sorted(order):
+        return False
+    design.objects = reorder_objects(design, runs, order)
+    pecs = []
+    for pec in design.pecs:
+        spans = layer_spans(pec)
+        pecs.append(join_layers(pec, [(pec, i, *spans[i]) for i in order]))
+    design.pecs = pecs
+    return True
+
+
+def main():
+
+    if (script := environ.get('RUNPYTHON')):
+        command = basename(script)
+    else:
+        command = 'python3 {}'.format(argv[0])
+
+    parser = ArgumentParser(prog=command, description=description,
+                            allow_abbrev=False,
+                            formatter_class=RawDescriptionHelpFormatter)
+
+    parser.add_argument('input', metavar='input', type=str,
+                        help="pathname of the .pes file to read")
+
+    parser.add_argument('output', metavar='output', type=str,
+                        help="pathname of the .pes file to write")
+
+    args = parser.parse_args()
+
+    try:
+        design = PESv6().get(args.input)
+        before = color_changes(design)
+        regroup(design)
+        design.put(args.output)
+    except Exception as e:
+        print('{:s}: {:s}: {}'.format(args.input, type(e).__name__, e), file=stderr)
+        exit(1)
+    print('{:s}: {:d} color changes, was {:d}'.format(args.output, color_changes(design),
+                                                      before))
+
+
+if __name__ == '__main__':
+    main()
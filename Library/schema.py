@@ -0,0 +1,235 @@
+###---------------------------------------------------------------------------------------------
+### schema
+###
+### Declarative descriptions of the fixed records in PES and PEC files. Each record is
+### described once as a list of fields, and is compiled into precomputed struct.Struct
+### objects, one per run of consecutive fixed-width fields, so that a whole run is read
+### or written with a single call. Variable-width fields (utf8 and tagged strings) break
+### the runs and are read or written with the corresponding method of the file. The same
+### description drives the dumper, which prints each field by calling dump_<kind>.
+###---------------------------------------------------------------------------------------------
+
+from struct import Struct
+
+## Struct codes for fixed-width kinds. The 'size' of a field is the element count for
+## vectors, and the byte count for data and text.
+SCALAR_CODES = {
+    'uint8':            'B',
+    'int8':             'b',
+    'uint16':           'H',
+    'int16':            'h',
+    'uint32':           'I',
+    'int32':            'i',
+    'bool16':           'H',
+    'float32':          'f',
+}
+
+VECTOR_CODES = {
+    'vector_int8':      'b',
+    'vector_uint8':     'B',
+    'vector_int16':     'h',
+    'vector_uint16':    'H',
+    'vector_uint32':    'I',
+    'vector_float32':   'f',
+}
+
+BYTES_KINDS = ('data', 'text', 'uint24')
+
+VARIABLE_KINDS = ('utf8', 'tagged_string')
+
+TEXT_ENCODING = 'latin-1'
+
+
+class Field:
+
+    def __init__(self, name, kind, size=None, /, fmt=None, const=None, length_size=None):
+        assert (kind in SCALAR_CODES or kind in VECTOR_CODES or
+                kind in BYTES_KINDS or kind in VARIABLE_KINDS), (
+            'unknown kind {!r:s} for field {!r:s}'.format(kind, name))
+        if kind == 'uint24':
+            size = 3
+        self.name           = name
+        self.kind           = kind
+        self.size           = size
+        self.fmt            = fmt
+        self.const          = const          # expected value, checked on get, written on put
+        self.length_size    = length_size    # for utf8 strings
+
+    def __repr__(self):
+        return '{:s}({!r:s}, {!r:s}, {!r})'.format(
+            __class__.__name__, self.name, self.kind, self.size)
+
+    @property
+    def is_fixed(self):
+        return self.kind not in VARIABLE_KINDS
+
+    @property
+    def code(self):
+        if self.kind in SCALAR_CODES:
+            return SCALAR_CODES[self.kind]
+        if self.kind in VECTOR_CODES:
+            return '{:d}{:s}'.format(self.size, VECTOR_CODES[self.kind])
+        return '{:d}s'.format(self.size)
+
+    @property
+    def count(self):
+        """Number of values the field contributes to a struct unpack."""
+        return self.size if self.kind in VECTOR_CODES else 1
+
+    def decode(self, value):
+        match self.kind:
+            case 'bool16':
+                return value != 0
+            case 'text':
+                return value.decode(TEXT_ENCODING)
+            case 'uint24':
+                return int.from_bytes(value, 'little')
+        return value
+
+    def encode(self, value):
+        match self.kind:
+            case 'bool16':
+                return int(bool(value))
+            case 'text':
+                return value.encode(TEXT_ENCODING)
+            case 'uint24':
+                return value.to_bytes(3, 'little')
+        return value
+
+    def get(self, file):
+        if self.length_size is not None:
+            return getattr(file, 'get_'+self.kind)(length_size=self.length_size)
+        return getattr(file, 'get_'+self.kind)()
+
+    def put(self, file, value):
+        if self.length_size is not None:
+            getattr(file, 'put_'+self.kind)(value, length_size=self.length_size)
+        else:
+            getattr(file, 'put_'+self.kind)(value)
+
+    def dump(self, f):
+        kwargs = {}
+        if self.fmt is not None:
+            kwargs['fmt'] = self.fmt
+        if self.length_size is not None:
+            kwargs['length_size'] = self.length_size
+        dump = getattr(f, 'dump_'+self.kind)
+        if self.kind in VECTOR_CODES or self.kind in ('data', 'text'):
+            return dump(self.name, self.size, **kwargs)
+        return dump(self.name, **kwargs)
+
+
+class Run:
+
+    """A run of consecutive fixed-width fields packed by a single struct.Struct."""
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.struct = Struct('<'+''.join(field.code for field in fields))
+        self.size = self.struct.size
+        self.slices = []
+        start = 0
+        for field in fields:
+            self.slices.append((field, start, field.count))
+            start += field.count
+
+    def unpack(self, data, values):
+        raw = self.struct.unpack(data)
+        for field, start, count in self.slices:
+            if field.kind in VECTOR_CODES:
+                values[field.name] = raw[start:start+count]
+            else:
+                values[field.name] = field.decode(raw[start])
+
+    def pack(self, value_of):
+        flat = []
+        for field in self.fields:
+            value = value_of(field)
+            if field.kind in VECTOR_CODES:
+                flat.extend(value)
+            else:
+                flat.append(field.encode(value))
+        return self.struct.pack(*flat)
+
+
+class Record:
+
+    def __init__(self, *fields):
+        self.fields = fields
+        self.segments = []
+        run = []
+        for field in fields:
+            if field.is_fixed:
+                run.append(field)
+                continue
+            if run:
+                self.segments.append(Run(run))
+                run = []
+            self.segments.append(field)
+        if run:
+            self.segments.append(Run(run))
+
+    def __add__(self, other):
+        return Record(*self.fields, *other.fields)
+
+    @property
+    def size(self):
+        """Size in bytes of a record with no variable-width fields."""
+        assert all(isinstance(segment, Run) for segment in self.segments)
+        return sum(segment.size for segment in self.segments)
+
+    def offset(self, name):
+        """Offset in bytes of the named field, which must follow only fixed-width fields."""
+        offset = 0
+        for field in self.fields:
+            if field.name == name:
+                return offset
+            assert field.is_fixed, (
+                '{!r:s} follows variable-width field {!r:s}'.format(name, field.name))
+            offset += Struct('<'+field.code).size
+        raise KeyError(name)
+
+    def check_constants(self, file, values):
+        for field in self.fields:
+            if field.const is not None:
+                value = values.pop(field.name)
+                file.check(value == field.const,
+                           'expected {!r} for {:s} but got {!r}'
+                           .format(field.const, field.name, value))
+
+    def get(self, file, obj=None):
+        """Reads the record, checking any constant fields. Stores the other fields as
+        attributes of obj, if given, and returns them as a dictionary."""
+        values = {}
+        for segment in self.segments:
+            if isinstance(segment, Run):
+                segment.unpack(file.get_data(segment.size), values)
+            else:
+                values[segment.name] = segment.get(file)
+        self.check_constants(file, values)
+        if obj is not None:
+            obj.__dict__.update(values)
+        return values
+
+    def put(self, file, obj, /, **overrides):
+        """Writes the record from the attributes of obj. Keyword arguments override
+        individual attributes."""
+        def value(field):
+            if field.const is not None:
+                return field.const
+            if field.name in overrides:
+                return overrides[field.name]
+            return getattr(obj, field.name)
+        for segment in self.segments:
+            if isinstance(segment, Run):
+                file.put_data(segment.pack(value))
+            else:
+                segment.put(file, value(segment))
+
+    def dump(self, f):
+        """Dumps the record one field at a time and returns the values dumped."""
+        values = {}
+        for field in self.fields:
+            values[field.name] = field.dump(f)
+        self.check_constants(f, values)
+        return values
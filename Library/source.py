@@ -0,0 +1,54 @@
+###---------------------------------------------------------------------------------------------
+### source
+###
+### Remembers the bytes a design was read from and where each of its larger parts came
+### from, so that the parts left unchanged can be copied back on put instead of being
+### encoded again.
+###---------------------------------------------------------------------------------------------
+
+import pickle
+from hashlib import blake2b
+
+
+def digest(part):
+    ## A digest of the contents of part, a list or an object with attributes.
+    contents = part if isinstance(part, list) else vars(part)
+    return blake2b(pickle.dumps(contents, pickle.HIGHEST_PROTOCOL), digest_size=16).digest()
+
+
+class Source:
+
+    ## A part is changed if its contents differ from what they were when it was read,
+    ## whether it was changed in place, e.g. by moving one stitch of a layer, or had
+    ## attributes assigned. The contents are compared by a digest taken when the part
+    ## is recorded, so a part changed and then changed back counts as unchanged.
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.parts = {}
+
+    def record(self, part, start, end):
+        ## The part itself is kept so that its id is not reused.
+        self.parts[id(part)] = (part, digest(part), start, end)
+
+    def span(self, part):
+        ## The (start, end) byte range part was read from, or None.
+        if (entry := self.parts.get(id(part))) is None:
+            return None
+        return entry[2:]
+
+    def discard(self, part):
+        self.parts.pop(id(part), None)
+
+    def get(self, part):
+
+        """Returns the bytes part was read from, or None if it has changed since or
+        was not read from the source."""
+
+        if (entry := self.parts.get(id(part))) is None:
+            return None
+        part, snapshot, start, end = entry
+        if digest(part) != snapshot:
+            self.discard(part)
+            return None
+        return self.data[start:end]
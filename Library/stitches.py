@@ -0,0 +1,84 @@
+###---------------------------------------------------------------------------------------------
+### stitches
+###
+### Conversions between the PEC layer lists of (cmd, args) tuples and NumPy arrays, for
+### code that works on whole designs at once.
+###---------------------------------------------------------------------------------------------
+
+import numpy as np
+from itertools import chain
+from pec import Cmd
+
+## PEC coordinates are in tenths of a millimeter.
+UNITS_PER_MM = 10
+
+
+def layer_moves(layer):
+    return [(cmd, *args) for cmd, args in layer
+            if cmd != Cmd.COLOR and cmd != Cmd.STOP]
+
+
+def pec_arrays(pec):
+
+    """Returns the layer, cmd, dx and dy arrays of every move in pec, in stitch order.
+    The COLOR and STOP instructions that end each layer are left out."""
+
+    arrays = [layer_arrays(layer) for layer in pec.layers]
+    layer = np.repeat(np.arange(len(arrays), dtype=np.int32),
+                      [len(cmd) for cmd, dx, dy in arrays])
+    if not arrays:
+        return layer, layer, layer, layer
+    cmd, dx, dy = (np.concatenate(a) for a in zip(*arrays))
+    return layer, cmd, dx, dy
+
+
+def layer_arrays(layer):
+
+    """Returns the cmd, dx and dy arrays of the moves in a single layer. The arrays are
+    filled straight from iterators over the layer, without building a tuple for each
+    move, as this is the slow part for large layers."""
+
+    n = len(layer)
+    cmd = np.fromiter((cmd for cmd, args in layer), dtype=np.int32, count=n)
+    sizes = np.fromiter((len(args) for cmd, args in layer), dtype=np.intp, count=n)
+    values = np.fromiter(chain.from_iterable(args for cmd, args in layer),
+                         dtype=np.int32, count=int(sizes.sum()))
+    move = (cmd != Cmd.COLOR) & (cmd != Cmd.STOP)
+    xy = values[np.repeat(move, sizes)].reshape(-1, 2)
+    return cmd[move], xy[:,0], xy[:,1]
+
+
+def layer_spans(pec):
+
+    """Returns the (x, y) positions, relative to the start of pec, at which each of its
+    layers starts and ends, as a list of (start, end) pairs."""
+
+    layer, cmd, dx, dy = pec_arrays(pec)
+    x, y = absolute(dx, dy)
+    ends = np.searchsorted(layer, np.arange(len(pec.layers)), side='right')
+    x, y = np.append(0, x).tolist(), np.append(0, y).tolist()
+    positions = [(x[end], y[end]) for end in ends.tolist()]
+    return list(zip([(0, 0)]+positions[:-1], positions))
+
+
+def absolute(dx, dy, /, x0=0, y0=0):
+
+    """Returns the absolute positions reached after each of the relative moves."""
+
+    return x0+np.cumsum(dx, dtype=np.int64), y0+np.cumsum(dy, dtype=np.int64)
+
+
+def split_move(cmd, dx, dy, /, limit=1000):
+
+    """Splits a move into equal moves of at most limit units along each axis, so that
+    each fits a PEC coordinate. Returns a list of (cmd, [dx, dy]) instructions."""
+
+    n = max(1, -(-max(abs(dx), abs(dy))//limit))
+    moves = []
+    x = y = 0
+    for i in range(1, n+1):
+        step_x, step_y = dx*i//n-x, dy*i//n-y
+        moves.append((cmd, [step_x, step_y]))
+        x += step_x
+        y += step_y
+    return moves
@@ -0,0 +1,97 @@
+###---------------------------------------------------------------------------------------------
+### template
+###
+### Produces many variants of one design that differ only in one object, e.g. the
+### lettering of a personalized patch. The design is encoded once into byte segments,
+### and each variant is assembled from those segments around the re-encoded object,
+### with the offsets that depend on its length filled in.
+###---------------------------------------------------------------------------------------------
+
+from pec        import PEC_PROLOGUE, PEC_DIMENSIONS
+from pesv6      import PES_File_Writer, PES_HEADER_PROLOGUE
+
+
+def encode(put, *args):
+    ## Returns the bytes written by put(file, *args) to a writer with no path.
+    file = PES_File_Writer()
+    put(file, *args)
+    return file.getvalue()
+
+
+class CompiledPEC:
+
+    ## A PEC split into its prologue around the thumbnail offset, the encoded stitches
+    ## of each layer, and the thumbnails.
+
+    def __init__(self, pec):
+        pec.n_layers = len(pec.layers)
+        pec.n_changes = pec.n_layers-1
+        prologue = encode(pec.put_prologue)
+        at = PEC_PROLOGUE.offset('thumbnail_offset')
+        self.prologue = (prologue[:at], prologue[at+3:])
+        self.layers = [encode(pec.put_layer, layer) for layer in pec.layers]
+        self.thumbnails = encode(pec.put_thumbnails)
+        self.pec = pec
+
+    def segments(self, /, layers=None):
+        stitches = list(self.layers)
+        for i, layer in (layers or {}).items():
+            stitches[i] = encode(self.pec.put_layer, layer)
+        ## The thumbnail offset counts from the start of the dimensions.
+        thumbnail_offset = PEC_DIMENSIONS.size+sum(map(len, stitches))
+        return [self.prologue[0], thumbnail_offset.to_bytes(3, 'little'),
+                self.prologue[1], *stitches, self.thumbnails]
+
+
+class Template:
+
+    """A design compiled for producing variants in which the object at index slot is
+    replaced. Everything else is encoded once, here. A variant may also replace whole
+    PEC layers, such as the layer that sews the lettering, but keeps the number of
+    layers, their colors and thumbnails, and the PEC dimensions of the template."""
+
+    def __init__(self, design, slot):
+        if not 0 <= slot < len(design.objects):
+            raise ValueError('no object {:d} to replace'.format(slot))
+        self.slot = slot
+
+        file = PES_File_Writer()
+        design.put_version(file)
+        start = file.tell()
+        design.put_header(file)
+        design.put_cembone_tag(file)
+        for obj in design.objects[:slot]:
+            design.put_object(file, obj)
+        file.patch('pec_offset', 0)
+        head = file.getvalue()
+        at = start+PES_HEADER_PROLOGUE.offset('pec_offset')
+        self.head = (head[:at], head[at+4:])
+
+        self.tail = b''.join(encode(design.put_object, obj)
+                             for obj in design.objects[slot+1:])
+        self.pecs = [CompiledPEC(pec) for pec in design.pecs]
+        self.pec_tables = encode(design.put_pec_tables)
+
+    def segments(self, obj, /, layers=None):
+
+        """Returns the list of byte segments of the variant with obj in the slot.
+        layers maps (PEC index, layer index) pairs to replacement layers."""
+
+        by_pec = {}
+        for (p, i), layer in (layers or {}).items():
+            by_pec.setdefault(p, {})[i] = layer
+        body = encode(obj.put)
+        pec_offset = len(self.head[0])+4+len(self.head[1])+len(body)+len(self.tail)
+        return [self.head[0], pec_offset.to_bytes(4, 'little'), self.head[1],
+                body, self.tail,
+                *(segment for p, pec in enumerate(self.pecs)
+                  for segment in pec.segments(layers=by_pec.get(p))),
+                self.pec_tables]
+
+    def instantiate(self, obj, /, layers=None):
+        return b''.join(self.segments(obj, layers=layers))
+
+    def put(self, path, obj, /, layers=None, atomic=True):
+        with PES_File_Writer(path, atomic=atomic) as file:
+            for segment in self.segments(obj, layers=layers):
+                file.put_data(segment)
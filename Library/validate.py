@@ -0,0 +1,106 @@
+###---------------------------------------------------------------------------------------------
+### validate
+###
+### Parses .pes files without stopping at the first problem, and reports every structural
+### anomaly found with its byte offset and severity, so that a whole corpus can be triaged
+### in one pass.
+###---------------------------------------------------------------------------------------------
+
+from sys        import argv, exit
+from os         import environ
+from os.path    import basename, getsize, isdir
+from glob       import glob
+from argparse   import ArgumentParser, RawDescriptionHelpFormatter
+from anomalies  import Severity, Anomaly
+from pesv6      import PES_File_Reader, PESv6
+
+description = "Reports structural anomalies in .pes embroidery files."
+
+
+def validate(path):
+
+    """Parses the file at path in non-strict mode and returns the list of anomalies
+    found. An exception that stops the parse is recorded as a FATAL anomaly at the
+    offset where it occurred."""
+
+    with PES_File_Reader(path, strict=False) as file:
+        try:
+            PESv6().get_file(file)
+        except Exception as e:
+            file.anomalies.append(Anomaly(file.tell(), Severity.FATAL,
+                                          '{:s}: {}'.format(type(e).__name__, e)))
+        else:
+            if (excess := getsize(path)-file.tell()) > 0:
+                file.check(False, '{:d} bytes of excess at end of file'.format(excess),
+                           Severity.WARNING)
+        return file.anomalies
+
+
+def expand_paths(paths):
+    for path in paths:
+        if isdir(path):
+            yield from sorted(glob(path+'/**/*.pes', recursive=True))
+        else:
+            yield path
+
+
+def validate_corpus(paths, /, min_severity=Severity.INFO):
+
+    """Validates every .pes file in paths, descending into directories. Yields a
+    (path, anomalies) pair for each file, keeping only anomalies of at least
+    min_severity."""
+
+    for path in expand_paths(paths):
+        yield path, [anomaly for anomaly in validate(path)
+                     if anomaly.severity >= min_severity]
+
+
+def main():
+
+    if (script := environ.get('RUNPYTHON')):
+        command = basename(script)
+    else:
+        command = 'python3 {}'.format(argv[0])
+
+    parser = ArgumentParser(prog=command, description=description,
+                            allow_abbrev=False,
+                            formatter_class=RawDescriptionHelpFormatter)
+
+    parser.add_argument('paths', metavar='path', type=str, nargs='+',
+                        help="pathname of a file, or of a directory to search for .pes files")
+
+    parser.add_argument('-s', '--min-severity',
+                        dest='min_severity',
+                        choices=[severity.name for severity in Severity],
+                        help="only report anomalies at least this severe")
+
+    parser.add_argument('-q', '--quiet',
+                        dest='quiet',
+                        action='store_true',
+                        help="only print the summary")
+
+    parser.set_defaults(min_severity=Severity.INFO.name, quiet=False)
+
+    args = parser.parse_args()
+
+    counts = dict.fromkeys(Severity, 0)
+    n_files = n_clean = 0
+    for path, anomalies in validate_corpus(args.paths,
+                                           min_severity=Severity[args.min_severity]):
+        n_files += 1
+        n_clean += not anomalies
+        for anomaly in anomalies:
+            counts[anomaly.severity] += 1
+            if not args.quiet:
+                print('{:s}: {}'.format(path, anomaly))
+
+    print('{:d} files, {:d} clean; {:s}'.format(
+        n_files, n_clean,
+        ', '.join('{:d} {:s}'.format(count, severity.name)
+                  for severity, count in counts.items())))
+
+    exit(1 if counts[Severity.ERROR] or counts[Severity.FATAL] else 0)
+
+
+if __name__ == '__main__':
+    main()